@@ -4,50 +4,72 @@
 import tkinter as tk
 from tkinter import ttk
 
-# ChucK and music-utilized imports
-from chuck import *
-
 # used for sleeping
 import time
 
 import random
 import math
+import collections
+import bisect
+
+# used for vectorized sample math
+import numpy as np
 
 # used for concurrency
 import threading
+import queue
 import os
 
-# used for I/O
-import RPi.GPIO as GPIO
+# used for OSC to ChucK and the fleet telemetry
+import socket
+import struct
+import ipaddress
+
+# used for the telemetry store
+import mmap
+import zlib
+import calendar
 
 # used for weather data acquisition
 import urllib.request, urllib.parse, json
+import asyncio
+import ssl
+import concurrent.futures
+import signal
 
-# ADC import
-import Adafruit_ADS1x15
+# used for the pitch set file
+import fractions
 
-# GPIO mode output pin
-MODE_PIN = 26
-GPIO.setmode(GPIO.BCM)
+# used for the command line and simulated runs
+import argparse
+import sys
+import wave
+
+# used for logging and the metrics endpoint
+import logging
+import tempfile
 
-# setup pin 26 as output
-GPIO.setup(MODE_PIN, GPIO.OUT)
+# the hardware modules (RPi.GPIO, Adafruit_ADS1x15 and chuck) are imported
+# by PiHardware, so the app loads and simulates off the Pi
 
+# GPIO mode output pin
 # LOW = auto mode, HIGH = user mode
-# default to auto mode
-GPIO.output(MODE_PIN, GPIO.LOW)
+MODE_PIN = 26
 
-# pitch set global variable and mutex
-c = threading.Condition()
-ps = 0
 
-# Timer global variable and mutex
-c1 = threading.Condition()
 TIMEOUT = 120 # number of seconds before user goes to auto mode
-timer = TIMEOUT
 
-# setup ADC
-adc = Adafruit_ADS1x15.ADS1115()
+# ADC acquisition mode
+#  - "single"     = sampler polls single-shot conversions every SAMPLE_INTERVAL
+#  - "continuous" = ADC converts continuously, ALERT/RDY pin signals each sample
+ADC_MODE = "single"
+
+# ADC DATA RATES (samples per second, continuous mode)
+#  - 8, 16, 32, 64, 128, 250, 475, 860
+DATA_RATE = 128
+IDLE_DATA_RATE = 8
+# GPIO input wired to the ADS1115 ALERT/RDY pin
+ALERT_PIN = 17
 
 # ADC GAIN VALUES
 #  - 2/3 = +/-6.144V
@@ -57,12 +79,126 @@ adc = Adafruit_ADS1x15.ADS1115()
 #  -   8 = +/-0.512V
 #  -  16 = +/-0.256V
 GAIN = 1
+# millivolts at the ADC input per count, at each gain
+ADC_MV_PER_COUNT = { 2/3:6144 / 32768, 1:4096 / 32768, 2:2048 / 32768,
+                     4:1024 / 32768, 8:512 / 32768, 16:256 / 32768 }
+
+# battery current sensor output, millivolts per mA of charge current
+BATTERY_MV_PER_MA = 1.0
 
 # setup channels
 VOLTAGE = 0
 CURRENT = 1
 BATTERY = 2
 
+# seconds between ADC scans of all channels
+# oversampled, the filtered streams below decimate to what consumers need
+SAMPLE_INTERVAL = 0.05
+# background scan interval while nothing showing needs live readings
+IDLE_SAMPLE_INTERVAL = 1.0
+
+# seconds of notes kept queued ahead of the audio output
+AUDIO_LOOKAHEAD = 0.5
+
+# note output
+#  - "chuck" = StruckBar calls through the chuck module, one message per call
+#  - "osc"   = frequency and strike sent together as one OSC bundle over a
+#              single UDP socket, the receiver must handle OSC_FREQ_ADDRESS
+#              and OSC_STRIKE_ADDRESS, and OSC_SETUP_ADDRESS for each voice's
+#              preset, volume, stick hardness and strike position, as
+#              struckbar.ck does (start it with struckbarLauncher.sh)
+NOTE_OUTPUT = "chuck"
+OSC_HOST = "127.0.0.1"
+OSC_PORT = 6449
+OSC_FREQ_ADDRESS = "/struckbar/frequency"
+OSC_STRIKE_ADDRESS = "/struckbar/strike"
+OSC_SETUP_ADDRESS = "/struckbar/setup"
+# set when the receiver honors bundle timetags, upcoming notes are then sent
+# AUDIO_LOOKAHEAD early, several per packet, and the receiver plays them on time
+OSC_TIMETAGS = False
+
+# composition
+#  - "neighbour" = every note the main pitch or a neighbour, one voice
+#  - "markov"    = whole measures from precomputed Markov phrase tables,
+#                  melody and bass voices
+COMPOSER = "neighbour"
+
+# how the background services run
+#  - "threads" = a thread per service
+#  - "asyncio" = one task per service on a single event loop that also
+#                pumps Tk, blocking I2C reads go to one executor thread
+RUNTIME = "threads"
+TK_PUMP_INTERVAL = 0.02 # seconds between Tk event pumps under asyncio
+
+# pitch sets, hot-reloaded from the file when it changes
+PITCHSET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pitchsets.json")
+PITCHSET_POLL = 2 # seconds between checks of the file
+
+# offline rendering to WAV
+RENDER_RATE = 22050 # samples per second
+RENDER_BLOCK = 4096 # samples synthesized at a time
+RENDER_GAIN = 0.35 # mix level before soft clipping
+RENDER_SPEED = 240 # profile seconds per audio second, a day in 6 minutes
+
+# output rates of the filtered streams (Hz)
+AUDIO_RATE = 10
+LABEL_RATE = 0.5
+TELEMETRY_RATE = 1
+# filter of each stream, see FILTERS
+#  - "average" = boxcar average
+#  - "median"  = sliding median, rejects single sample spikes
+#  - "iir"     = first order low pass, smooths as much as the average
+AUDIO_FILTER = "median"
+LABEL_FILTER = "average"
+TELEMETRY_FILTER = "average"
+
+# directory holding the telemetry, charge and weather files
+DATA_DIR = "/home/pi/SPC"
+
+# telemetry store settings
+TELEMETRY_DIR = "telemetry" # in DATA_DIR
+TELEMETRY_SEGMENT = 86400 # seconds of readings per segment file
+TELEMETRY_RETENTION = 30 # days segment files are kept
+TELEMETRY_FLUSH = 60 # seconds between flushes to the SD card
+
+# battery charge counting
+CHARGE_ON = 1100 # raw battery reading that starts a charge
+CHARGE_OFF = 900 # raw battery reading that ends it
+CHARGE_MAX_GAP = 60 # seconds between samples that are still integrated
+CHARGE_STATE = "charge.json" # running totals in DATA_DIR, kept across restarts
+CHARGE_SAVE = 30 # seconds between saves of the running totals
+
+# rollup levels for the history charts, (bucket width in seconds, buckets kept)
+ROLLUP_LEVELS = ((1, 3600), (60, 1440), (900, 672), (3600, 672))
+# seconds of stored telemetry the rollups are seeded from at boot
+ROLLUP_SEED = 7 * 86400
+# most points drawn per chart line
+CHART_POINTS = 360
+
+# weather settings
+WEATHER_CACHE = "weather.json" # last known good reading, in DATA_DIR
+WEATHER_TTL = 600 # seconds before a reading is refreshed
+WEATHER_IDLE_TTL = 3600 # refresh period while the weather isn't on screen
+WEATHER_TIMEOUT = 15 # seconds before a request is abandoned
+WEATHER_MAX_BACKOFF = 900 # longest wait between failed requests
+
+# local metrics endpoint, Prometheus text format at /metrics
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9105 # 0 turns it off
+
+# web dashboard, on by default in headless mode
+WEB_HOST = "0.0.0.0"
+WEB_PORT = 8080
+WEB_MAX_CLIENTS = 200 # browsers watching at once
+WEB_CLIENT_BACKLOG = 64 # updates a browser may fall behind before it is dropped
+WEB_KEEPALIVE = 15 # seconds between keepalives on a quiet event stream
+
+# fleet telemetry, frames sent to a FleetCollector over UDP
+FLEET_PORT = 6500
+FLEET_RATE = 1 # frames per second
+FLEET_TTL = 1 # multicast hops, 1 stays on the local network
+FLEET_HISTORY = 3600 # frames kept per node by the collector
+
 # setup fonts
 SM_FONT = ("Verdana", "11")
 MED_FONT = ("Verdana", "12")
@@ -71,15 +207,1973 @@ LARGE_FONT = ("Verdana", "18")
 XL_FONT = ("Verdana", "21")
 TITLE_FONT = ("Verdana", "24")
 
-# init ChucK
-init()
-
 # seed random
 random.seed(None)
 
+# per-sample and per-note messages are DEBUG, hidden by default
+log = logging.getLogger("spc")
+
 # Wait to ensure internet connection on boot
 # time.sleep(10)
 
+'''
+    Metric Classes
+        Counters, gauges and histograms kept in plain Python numbers so
+        updating one costs about as much as an attribute write
+        They take no locks, though some are updated from several threads
+        (notesPlayed from every NoteScheduler and from simulateDays,
+        adcReadSeconds from the sampler or the GPIO callback thread)
+        A += can lose an update when another thread runs between its read
+        and its write, and a scrape can catch a histogram between its
+        fields. Either puts a count off by one now and then, well below
+        what a rate or a percentile shows, so it isn't worth taking a lock
+        on every sample and note
+'''
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount = 1):
+        self.value += amount
+
+    def samples(self):
+        return [(self.name, "", self.value)]
+
+# value is read from fn() when scraped
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def samples(self):
+        return [(self.name, "", self.fn())]
+
+# bounds are the increasing upper bounds of the buckets
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, bounds):
+        self.name = name
+        self.help = help
+        self.bounds = bounds
+        # last bucket counts everything above the top bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        samples = []
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            samples.append((self.name + "_bucket", '{le="' + repr(bound) + '"}', total))
+        samples.append((self.name + "_bucket", '{le="+Inf"}', self.count))
+        samples.append((self.name + "_sum", "", self.sum))
+        samples.append((self.name + "_count", "", self.count))
+        return samples
+
+'''
+    Metrics Registry Class
+        Every metric by name, rendered in the Prometheus text format
+'''
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    # registering a name again replaces the old gauge
+    def gauge(self, name, help, fn):
+        return self.add(Gauge(name, help, fn))
+
+    def histogram(self, name, help, bounds):
+        return self.add(Histogram(name, help, bounds))
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append("# HELP " + metric.name + " " + metric.help)
+            lines.append("# TYPE " + metric.name + " " + metric.type)
+            for name, labels, value in metric.samples():
+                lines.append(name + labels + " " + repr(float(value)))
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+adcReadSeconds = metrics.histogram("spc_adc_read_seconds", "Time to read one ADC conversion",
+                                   (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1))
+adcScans = metrics.counter("spc_adc_scans_total", "Scans of every ADC channel published")
+notesPlayed = metrics.counter("spc_notes_total", "Notes handed to the audio output")
+noteLateness = metrics.histogram("spc_note_lateness_seconds", "Time notes reached the audio output after they were due",
+                                 (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1))
+uiUpdateLag = metrics.histogram("spc_ui_update_lag_seconds", "Time from a label update being posted to it being applied",
+                                (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+weatherFetchSeconds = metrics.histogram("spc_weather_fetch_seconds", "Duration of weather fetches, failed ones included",
+                                        (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 15.0))
+weatherFetchFailures = metrics.counter("spc_weather_fetch_failures_total", "Weather fetches that failed")
+
+# reads an HTTP request, returns (method, unquoted path, query dict of lists)
+async def readRequest(reader):
+    request = await asyncio.wait_for(reader.readline(), 5)
+    # headers are ignored
+    while True:
+        line = await asyncio.wait_for(reader.readline(), 5)
+        if line in (b"\r\n", b"\n", b""):
+            break
+    parts = request.decode("latin-1").split()
+    if len(parts) < 2:
+        raise ValueError("bad request line " + repr(request))
+    url = urllib.parse.urlsplit(parts[1])
+    return parts[0], urllib.parse.unquote(url.path), urllib.parse.parse_qs(url.query)
+
+async def writeResponse(writer, status, contentType, body):
+    writer.write(("HTTP/1.0 " + status + "\r\n" +
+                  "Content-Type: " + contentType + "\r\n" +
+                  "Content-Length: " + str(len(body)) + "\r\n\r\n").encode("latin-1") + body)
+    await writer.drain()
+
+'''
+    Metrics Server Class
+        Serves the registry at /metrics in the Prometheus text format over
+        plain HTTP, on its own asyncio event loop
+            Inputs:
+                registry - MetricsRegistry to serve
+                host - address to listen on, loopback keeps it local
+                port - TCP port to listen on
+'''
+class MetricsServer(threading.Thread):
+    def __init__(self, registry, host, port):
+        threading.Thread.__init__(self)
+        self.registry = registry
+        self.host = host
+        self.port = port
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, query = await readRequest(reader)
+            if method == "GET" and path == "/metrics":
+                await writeResponse(writer, "200 OK", "text/plain; version=0.0.4",
+                                    self.registry.render().encode("utf-8"))
+            else:
+                await writeResponse(writer, "404 Not Found", "text/plain", b"not found\n")
+        except (OSError, ValueError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def runAsync(self, runtime):
+        try:
+            server = await asyncio.start_server(self.handle, self.host, self.port)
+        except OSError as e:
+            log.warning("Metrics server failed to start: %r", e)
+            return
+        try:
+            await asyncio.get_event_loop().create_future()
+        finally:
+            server.close()
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self.runAsync(None))
+
+'''
+    ADC Sample
+        One timestamped scan of every ADC channel
+            Fields:
+                t - clock.monotonic() timestamp of the scan, see SystemClock
+                voltage - raw VOLTAGE channel value
+                current - raw CURRENT channel value
+                battery - raw BATTERY channel value
+'''
+Sample = collections.namedtuple("Sample", ["t", "voltage", "current", "battery"])
+
+'''
+    Linear Calibration
+        Converts raw ADC counts to units with counts * scale + offset
+            Inputs:
+                scale - units per count
+                offset - units at zero counts
+'''
+class LinearCalibration:
+    def __init__(self, scale, offset = 0.0):
+        self.scale = scale
+        self.offset = offset
+
+    # plain arithmetic, a single reading stays a Python float
+    def convert(self, counts):
+        return counts * self.scale + self.offset
+
+'''
+    Piecewise Calibration
+        Converts raw ADC counts to units by interpolating a measured table,
+        values outside the table are clamped to its ends
+            Inputs:
+                counts - increasing raw ADC counts of the table points
+                values - units at each of the table points
+'''
+class PiecewiseCalibration:
+    def __init__(self, counts, values):
+        self.counts = np.array(counts, dtype=np.float64)
+        self.values = np.array(values, dtype=np.float64)
+        self.countList = self.counts.tolist()
+        self.valueList = self.values.tolist()
+
+    def convert(self, counts):
+        if isinstance(counts, np.ndarray):
+            return np.interp(counts, self.counts, self.values)
+        # a single reading, interpolated without NumPy
+        i = bisect.bisect_right(self.countList, counts)
+        if i == 0:
+            return self.valueList[0]
+        if i == len(self.countList):
+            return self.valueList[-1]
+        c0, c1 = self.countList[i - 1], self.countList[i]
+        v0, v1 = self.valueList[i - 1], self.valueList[i]
+        return v0 + (v1 - v0) * (counts - c0) / (c1 - c0)
+
+'''
+    Calibration Class
+        Holds the calibration of every ADC channel and converts single
+        readings, or whole blocks of stored records in one call, to
+        engineering units
+            Inputs:
+                tables - dict of channel to LinearCalibration/PiecewiseCalibration
+'''
+class Calibration:
+    def __init__(self, tables):
+        self.tables = tables
+
+    # counts may be a single reading or a NumPy array of readings
+    def convert(self, channel, counts):
+        return self.tables[channel].convert(counts)
+
+    # converts records with voltage, current and battery fields, such as
+    # TelemetryStore.query rows, to (volts, amps, mA) arrays
+    def convertBlock(self, records):
+        return (self.convert(VOLTAGE, records['voltage'].astype(np.float64)),
+                self.convert(CURRENT, records['current'].astype(np.float64)),
+                self.convert(BATTERY, records['battery'].astype(np.float64)))
+
+calibration = Calibration({
+    # maps [0 - 26500] to [0 - 10V] to [0 - 240V]
+    VOLTAGE: LinearCalibration((10 / 26500) * 24),
+    # maps [0 - 26500] to [4 - 20 mA] to [0 - 7A]
+    CURRENT: LinearCalibration((16 / 26500) * .4375),
+    # maps [0 - 32767] to [0 - 4.096V] to mA through the current sensor
+    BATTERY: LinearCalibration(ADC_MV_PER_COUNT[GAIN] / BATTERY_MV_PER_MA),
+})
+
+# full scale raw reading used by the audio mappings
+AUDIO_FULL_SCALE = 27000
+
+'''
+    System Clock
+        The clock samples are stamped with, monotonic() orders them and
+        time() places them on the wall clock
+        Stands in for SimClock on the Pi
+'''
+class SystemClock:
+    # simulated seconds per real second
+    speed = 1.0
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def time(self):
+        return time.time()
+
+'''
+    Simulated Clock
+        Runs from start at speed times real time, so a replayed day passes
+        in minutes, advance() moves it by hand
+        With a speed of 0 it only moves when advanced, for stepped load tests
+            Inputs:
+                start - time.time() the simulation begins at
+                speed - simulated seconds per real second
+'''
+class SimClock:
+    def __init__(self, start, speed):
+        self.start = start
+        self.speed = speed
+        self.realStart = time.monotonic()
+        self.advanced = 0.0
+
+    def monotonic(self):
+        return (time.monotonic() - self.realStart) * self.speed + self.advanced
+
+    def time(self):
+        return self.start + self.monotonic()
+
+    def advance(self, seconds):
+        self.advanced += seconds
+
+'''
+    Wakeup Class
+        A threading.Event asyncio tasks can wait on too, so a service is
+        woken the same way whichever runtime runs it
+        set() and clear() are safe to call from any thread
+'''
+class Wakeup:
+    def __init__(self):
+        self.event = threading.Event()
+        # (loop, asyncio.Event) of each task waiting
+        self.waiters = []
+
+    def set(self):
+        self.event.set()
+        for loop, waiter in list(self.waiters):
+            loop.call_soon_threadsafe(waiter.set)
+
+    def clear(self):
+        self.event.clear()
+
+    def is_set(self):
+        return self.event.is_set()
+
+    def wait(self, timeout = None):
+        return self.event.wait(timeout)
+
+    # wait() for asyncio tasks, True unless timeout ran out first
+    async def waitAsync(self, timeout = None):
+        if self.event.is_set():
+            return True
+        waiter = (asyncio.get_event_loop(), asyncio.Event())
+        self.waiters.append(waiter)
+        try:
+            # set() may have run before the waiter was added
+            if not self.event.is_set():
+                await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.waiters.remove(waiter)
+        return self.event.is_set()
+
+'''
+    ADC Sampler Class
+        Single owner of the ADC, scans every channel on a fixed schedule
+        and publishes the results to the rest of the app
+            Inputs:
+                adc - ADS1115 to read from
+                interval - interval of time between scans
+                clock - SystemClock or SimClock the samples are stamped with
+'''
+class ADCSampler(threading.Thread):
+    def __init__(self, adc, interval, clock):
+        threading.Thread.__init__(self)
+        self.adc = adc
+        self.interval = interval
+        self.clock = clock
+        # most recent sample, replaced (never modified) on every scan
+        self.latest = None
+        self.subscribers = ()
+        # set to apply a new interval right away
+        self.wake = Wakeup()
+
+    # callback(sample) is run on the sampler thread after every scan
+    def subscribe(self, callback):
+        self.subscribers = self.subscribers + (callback,)
+
+    def unsubscribe(self, callback):
+        self.subscribers = tuple(cb for cb in self.subscribers if cb != callback)
+
+    # scans every SAMPLE_INTERVAL while a feed needs live readings,
+    # every IDLE_SAMPLE_INTERVAL otherwise
+    def setActive(self, active):
+        interval = SAMPLE_INTERVAL if active else IDLE_SAMPLE_INTERVAL
+        if interval != self.interval:
+            self.interval = interval
+            self.wake.set()
+
+    def scan(self):
+        t0 = time.monotonic()
+        volIn = self.adc.read_adc(VOLTAGE, gain=GAIN)
+        t1 = time.monotonic()
+        curIn = self.adc.read_adc(CURRENT, gain=GAIN)
+        t2 = time.monotonic()
+        batIn = self.adc.read_adc(BATTERY, gain=GAIN)
+        t3 = time.monotonic()
+        adcReadSeconds.observe(t1 - t0)
+        adcReadSeconds.observe(t2 - t1)
+        adcReadSeconds.observe(t3 - t2)
+        return Sample(self.clock.monotonic(), volIn, curIn, batIn)
+
+    def publish(self, sample):
+        adcScans.inc()
+        self.latest = sample
+        for callback in self.subscribers:
+            callback(sample)
+
+    def run(self):
+        nextScan = time.monotonic()
+        while True:
+            self.publish(self.scan())
+
+            # sleep until the next slot so scans don't drift
+            nextScan += self.interval
+            delay = nextScan - time.monotonic()
+            if delay > 0:
+                if self.wake.wait(delay):
+                    # interval changed, restart the schedule from now
+                    self.wake.clear()
+                    nextScan = time.monotonic()
+            else:
+                # fell behind, skip the missed slots instead of bursting
+                nextScan = time.monotonic()
+
+    # same schedule as run, the I2C reads are made on the runtime's executor
+    async def runAsync(self, runtime):
+        nextScan = time.monotonic()
+        while True:
+            self.publish(await runtime.blocking(self.scan))
+
+            nextScan += self.interval
+            delay = nextScan - time.monotonic()
+            if delay > 0:
+                if await self.wake.waitAsync(delay):
+                    self.wake.clear()
+                    nextScan = time.monotonic()
+            else:
+                nextScan = time.monotonic()
+
+'''
+    Continuous ADC Sampler Class
+        Runs the ADC in continuous conversion and collects each sample from
+        the ALERT/RDY pin instead of waiting on single-shot conversions
+        Channels are scanned round robin, the mux is moved to the next
+        channel as soon as the previous conversion is ready
+            Inputs:
+                adc - ADS1115 to read from
+                gpio - GPIO module the ALERT/RDY pin is attached to
+                alertPin - GPIO pin wired to ALERT/RDY
+                dataRate - conversions per second
+                clock - SystemClock or SimClock the samples are stamped with
+'''
+class ContinuousADCSampler(ADCSampler):
+    def __init__(self, adc, gpio, alertPin, dataRate, clock):
+        # one full scan takes one conversion per channel
+        ADCSampler.__init__(self, adc, 3.0 / dataRate, clock)
+        self.gpio = gpio
+        self.alertPin = alertPin
+        self.dataRate = dataRate
+        self.channels = (VOLTAGE, CURRENT, BATTERY)
+        self.chanIndex = 0
+        self.scanValues = [0] * len(self.channels)
+        self.lastReady = time.monotonic()
+
+    # converts at DATA_RATE while a feed needs live readings,
+    # IDLE_DATA_RATE otherwise, from the next conversion on
+    def setActive(self, active):
+        self.dataRate = DATA_RATE if active else IDLE_DATA_RATE
+        self.interval = 3.0 / self.dataRate
+
+    def startChannel(self, channel):
+        # a high threshold with the MSB set and a low threshold with it clear
+        # turns the comparator output into a conversion ready signal
+        self.adc.start_adc_comparator(channel, 0x8000, 0x0000, gain=GAIN,
+                                      data_rate=self.dataRate, active_low=True,
+                                      traditional=True, latching=False, num_readings=1)
+
+    # ALERT/RDY edge callback, runs on the GPIO callback thread
+    def onReady(self, pin):
+        self.lastReady = time.monotonic()
+        self.scanValues[self.chanIndex] = self.adc.get_last_result()
+        adcReadSeconds.observe(time.monotonic() - self.lastReady)
+
+        # writing the config restarts conversion on the next channel
+        self.chanIndex = (self.chanIndex + 1) % len(self.channels)
+        self.startChannel(self.channels[self.chanIndex])
+
+        if self.chanIndex == 0:
+            volIn, curIn, batIn = self.scanValues
+            self.publish(Sample(self.clock.monotonic(), volIn, curIn, batIn))
+
+    def begin(self):
+        self.gpio.setup(self.alertPin, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
+        self.gpio.add_event_detect(self.alertPin, self.gpio.FALLING, callback=self.onReady)
+        self.startChannel(self.channels[self.chanIndex])
+
+    # watchdog check, True if the ready edges stopped
+    def stalled(self):
+        if time.monotonic() - self.lastReady > 1:
+            log.warning("ADC ready timeout, restarting conversion")
+            return True
+        return False
+
+    def run(self):
+        self.begin()
+
+        # watchdog, restart the current channel if the ready edges stop
+        while True:
+            time.sleep(1)
+            if self.stalled():
+                self.startChannel(self.channels[self.chanIndex])
+
+    async def runAsync(self, runtime):
+        await runtime.blocking(self.begin)
+        try:
+            while True:
+                await asyncio.sleep(1)
+                if self.stalled():
+                    await runtime.blocking(self.startChannel, self.channels[self.chanIndex])
+        finally:
+            await runtime.blocking(self.stop)
+
+    def stop(self):
+        self.gpio.remove_event_detect(self.alertPin)
+        self.adc.stop_adc()
+
+'''
+    Simulated GPIO Class
+        Minimal stand-in for RPi.GPIO, records every output transition and
+        lets edges be triggered by hand
+            Inputs:
+                clock - SystemClock or SimClock the transitions are stamped with
+'''
+class SimulatedGPIO:
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, clock = None):
+        self.clock = clock or SystemClock()
+        self.levels = {}
+        self.callbacks = {}
+        # (clock.time(), pin, level) of every output change
+        self.transitions = []
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, direction, pull_up_down = None, initial = None):
+        if direction == self.IN:
+            self.levels[pin] = self.HIGH if pull_up_down == self.PUD_UP else self.LOW
+        elif initial is not None:
+            self.output(pin, initial)
+
+    def output(self, pin, level):
+        if self.levels.get(pin) != level:
+            self.transitions.append((self.clock.time(), pin, level))
+        self.levels[pin] = level
+
+    def input(self, pin):
+        return self.levels.get(pin, self.LOW)
+
+    def add_event_detect(self, pin, edge, callback = None, bouncetime = None):
+        self.callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    # fires the edge callback registered on pin, if any
+    def edge(self, pin):
+        callback = self.callbacks.get(pin)
+        if callback is not None:
+            callback(pin)
+
+    def cleanup(self):
+        self.callbacks = {}
+
+'''
+    Simulated ADC Class
+        Stand-in for the ADS1115 so the samplers can run off the Pi
+        Single-shot reads block for one conversion like the real chip,
+        continuous mode pulses ALERT/RDY on a SimulatedGPIO at the data rate
+        A stepped clock (speed 0) skips the conversion time
+            Inputs:
+                signals - dict of channel to function(t) returning a raw value,
+                          t is the clock's time()
+                gpio - SimulatedGPIO whose alertPin gets the ready edges
+                alertPin - pin pulsed after every continuous conversion
+                clock - SystemClock or SimClock the signals are read at
+'''
+class SimulatedADC:
+    def __init__(self, signals = None, gpio = None, alertPin = ALERT_PIN, clock = None):
+        if signals is None:
+            # slow swings around mid scale
+            signals = {
+                VOLTAGE: lambda t: 13500 + 8000 * math.sin(t / 30),
+                CURRENT: lambda t: 13500 + 8000 * math.sin(t / 45),
+                BATTERY: lambda t: 1500 + 1000 * math.sin(t / 60),
+            }
+        self.signals = signals
+        self.gpio = gpio
+        self.alertPin = alertPin
+        self.clock = clock or SystemClock()
+        self.channel = None
+        self.dataRate = DATA_RATE
+        self.lastResult = 0
+        # conversions per channel, for the benchmarks
+        self.reads = collections.Counter()
+        self.converting = threading.Event()
+        self.converter = None
+
+    def value(self, channel):
+        self.reads[channel] += 1
+        signal = self.signals.get(channel)
+        if signal is None:
+            return 0
+        return max(-32768, min(32767, int(signal(self.clock.time()))))
+
+    def read_adc(self, channel, gain = 1, data_rate = None):
+        if self.clock.speed:
+            time.sleep(1.0 / (data_rate or DATA_RATE))
+        return self.value(channel)
+
+    def start_adc(self, channel, gain = 1, data_rate = None):
+        self.channel = channel
+        self.dataRate = data_rate or DATA_RATE
+        if self.converter is None:
+            self.converting.set()
+            self.converter = threading.Thread(target=self.convert)
+            self.converter.daemon = True
+            self.converter.start()
+
+    def start_adc_comparator(self, channel, high_threshold, low_threshold, gain = 1,
+                             data_rate = None, active_low = True, traditional = True,
+                             latching = False, num_readings = 1):
+        self.start_adc(channel, gain, data_rate)
+
+    def get_last_result(self):
+        return self.lastResult
+
+    def stop_adc(self):
+        self.converting.clear()
+        self.converter = None
+
+    def convert(self):
+        while self.converting.is_set():
+            time.sleep(1.0 / self.dataRate)
+            self.lastResult = self.value(self.channel)
+            if self.gpio is not None:
+                self.gpio.edge(self.alertPin)
+
+'''
+    Solar Profile Class
+        Raw panel voltage, panel current and battery readings over time,
+        linearly interpolated, for SimulatedADC to replay
+        Times are seconds from start, the profile repeats every period
+            Inputs:
+                times - increasing seconds from start of each point
+                voltage - raw VOLTAGE reading at each point
+                current - raw CURRENT reading at each point
+                battery - raw BATTERY reading at each point
+                start - time.time() of the first point
+                period - seconds before the profile repeats
+'''
+class SolarProfile:
+    def __init__(self, times, voltage, current, battery, start, period):
+        self.times = np.asarray(times, dtype=np.float64)
+        self.columns = (np.asarray(voltage, dtype=np.float64),
+                        np.asarray(current, dtype=np.float64),
+                        np.asarray(battery, dtype=np.float64))
+        self.start = start
+        self.period = period
+
+    # clear day from 6:00 to 20:00 local time with passing clouds
+    @classmethod
+    def synthetic(cls, clouds = 0.3, seed = None):
+        times = np.arange(0, 86400 + 60, 60.0)
+        sun = np.clip(np.sin(math.pi * (times / 3600 - 6) / 14), 0, 1)
+        # smoothed random walk between clear and overcast
+        rng = np.random.RandomState(seed)
+        walk = np.convolve(rng.standard_normal(len(times)), np.ones(30) / 30, mode="same")
+        shade = 1 - clouds * np.clip(0.5 + 2 * walk, 0, 1)
+        light = sun * shade
+        # panel voltage comes up soon after sunrise, current follows the light
+        voltage = 26500 * np.minimum(1, 4 * sun) ** 0.3 * (0.9 + 0.1 * shade)
+        current = 26500 * light
+        battery = 2000 * light
+        now = time.localtime()
+        midnight = time.time() - (now.tm_hour * 3600 + now.tm_min * 60 + now.tm_sec)
+        return cls(times, voltage, current, battery, midnight, 86400)
+
+    # path is a CSV of time.time(), voltage, current, battery rows or a
+    # telemetry directory, the recording is replayed from its first reading
+    @classmethod
+    def load(cls, path):
+        if os.path.isdir(path):
+            store = TelemetryStore(path, TELEMETRY_RATE, TELEMETRY_SEGMENT, TELEMETRY_RETENTION)
+            records = store.query(0, float("inf"))
+            rows = np.column_stack((records['t'], records['voltage'],
+                                    records['current'], records['battery']))
+        else:
+            rows = []
+            with open(path) as f:
+                for line in f:
+                    try:
+                        rows.append([float(field) for field in line.split(",")[:4]])
+                    except ValueError:
+                        # header or comment
+                        continue
+            rows = np.array(rows)
+        if len(rows) < 2:
+            raise ValueError(path + " holds fewer than two readings")
+
+        times = rows[:, 0] - rows[0, 0]
+        # loops with the same spacing as its last two readings
+        period = times[-1] + (times[-1] - times[-2])
+        return cls(times, rows[:, 1], rows[:, 2], rows[:, 3], rows[0, 0], period)
+
+    # raw reading of channel at time.time() t
+    def value(self, channel, t):
+        x = (t - self.start) % self.period
+        return float(np.interp(x, self.times, self.columns[channel]))
+
+    # SimulatedADC signals
+    def signals(self):
+        return { channel:(lambda t, channel=channel: self.value(channel, t))
+                 for channel in (VOLTAGE, CURRENT, BATTERY) }
+
+'''
+    Simulated StruckBar Class
+        Stand-in for the chuck module's StruckBar, records every note
+        instead of playing it
+            Inputs:
+                clock - SystemClock or SimClock the notes are stamped with
+'''
+class SimulatedStruckBar:
+    def __init__(self, clock):
+        self.clock = clock
+        self.connected = False
+        self.freq = 0.0
+        self.settings = {}
+        # (clock.time(), frequency, velocity) of every strike
+        self.notes = []
+
+    def connect(self):
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+    def setVolume(self, volume):
+        self.settings['volume'] = volume
+
+    def setStickHardness(self, hardness):
+        self.settings['stickHardness'] = hardness
+
+    def setStrikePosition(self, position):
+        self.settings['strikePosition'] = position
+
+    def preset(self, number):
+        self.settings['preset'] = number
+
+    def setFrequency(self, freq):
+        self.freq = freq
+
+    def strike(self, velocity):
+        self.notes.append((self.clock.time(), self.freq, velocity))
+
+# puts the mode pin in auto mode
+def setupModePin(gpio):
+    gpio.setmode(gpio.BCM)
+    gpio.setup(MODE_PIN, gpio.OUT)
+    gpio.output(MODE_PIN, gpio.LOW)
+
+'''
+    Pi Hardware Class
+        The kiosk's real I/O, RPi.GPIO, the ADS1115 on the I2C bus and
+        ChucK, imported here so nothing else needs them to load
+'''
+class PiHardware:
+    def __init__(self):
+        import RPi.GPIO
+        import Adafruit_ADS1x15
+        import chuck
+        self.gpio = RPi.GPIO
+        # the ADS1115 ALERT/RDY pin is wired to the same header
+        self.alertGPIO = RPi.GPIO
+        self.adc = Adafruit_ADS1x15.ADS1115()
+        self.chuck = chuck
+        self.clock = SystemClock()
+
+    def start(self):
+        setupModePin(self.gpio)
+        self.chuck.init()
+
+    def newInstrument(self):
+        return self.chuck.StruckBar()
+
+'''
+    Simulated Hardware Class
+        Hardware-in-the-loop stand-in for PiHardware, a SimulatedADC
+        replaying a SolarProfile on a SimClock, a SimulatedGPIO recording
+        the mode pin and SimulatedStruckBars recording the notes
+            Inputs:
+                profile - SolarProfile to replay, a synthetic day if None
+                speed - simulated seconds per real second, 0 to step by hand
+'''
+class SimulatedHardware:
+    def __init__(self, profile = None, speed = 1.0):
+        self.profile = profile or SolarProfile.synthetic()
+        self.clock = SimClock(self.profile.start, speed)
+        self.gpio = SimulatedGPIO(self.clock)
+        self.alertGPIO = self.gpio
+        self.adc = SimulatedADC(self.profile.signals(), self.gpio, ALERT_PIN, self.clock)
+        self.instruments = []
+
+    def start(self):
+        setupModePin(self.gpio)
+
+    def newInstrument(self):
+        instrument = SimulatedStruckBar(self.clock)
+        self.instruments.append(instrument)
+        return instrument
+
+    # every note played on every instrument, in time order
+    def notes(self):
+        return sorted(note for instrument in self.instruments for note in instrument.notes)
+
+'''
+    Moving Average Filter
+        Boxcar average over the last length samples, run on sample blocks
+        with the tail of the previous block carried over
+            Inputs:
+                length - number of samples averaged
+'''
+class MovingAverageFilter:
+    def __init__(self, length):
+        self.length = length
+        self.tail = None
+
+    # block is an (n, channels) array, returns the filtered block
+    def process(self, block):
+        if self.tail is None:
+            # start at the first reading instead of ramping up from zero
+            self.tail = np.repeat(block[:1], self.length - 1, axis=0)
+        x = np.concatenate((self.tail, block))
+        sums = np.concatenate((np.zeros((1, x.shape[1])), np.cumsum(x, axis=0)))
+        self.tail = x[len(x) - (self.length - 1):]
+        return (sums[self.length:] - sums[:-self.length]) / self.length
+
+'''
+    Median Filter
+        Sliding median over the last length samples, rejects single
+        sample spikes that an average would smear
+            Inputs:
+                length - number of samples in the window
+'''
+class MedianFilter:
+    def __init__(self, length):
+        self.length = length
+        self.tail = None
+
+    def process(self, block):
+        if self.tail is None:
+            self.tail = np.repeat(block[:1], self.length - 1, axis=0)
+        x = np.concatenate((self.tail, block))
+        windows = np.lib.stride_tricks.sliding_window_view(x, self.length, axis=0)
+        self.tail = x[len(x) - (self.length - 1):]
+        return np.median(windows, axis=-1)
+
+'''
+    IIR Filter
+        First order low pass, y[n] = y[n-1] + alpha * (x[n] - y[n-1])
+        Solved in closed form over chunks of the block so there is no
+        per-sample Python loop
+        The chunks are shorter the smaller decay is, so decay ** -n never
+        grows past e ** RANGE and can't overflow
+            Inputs:
+                alpha - smoothing factor, 0 < alpha <= 1 (1 = no smoothing)
+'''
+class IIRFilter:
+    CHUNK = 64
+    RANGE = 30
+
+    def __init__(self, alpha):
+        if not 0 < alpha <= 1:
+            raise ValueError("IIR alpha must be in (0, 1], not " + repr(alpha))
+        self.alpha = alpha
+        self.state = None
+        # a float alpha below 1 leaves decay >= 2 ** -53, so a chunk of
+        # one sample is always safe
+        self.chunk = self.CHUNK
+        if alpha < 1:
+            self.chunk = max(1, min(self.CHUNK, int(self.RANGE / -math.log(1 - alpha))))
+
+    def process(self, block):
+        if self.state is None:
+            self.state = block[0].astype(np.float64)
+        if self.alpha >= 1:
+            self.state = block[-1].astype(np.float64)
+            return block.astype(np.float64)
+
+        decay = 1 - self.alpha
+        out = np.empty(block.shape)
+        for start in range(0, len(block), self.chunk):
+            x = block[start:start + self.chunk]
+            powers = (decay ** np.arange(1, len(x) + 1))[:, None]
+            # y[i] = decay^(i+1) * y0 + alpha * sum(decay^(i-k) * x[k])
+            y = powers * (self.state + self.alpha * np.cumsum(x / powers, axis=0))
+            out[start:start + len(x)] = y
+            self.state = y[-1]
+        return out
+
+# stream filters by name, each built from its window length in samples
+FILTERS = { "average":MovingAverageFilter, "median":MedianFilter,
+            # the same mean sample age as an average of length
+            "iir":lambda length: IIRFilter(2.0 / (length + 1)) }
+
+'''
+    Filtered Stream Class
+        Filters and decimates the sampler's scans, publishing one filtered
+        sample per output period
+        Scans are collected into a block and filtered together, so the cost
+        is one batched filter call per output sample
+        Output is paced by the scan timestamps, so it keeps its rate when
+        the sampler changes speed
+            Inputs:
+                sampler - ADCSampler to subscribe to
+                rate - output samples per second
+                filter - MovingAverageFilter, MedianFilter or IIRFilter
+'''
+class FilteredStream:
+    def __init__(self, sampler, rate, filter):
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.filter = filter
+        # sized for the sampler's fastest rate
+        self.block = np.zeros((max(1, int(math.ceil(self.period / sampler.interval))), len(Sample._fields)))
+        self.fill = 0
+        # scans are on a fixed grid, allow for rounding of their timestamps
+        self.slack = sampler.interval / 2
+        self.nextOut = None
+        self.latest = None
+        self.subscribers = ()
+        sampler.subscribe(self.push)
+
+    def subscribe(self, callback):
+        self.subscribers = self.subscribers + (callback,)
+
+    def unsubscribe(self, callback):
+        self.subscribers = tuple(cb for cb in self.subscribers if cb != callback)
+
+    # sampler callback
+    def push(self, sample):
+        self.block[self.fill] = sample
+        self.fill += 1
+        if self.nextOut is None:
+            self.nextOut = sample.t + self.period
+        if sample.t < self.nextOut - self.slack and self.fill < len(self.block):
+            return
+
+        filtered = self.filter.process(self.block[:self.fill, 1:])
+        volVal, curVal, batVal = filtered[-1].tolist()
+        out = Sample(sample.t, volVal, curVal, batVal)
+        self.fill = 0
+        self.nextOut += self.period
+        if self.nextOut < sample.t:
+            self.nextOut = sample.t + self.period
+
+        self.latest = out
+        for callback in self.subscribers:
+            callback(out)
+
+'''
+    Telemetry Segment Class
+        One memory-mapped file of fixed-width telemetry records covering
+        [start, start + period) seconds of wall clock time
+        Layout is a small header, a per-minute index of the first record in
+        each minute, then the records, all preallocated when created
+        Each record carries a CRC and the header count is only advanced after
+        the record is written, so reopening after a power cut drops at most
+        the records that never fully reached the card
+            Inputs:
+                path - segment file
+                start - time.time() the segment begins
+                period - seconds the segment covers
+                capacity - number of records the file holds
+'''
+class TelemetrySegment:
+    MAGIC = b"SPCTLM1\0"
+    # magic, record size, capacity, count, start, period
+    HEADER = struct.Struct("<8sIIQdd")
+    HEADER_SIZE = 64
+    # time.time(), raw voltage, raw current, raw battery, CRC of the rest
+    RECORD = struct.Struct("<dfffI")
+    DTYPE = np.dtype([('t', '<f8'), ('voltage', '<f4'), ('current', '<f4'),
+                      ('battery', '<f4'), ('crc', '<u4')])
+
+    def __init__(self, path, start = None, period = None, capacity = None):
+        self.path = path
+        if not os.path.exists(path):
+            self.create(start, period, capacity)
+
+        self.file = open(path, "r+b")
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        magic, recordSize, self.capacity, count, self.start, self.period = self.HEADER.unpack_from(self.mm, 0)
+        if magic != self.MAGIC or recordSize != self.RECORD.size:
+            raise ValueError(path + " is not a telemetry segment")
+
+        self.slots = int(math.ceil(self.period / 60))
+        self.index = np.ndarray(self.slots, dtype='<u4', buffer=self.mm, offset=self.HEADER_SIZE)
+        self.dataOffset = self.HEADER_SIZE + self.slots * 4
+        self.records = np.ndarray(self.capacity, dtype=self.DTYPE, buffer=self.mm, offset=self.dataOffset)
+        self.count = self.recover(count)
+
+    def create(self, start, period, capacity):
+        slots = int(math.ceil(period / 60))
+        size = self.HEADER_SIZE + slots * 4 + capacity * self.RECORD.size
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, "wb") as f:
+            # sparse, blocks are only allocated as records are written
+            f.truncate(size)
+            f.write(self.HEADER.pack(self.MAGIC, self.RECORD.size, capacity, 0, start, period))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, self.path)
+
+    def valid(self, n):
+        data = self.mm[self.dataOffset + n * self.RECORD.size:self.dataOffset + (n + 1) * self.RECORD.size]
+        return data[:-4] != bytes(self.RECORD.size - 4) and zlib.crc32(data[:-4]) == self.RECORD.unpack(data)[4]
+
+    # finds the last good record, the header count may lag or lead the records
+    def recover(self, count):
+        count = min(count, self.capacity)
+        while count > 0 and not self.valid(count - 1):
+            count -= 1
+        while count < self.capacity and self.valid(count) and \
+                (count == 0 or self.records[count]['t'] >= self.records[count - 1]['t']):
+            count += 1
+        return count
+
+    def full(self):
+        return self.count >= self.capacity
+
+    # time of the newest record, -inf while empty
+    def last(self):
+        return self.records[self.count - 1]['t'] if self.count else -math.inf
+
+    def append(self, t, voltage, current, battery):
+        n = self.count
+        data = self.RECORD.pack(t, voltage, current, battery, 0)[:-4]
+        self.mm[self.dataOffset + n * self.RECORD.size:self.dataOffset + (n + 1) * self.RECORD.size] = \
+            data + struct.pack("<I", zlib.crc32(data))
+
+        slot = int((t - self.start) // 60)
+        if 0 <= slot < self.slots and self.index[slot] == 0:
+            # stored + 1 so 0 means an empty minute
+            self.index[slot] = n + 1
+
+        self.count = n + 1
+        struct.pack_into("<Q", self.mm, 16, self.count)
+
+    # copy of the records with t0 <= t < t1
+    def query(self, t0, t1):
+        count = self.count
+        times = self.records['t'][:count]
+        # the minute index narrows the search to the records of one minute
+        slot = max(0, int((t0 - self.start) // 60))
+        lo = 0
+        if slot < self.slots:
+            filled = np.flatnonzero(self.index[slot:])
+            lo = int(self.index[slot + filled[0]]) - 1 if len(filled) else count
+        elif count:
+            lo = count
+        first = lo + int(np.searchsorted(times[lo:], t0))
+        last = first + int(np.searchsorted(times[first:], t1))
+        return self.records[first:last].copy()
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        self.flush()
+        # drop the numpy views before unmapping
+        self.index = None
+        self.records = None
+        self.mm.close()
+        self.file.close()
+
+'''
+    Telemetry Store Class
+        Daily (TELEMETRY_SEGMENT) segment files of raw panel and battery
+        readings, with rollover and retention
+        Each file is kept in time order, when the clock steps back or a file
+        fills the readings go on in the next part for the same day
+            Inputs:
+                directory - folder holding the segment files
+                rate - readings per second, sizes each segment
+                period - seconds covered by each segment
+                retention - days segment files are kept
+'''
+class TelemetryStore:
+    def __init__(self, directory, rate, period, retention):
+        self.directory = directory
+        self.rate = rate
+        self.period = period
+        self.retention = retention
+        self.segment = None
+        os.makedirs(directory, exist_ok=True)
+
+    # the first part of a day is <start>.tlm, later ones <start>.<part>.tlm
+    def segmentPath(self, start, part = 0):
+        name = time.strftime("%Y%m%d-%H%M%S", time.gmtime(start))
+        if part:
+            name += "." + str(part)
+        return os.path.join(self.directory, name + ".tlm")
+
+    # sorted (start, part) of every segment file
+    def segmentStarts(self):
+        starts = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".tlm"):
+                stamp, _, part = name[:-4].partition(".")
+                starts.append((calendar.timegm(time.strptime(stamp, "%Y%m%d-%H%M%S")), int(part or 0)))
+        return sorted(starts)
+
+    def rollover(self, t):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+        start = t - (t % self.period)
+        # twice the nominal rate leaves room for a fast sampler
+        capacity = int(self.period * self.rate * 2)
+        part = 0
+        while True:
+            segment = TelemetrySegment(self.segmentPath(start, part), start, self.period, capacity)
+            if not segment.full() and t >= segment.last():
+                break
+            segment.close()
+            part += 1
+        self.segment = segment
+        self.expire(t)
+
+    def expire(self, t):
+        for start, part in self.segmentStarts():
+            if start + self.period < t - self.retention * 86400:
+                os.remove(self.segmentPath(start, part))
+
+    def append(self, t, voltage, current, battery):
+        if self.segment is None or t >= self.segment.start + self.segment.period or \
+                t < self.segment.start or self.segment.full() or t < self.segment.last():
+            self.rollover(t)
+        self.segment.append(t, voltage, current, battery)
+
+    # records with t0 <= t < t1 from every segment they span, in time order
+    def query(self, t0, t1):
+        blocks = []
+        for start, part in self.segmentStarts():
+            if start + self.period <= t0 or start >= t1:
+                continue
+            path = self.segmentPath(start, part)
+            if self.segment is not None and path == self.segment.path:
+                blocks.append(self.segment.query(t0, t1))
+            else:
+                segment = TelemetrySegment(path)
+                blocks.append(segment.query(t0, t1))
+                segment.close()
+        if not blocks:
+            return np.zeros(0, dtype=TelemetrySegment.DTYPE)
+        records = np.concatenate(blocks)
+        # parts of one day overlap after the clock steps back
+        if len(blocks) > 1:
+            records = records[np.argsort(records['t'], kind="stable")]
+        return records
+
+    def flush(self):
+        if self.segment is not None:
+            self.segment.flush()
+
+'''
+    Telemetry Recorder Class
+        Writes the filtered panel and battery readings to a TelemetryStore,
+        the stream callback only queues so the sampler never waits on the card
+        Other writes to the card can be queued with defer
+            Inputs:
+                stream - FilteredStream to record
+                store - TelemetryStore to write to
+                clock - clock the samples are stamped with
+'''
+class TelemetryRecorder(threading.Thread):
+    def __init__(self, stream, store, clock):
+        threading.Thread.__init__(self)
+        self.store = store
+        self.clock = clock
+        self.queue = queue.Queue()
+        stream.subscribe(self.queue.put)
+
+    # fn() is run in turn with the readings, safe to call from any thread
+    def defer(self, fn):
+        self.queue.put(fn)
+
+    def record(self, sample):
+        # samples are timestamped with the monotonic clock
+        t = sample.t + (self.clock.time() - self.clock.monotonic())
+        self.store.append(t, sample.voltage, sample.current, sample.battery)
+        self.queue.task_done()
+
+    def run(self):
+        lastFlush = time.monotonic()
+        while True:
+            try:
+                item = self.queue.get(timeout=TELEMETRY_FLUSH)
+            except queue.Empty:
+                item = None
+
+            if callable(item):
+                item()
+                self.queue.task_done()
+            elif item is not None:
+                self.record(item)
+
+            if time.monotonic() - lastFlush >= TELEMETRY_FLUSH:
+                self.store.flush()
+                lastFlush = time.monotonic()
+
+    # records what was queued every second, the flushes go to the executor
+    async def runAsync(self, runtime):
+        lastFlush = time.monotonic()
+        try:
+            while True:
+                await asyncio.sleep(1)
+                while not self.queue.empty():
+                    item = self.queue.get_nowait()
+                    if callable(item):
+                        await runtime.blocking(item)
+                        self.queue.task_done()
+                    else:
+                        self.record(item)
+                if time.monotonic() - lastFlush >= TELEMETRY_FLUSH:
+                    await runtime.blocking(self.store.flush)
+                    lastFlush = time.monotonic()
+        finally:
+            while not self.queue.empty():
+                item = self.queue.get_nowait()
+                if callable(item):
+                    item()
+                    self.queue.task_done()
+                else:
+                    self.record(item)
+            self.store.flush()
+
+'''
+    Coulomb Counter Class
+        Integrates battery current into charge with the trapezoid rule on
+        the sample timestamps, O(1) per sample at any sample rate
+        Charging starts above CHARGE_ON and only ends below CHARGE_OFF, so
+        noise around one threshold can't throw the count away
+        The running totals are saved to disk and picked up after a restart,
+        the writes are handed to defer so the sampler never waits on the card
+            Inputs:
+                stream - ADCSampler or FilteredStream to integrate
+                statePath - JSON file holding the running totals
+                defer - defer(fn) runs fn() off the sampler, such as
+                        TelemetryRecorder.defer, inline if None
+'''
+class CoulombCounter:
+    def __init__(self, stream, statePath, defer = None):
+        self.statePath = statePath
+        self.defer = defer or (lambda fn: fn())
+        # the last save on exit can run while the recorder is saving
+        self.saveLock = threading.Lock()
+        self.charging = False
+        # charge and time of the current (or last) charge
+        self.sessionmAh = 0.0
+        self.sessionSeconds = 0.0
+        # all charge ever counted
+        self.totalmAh = 0.0
+        self.load()
+
+        self.lastT = None
+        self.lastmA = None
+        self.lastSave = time.monotonic()
+        # (charging, sessionmAh, sessionSeconds, totalmAh), replaced on every sample
+        self.snapshot = (self.charging, self.sessionmAh, self.sessionSeconds, self.totalmAh)
+        stream.subscribe(self.push)
+
+    def load(self):
+        try:
+            with open(self.statePath) as f:
+                state = json.load(f)
+            self.charging = bool(state['charging'])
+            self.sessionmAh = float(state['sessionmAh'])
+            self.sessionSeconds = float(state['sessionSeconds'])
+            self.totalmAh = float(state['totalmAh'])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def state(self):
+        return { 'charging':self.charging, 'sessionmAh':self.sessionmAh,
+                 'sessionSeconds':self.sessionSeconds, 'totalmAh':self.totalmAh }
+
+    # state is taken now if not given
+    def save(self, state = None):
+        if state is None:
+            state = self.state()
+        tmpPath = self.statePath + ".tmp"
+        try:
+            with self.saveLock:
+                with open(tmpPath, "w") as f:
+                    json.dump(state, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmpPath, self.statePath)
+        except OSError as e:
+            log.warning("Saving charge failed: %r", e)
+
+    def push(self, sample):
+        # map input value to mA
+        mA = float(calibration.convert(BATTERY, sample.battery))
+
+        # integrate the interval since the last sample if it was charging
+        if self.charging and self.lastT is not None:
+            dt = sample.t - self.lastT
+            # skip gaps where the sampler wasn't running
+            if 0 < dt <= CHARGE_MAX_GAP:
+                mAh = (self.lastmA + mA) / 2 * dt / 3600
+                self.sessionmAh += mAh
+                self.totalmAh += mAh
+                self.sessionSeconds += dt
+
+        # hysteresis on the charging threshold
+        changed = False
+        if not self.charging and sample.battery > CHARGE_ON:
+            self.charging = True
+            self.sessionmAh = 0.0
+            self.sessionSeconds = 0.0
+            changed = True
+        elif self.charging and sample.battery < CHARGE_OFF:
+            self.charging = False
+            changed = True
+
+        self.lastT = sample.t
+        self.lastmA = mA
+        self.snapshot = (self.charging, self.sessionmAh, self.sessionSeconds, self.totalmAh)
+
+        if changed or time.monotonic() - self.lastSave >= CHARGE_SAVE:
+            self.lastSave = time.monotonic()
+            # the totals as of this sample, written whenever defer gets to it
+            state = self.state()
+            self.defer(lambda: self.save(state))
+
+'''
+    Rollup Level Class
+        Ring of fixed width time buckets holding the min, max, sum and count
+        of every metric, updated in place as samples arrive
+            Inputs:
+                width - seconds per bucket
+                size - number of buckets kept
+                metrics - number of values per sample
+'''
+class RollupLevel:
+    def __init__(self, width, size, metrics):
+        self.width = width
+        self.size = size
+        # bucket number held in each slot, -1 when empty
+        self.buckets = np.full(size, -1, dtype=np.int64)
+        self.mins = np.zeros((size, metrics))
+        self.maxs = np.zeros((size, metrics))
+        self.sums = np.zeros((size, metrics))
+        self.counts = np.zeros(size)
+
+    def add(self, t, values):
+        bucket = int(t // self.width)
+        slot = bucket % self.size
+        if self.buckets[slot] != bucket:
+            # slot still holds an old bucket, start over
+            self.buckets[slot] = bucket
+            self.mins[slot] = values
+            self.maxs[slot] = values
+            self.sums[slot] = values
+            self.counts[slot] = 1
+        else:
+            np.minimum(self.mins[slot], values, out=self.mins[slot])
+            np.maximum(self.maxs[slot], values, out=self.maxs[slot])
+            self.sums[slot] += values
+            self.counts[slot] += 1
+
+    # (bucket numbers, mins, maxs, sums, counts) of a block of samples in
+    # time order, reduced in one pass, for merge
+    def reduce(self, t, values):
+        buckets = (t // self.width).astype(np.int64)
+        # only the newest size buckets fit in the ring
+        keep = buckets > buckets[-1] - self.size
+        buckets, values = buckets[keep], values[keep]
+        starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        return (buckets[starts],
+                np.minimum.reduceat(values, starts, axis=0),
+                np.maximum.reduceat(values, starts, axis=0),
+                np.add.reduceat(values, starts, axis=0),
+                np.diff(np.r_[starts, len(buckets)]))
+
+    # adds buckets from reduce, combined with the ones add already started
+    # and never replacing a newer bucket in the same slot
+    def merge(self, ids, mins, maxs, sums, counts):
+        slots = ids % self.size
+        held = self.buckets[slots]
+        new = held < ids
+        fill = slots[new]
+        self.buckets[fill] = ids[new]
+        self.mins[fill] = mins[new]
+        self.maxs[fill] = maxs[new]
+        self.sums[fill] = sums[new]
+        self.counts[fill] = counts[new]
+        same = held == ids
+        fill = slots[same]
+        self.mins[fill] = np.minimum(self.mins[fill], mins[same])
+        self.maxs[fill] = np.maximum(self.maxs[fill], maxs[same])
+        self.sums[fill] += sums[same]
+        self.counts[fill] += counts[same]
+
+    # (bucket start times, mins, maxs, means) of the filled buckets in [t0, t1)
+    def read(self, t0, t1):
+        wanted = np.arange(int(t0 // self.width), int(math.ceil(t1 / self.width)))
+        wanted = wanted[len(wanted) - min(len(wanted), self.size):]
+        slots = wanted % self.size
+        filled = self.buckets[slots] == wanted
+        slots = slots[filled]
+        counts = self.counts[slots][:, None]
+        return (wanted[filled] * self.width, self.mins[slots], self.maxs[slots],
+                self.sums[slots] / counts)
+
+'''
+    Rollup Store Class
+        Min/max/mean rollups of the panel power and battery charge at every
+        ROLLUP_LEVELS width, so charts never rescan raw readings
+        Each sample updates one bucket per level, O(1) per sample
+        seed() reduces the readings stored before boot off the sampler, and
+        the next sample merges them in, so the longer charts aren't blank
+        after a restart and the levels are only ever written by the sampler
+            Inputs:
+                stream - FilteredStream to roll up
+                counter - CoulombCounter giving the battery charge
+                levels - (bucket width, buckets kept) per level
+                clock - clock the samples are stamped with
+'''
+class RollupStore:
+    # panel power in Watts, total battery charge in mAh
+    METRICS = ("power", "charge")
+
+    def __init__(self, stream, counter, levels, clock):
+        self.levels = [RollupLevel(width, size, len(self.METRICS)) for width, size in levels]
+        self.counter = counter
+        self.clock = clock
+        # time of the newest sample, on the wall clock
+        self.latest = None
+        # reduced buckets per level from seed, waiting for push to merge them
+        self.pending = None
+        # False until the stored history has been merged in
+        self.seeded = False
+        stream.subscribe(self.push)
+
+    # records are TelemetryStore.query rows in time order, totalmAh the
+    # battery charge counted by then, safe to call from any thread
+    def seed(self, records, totalmAh):
+        if len(records) == 0:
+            self.pending = []
+            return
+        t = records['t']
+        volts, amps, mA = calibration.convertBlock(records)
+        # the charge isn't stored, count it back from the current total by
+        # integrating the battery current while it was above CHARGE_ON
+        dt = np.diff(t, prepend=t[0])
+        counted = (records['battery'] > CHARGE_ON) & (dt > 0) & (dt <= CHARGE_MAX_GAP)
+        mAh = np.where(counted, mA * dt / 3600, 0.0)
+        charge = totalmAh - (mAh.sum() - np.cumsum(mAh))
+        values = np.stack((volts * amps, charge), axis=1)
+        self.pending = [level.reduce(t, values) for level in self.levels]
+
+    def push(self, sample):
+        pending = self.pending
+        if pending is not None:
+            self.pending = None
+            for level, buckets in zip(self.levels, pending):
+                level.merge(*buckets)
+            self.seeded = True
+
+        power = calibration.convert(VOLTAGE, sample.voltage) * calibration.convert(CURRENT, sample.current)
+        values = np.array([power, self.counter.snapshot[3]])
+        # wall clock so buckets line up with minutes and hours
+        t = sample.t + (self.clock.time() - self.clock.monotonic())
+        for level in self.levels:
+            level.add(t, values)
+        self.latest = t
+
+    # coarsest level that still gives CHART_POINTS points over span seconds
+    def levelFor(self, span):
+        best = self.levels[0]
+        for level in self.levels:
+            if span / level.width >= CHART_POINTS / 4 and level.size * level.width >= span:
+                best = level
+        return best
+
+    # chart data for the last span seconds, folded down to at most CHART_POINTS
+    def chart(self, span):
+        level = self.levelFor(span)
+        end = self.clock.time()
+        starts, mins, maxs, means = level.read(end - span, end)
+        fold = int(math.ceil(len(starts) / CHART_POINTS))
+        if fold > 1:
+            cut = len(starts) - len(starts) % fold
+            starts = starts[:cut].reshape(-1, fold)[:, 0]
+            mins = mins[:cut].reshape(-1, fold, mins.shape[1]).min(axis=1)
+            maxs = maxs[:cut].reshape(-1, fold, maxs.shape[1]).max(axis=1)
+            means = means[:cut].reshape(-1, fold, means.shape[1]).mean(axis=1)
+        return level, end, starts, mins, maxs, means
+
+'''
+    Kiosk Snapshot
+        One immutable version of the state the threads share
+            Fields:
+                version - bumped on every change
+                pitch - PitchSelection being played
+                mode - "auto" or "user"
+                deadline - monotonic time user mode times out, None in auto mode
+'''
+KioskSnapshot = collections.namedtuple("KioskSnapshot", ["version", "pitch", "mode", "deadline"])
+
+'''
+    Kiosk State Class
+        Holds the current KioskSnapshot, readers just take snapshot and
+        never lock, writers serialize on a lock and swap in a new snapshot
+        Listeners run on the writer's thread, in version order, with the
+        new and previous snapshots, so they must be quick and not write
+        Threads that need to react sleep in waitFor instead of polling
+            Inputs:
+                pitch - initial PitchSelection
+'''
+class KioskState:
+    def __init__(self, pitch):
+        self.snapshot = KioskSnapshot(0, pitch, "auto", None)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.listeners = []
+        # (loop, asyncio.Event) of each task in waitForAsync
+        self.waiters = []
+
+    # callback(snapshot, previous) after every change
+    def subscribe(self, callback):
+        self.listeners.append(callback)
+
+    def update(self, **changes):
+        return self.apply(lambda snapshot: changes)
+
+    # fn gets the current snapshot and returns the fields to change, since
+    # writers are serialized it sees every earlier write
+    # returns the new snapshot, or None if nothing changed
+    def apply(self, fn):
+        with self.lock:
+            previous = self.snapshot
+            changes = { k:v for k, v in fn(previous).items() if getattr(previous, k) != v }
+            if not changes:
+                return None
+            snapshot = previous._replace(version = previous.version + 1, **changes)
+            self.snapshot = snapshot
+            for callback in self.listeners:
+                callback(snapshot, previous)
+            self.changed.notify_all()
+            for loop, waiter in self.waiters:
+                loop.call_soon_threadsafe(waiter.set)
+        return snapshot
+
+    # blocks until the version is past version, returns the latest
+    # snapshot, which is still the old one if timeout runs out
+    def waitFor(self, version, timeout = None):
+        snapshot = self.snapshot
+        if snapshot.version > version:
+            return snapshot
+        with self.lock:
+            self.changed.wait_for(lambda: self.snapshot.version > version, timeout)
+            return self.snapshot
+
+    # waitFor for asyncio tasks
+    async def waitForAsync(self, version, timeout = None):
+        waiter = (asyncio.get_event_loop(), asyncio.Event())
+        with self.lock:
+            if self.snapshot.version > version:
+                return self.snapshot
+            self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self.lock:
+                self.waiters.remove(waiter)
+        return self.snapshot
+
+# drives MODE_PIN from the kiosk mode, high in user mode
+def followMode(gpio):
+    def listener(snapshot, previous):
+        if snapshot.mode != previous.mode:
+            gpio.output(MODE_PIN, gpio.HIGH if snapshot.mode == "user" else gpio.LOW)
+    return listener
+
+'''
+    UI Update Bus
+        Worker threads post label text here instead of calling Tk, and the
+        Tk main loop drains it on its own thread with after()
+        Posts to the same key are coalesced and labels are only
+        reconfigured when their text actually changed
+            Inputs:
+                interval - milliseconds between drains
+'''
+class UIUpdateBus:
+    def __init__(self, interval = 100):
+        self.interval = interval
+        self.queue = queue.Queue()
+        # functions to run on the Tk thread
+        self.calls = queue.Queue()
+        # key -> labels showing it
+        self.labels = {}
+        # key -> text currently shown
+        self.values = {}
+        # callbacks given each drain's changed values
+        self.watchers = ()
+        self.root = None
+
+    # safe to call from any thread
+    def post(self, key, text):
+        self.queue.put((key, text, time.monotonic()))
+
+    # runs fn(*args) on the Tk thread at the next drain, safe from any thread
+    def call(self, fn, *args):
+        self.calls.put((fn, args))
+
+    # main thread only, label shows the value of key from now on
+    def bind(self, key, label):
+        self.labels.setdefault(key, []).append(label)
+        if key in self.values:
+            label.config(text=self.values[key])
+
+    # callback({key: text}) runs on the draining thread after every drain
+    # that changed a value
+    def watch(self, callback):
+        self.watchers = self.watchers + (callback,)
+
+    # root is the Tk root, or anything else with Tk's after()
+    def start(self, root):
+        self.root = root
+        self.root.after(self.interval, self.drain)
+
+    # a failing call, label or watcher is logged and skipped, the bus
+    # keeps draining either way
+    def drain(self):
+        try:
+            self.apply()
+        finally:
+            self.root.after(self.interval, self.drain)
+
+    def apply(self):
+        while True:
+            try:
+                fn, args = self.calls.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                fn(*args)
+            except Exception:
+                log.exception("UI bus call %r failed", fn)
+
+        # keep only the newest text per key
+        pending = {}
+        posted = []
+        while True:
+            try:
+                key, text, postedAt = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            pending[key] = text
+            posted.append(postedAt)
+
+        changes = {}
+        for key, text in pending.items():
+            if self.values.get(key) == text:
+                continue
+            self.values[key] = text
+            changes[key] = text
+            for label in self.labels.get(key, ()):
+                try:
+                    label.config(text=text)
+                except tk.TclError as e:
+                    log.warning("Updating label %s failed: %r", key, e)
+
+        if changes:
+            for callback in self.watchers:
+                try:
+                    callback(changes)
+                except Exception:
+                    log.exception("UI bus watcher %r failed", callback)
+
+        now = time.monotonic()
+        for postedAt in posted:
+            uiUpdateLag.observe(now - postedAt)
+
+'''
+    Dashboard Server Class
+        Headless or remote view of the kiosk, serves a small page that
+        follows the UI bus over Server-Sent Events
+        The bus is drained once per interval no matter how many browsers
+        watch, and each drain is encoded once and sent to every client
+        Clients that fall WEB_CLIENT_BACKLOG updates behind are dropped
+            Inputs:
+                host - address to listen on
+                port - TCP port to listen on
+                loop - event loop to serve on, its own thread's if None
+'''
+class DashboardServer(threading.Thread):
+    # services a watching browser needs, see setFeeds
+    feeds = ("sampler", "panel", "weather", "battery", "pitch")
+
+    PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><meta name="viewport" content="width=device-width, initial-scale=1">
+<title>Solar Powered Chime</title>
+<style>
+body { font-family: Verdana, sans-serif; background: #e8feff; margin: 2em; }
+h2 { margin-bottom: 0.2em; } div { font-size: 1.3em; margin: 0.2em 0; }
+</style></head>
+<body>
+<h1>Solar Powered Chime</h1>
+<h2>Panel</h2><div id="panel.voltage">-</div><div id="panel.current">-</div>
+<h2>Weather</h2><div id="weather.temp">-</div><div id="weather.cond">-</div>
+<h2>Battery</h2><div id="battery.charging">-</div><div id="battery.power"></div><div id="battery.time"></div>
+<h2>Audio</h2><div id="audio">-</div><div id="pitch">-</div>
+<script>
+new EventSource("/events").onmessage = function (e) {
+    var changes = JSON.parse(e.data);
+    for (var key in changes) {
+        var el = document.getElementById(key);
+        if (el) el.textContent = changes[key];
+    }
+};
+</script>
+</body></html>
+"""
+
+    def __init__(self, host, port, loop = None):
+        threading.Thread.__init__(self)
+        self.host = host
+        self.port = port
+        self.loop = loop or asyncio.new_event_loop()
+        # key -> newest text, sent whole to new clients
+        self.values = {}
+        # one asyncio.Queue of encoded events per client
+        self.clients = set()
+        # called with the client count whenever it changes, on the server thread
+        self.onClients = None
+
+    # Tk style after(), so the UI bus can be drained here without Tk
+    def after(self, ms, fn):
+        self.loop.call_soon_threadsafe(self.loop.call_later, ms / 1000, fn)
+
+    # UI bus watcher, runs on whichever thread drains the bus
+    def watch(self, changes):
+        self.loop.call_soon_threadsafe(self.broadcast, changes)
+
+    def broadcast(self, changes):
+        self.values.update(changes)
+        event = self.encode(changes)
+        for client in list(self.clients):
+            try:
+                client.put_nowait(event)
+            except asyncio.QueueFull:
+                # too slow to keep up, its handler stops after the backlog
+                self.clients.discard(client)
+
+    def encode(self, changes):
+        return ("data: " + json.dumps(changes) + "\n\n").encode("utf-8")
+
+    def clientsChanged(self):
+        if self.onClients is not None:
+            self.onClients(len(self.clients))
+
+    async def events(self, writer):
+        if len(self.clients) >= WEB_MAX_CLIENTS:
+            await writeResponse(writer, "503 Service Unavailable", "text/plain", b"too many viewers\n")
+            return
+        writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/event-stream\r\n"
+                     b"Cache-Control: no-cache\r\n\r\n" + self.encode(self.values))
+        client = asyncio.Queue(WEB_CLIENT_BACKLOG)
+        self.clients.add(client)
+        self.clientsChanged()
+        try:
+            while client in self.clients:
+                try:
+                    event = await asyncio.wait_for(client.get(), WEB_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    # comment line, keeps proxies from closing an idle stream
+                    event = b": keepalive\n\n"
+                writer.write(event)
+                await writer.drain()
+        finally:
+            self.clients.discard(client)
+            self.clientsChanged()
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, query = await readRequest(reader)
+            if method == "GET" and path == "/":
+                await writeResponse(writer, "200 OK", "text/html; charset=utf-8", self.PAGE.encode("utf-8"))
+            elif method == "GET" and path == "/events":
+                await self.events(writer)
+            else:
+                await writeResponse(writer, "404 Not Found", "text/plain", b"not found\n")
+        except (OSError, ValueError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def runAsync(self, runtime):
+        try:
+            server = await asyncio.start_server(self.handle, self.host, self.port)
+        except OSError as e:
+            log.warning("Dashboard server failed to start: %r", e)
+            return
+        log.info("Dashboard at http://%s:%d/", self.host, self.port)
+        try:
+            await self.loop.create_future()
+        finally:
+            server.close()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.runAsync(None))
+
+# decoded images, each file is only decoded once
+images = {}
+
+def loadImage(path):
+    image = images.get(path)
+    if image is None:
+        try:
+            image = tk.PhotoImage(file=path)
+        except tk.TclError as e:
+            # missing off the Pi, a blank image keeps the layout
+            log.warning("Loading image failed: %r", e)
+            image = tk.PhotoImage(width=64, height=64)
+        images[path] = image
+    return image
+
+# set by main when the web dashboard is running
+dashboard = None
+# set by main when the services run as asyncio tasks
+runtime = None
+
+'''
+    Async Runtime Class
+        Runs the services as tasks on one asyncio event loop instead of a
+        thread each, each service's runAsync(runtime) being its task
+        Tk is pumped from the same loop, and the blocking I2C reads go to a
+        single executor thread so the loop never waits on the bus
+        stop() cancels every task and lets their cleanup run, which
+        disconnects the instruments and flushes the telemetry
+'''
+class AsyncRuntime:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.tasks = []
+        self.done = asyncio.Event()
+
+    def spawn(self, service):
+        task = self.loop.create_task(service.runAsync(self))
+        task.add_done_callback(self.finished)
+        self.tasks.append(task)
+
+    def finished(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            log.error("Service task failed", exc_info=task.exception())
+
+    # runs fn(*args) on the executor thread
+    def blocking(self, fn, *args):
+        return self.loop.run_in_executor(self.executor, fn, *args)
+
+    # safe to call from any thread or signal handler
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.done.set)
+
+    async def pumpTk(self, root):
+        while True:
+            root.update()
+            await asyncio.sleep(TK_PUMP_INTERVAL)
+
+    # runs until stop(), or root's window is closed
+    def run(self, root = None):
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+        if root is not None:
+            root.protocol("WM_DELETE_WINDOW", self.stop)
+            self.tasks.append(self.loop.create_task(self.pumpTk(root)))
+        try:
+            self.loop.run_until_complete(self.done.wait())
+        finally:
+            log.info("Shutting down")
+            for task in self.tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*self.tasks, return_exceptions=True))
+            self.executor.shutdown(wait=True)
+            if root is not None:
+                root.destroy()
+            self.loop.close()
+
+# starts service as a runtime task, or on its own thread without a runtime
+def startService(service):
+    if runtime is not None:
+        runtime.spawn(service)
+    else:
+        service.daemon = True
+        service.start()
+
+# the background threads, by the names pages list in their feeds
+def makeServices():
+    audioT = AudioPlayThread(COMPOSERS[composerName](), hardware.clock)
+    audioT.stop()
+    services = {
+        "sampler":sampler,
+        "recorder":recorder,
+        "weather":WeatherUpdateLabel(weatherProvider, os.path.join(dataDir, WEATHER_CACHE)),
+        "panel":PanelUpdateLabel(2),
+        "battery":BatteryUpdateLabel(coulombs),
+        "audio":audioT,
+        "pitch":PitchLabelUpdate(kiosk),
+        "pitchsets":PitchSetWatcher(pitchSets, PITCHSET_POLL),
+    }
+    if fleetTarget is not None:
+        node, host, port = fleetTarget
+        services["fleet"] = TelemetryPublisher(telemetryStream, audioT, kiosk, hardware.clock,
+                                               node, host, port, FLEET_RATE)
+    return services
+
+# runs the services named in wanted at full rate and idles the rest
+def setFeeds(services, wanted):
+    wanted = set(wanted)
+    # audio keeps following the panel on every page
+    audio = services.get("audio")
+    if audio is not None and not audio.stopped():
+        wanted.add("sampler")
+    for name, service in services.items():
+        if hasattr(service, "setActive"):
+            service.setActive(name in wanted)
+
 '''
     Main GUI Class
         Stores frames and starts app in fullscreen
@@ -101,22 +2195,53 @@ class DisplayApp(tk.Tk):
         self.bind("<F11>", self.toggle_fullscreen)
         self.bind("<Escape>", self.end_fullscreen)
 
+        # returns to auto mode after TIMEOUT seconds without a touch
+        self.scheduler = InactivityScheduler(self, kiosk, TIMEOUT)
+        startService(self.scheduler)
+
+        # pages are built the first time they are shown
+        self.container = container
         self.frames = {}
+        self.currentFrame = None
 
-        for F in (AutoPage, LandingPage, AudioPage, BatteryPage):
-            frame = F(container, self)
-            self.frames[F] = frame
-            frame.grid(row = 0, column = 0, sticky = "nsew")
+        # background threads, started after the first frame is drawn
+        self.services = {}
 
         self.show_frame(AutoPage)
 
+        # Tk redraws from idle callbacks queued ahead of this one, so the
+        # attract screen is on screen before any thread starts
+        self.after_idle(self.startServices)
+
+    def startServices(self):
+        self.services = makeServices()
+        for service in self.services.values():
+            startService(service)
+        self.updateFeeds()
+
+    # runs the services the showing page, and any browser watching the
+    # dashboard, need at full rate and idles the rest
+    def updateFeeds(self):
+        wanted = set(type(self.currentFrame).feeds)
+        if dashboard is not None and dashboard.clients:
+            wanted.update(dashboard.feeds)
+        setFeeds(self.services, wanted)
+
     def show_frame(self, cont):
-        self.resetTimer()
         if cont.__name__ != "AutoPage":
-            print("Switching to user mode")
-            GPIO.output(MODE_PIN, GPIO.HIGH)
-        frame = self.frames[cont]
+            self.resetTimer()
+            log.info("Switching to user mode")
+        else:
+            # nothing to time out from in auto mode
+            self.scheduler.disarm()
+        frame = self.frames.get(cont)
+        if frame is None:
+            frame = cont(self.container, self)
+            self.frames[cont] = frame
+            frame.grid(row = 0, column = 0, sticky = "nsew")
+        self.currentFrame = frame
         frame.tkraise()
+        self.updateFeeds()
 
     def toggle_fullscreen(self, event = None):
         self.state = not self.state
@@ -128,13 +2253,9 @@ class DisplayApp(tk.Tk):
         self.attributes("-fullscreen", False)
         return "break"
 
+    # called on every touch in user mode
     def resetTimer(self):
-        # establish global timer variable
-        global timer
-
-        c1.acquire()
-        timer = TIMEOUT
-        c1.release()
+        self.scheduler.reset()
 
 ''''
      Auto Page
@@ -142,6 +2263,8 @@ class DisplayApp(tk.Tk):
 '''
 
 class AutoPage(ttk.Frame):
+    # services this page needs running, see DisplayApp.updateFeeds
+    feeds = ()
 
     def __init__(self, parent, controller):
         gui_style = ttk.Style()
@@ -154,15 +2277,15 @@ class AutoPage(ttk.Frame):
         beginLbl = ttk.Label(self, text="Tap anywhere to begin!", font=MED_FONT, style="My1.TLabel")
         beginLbl.grid(row=2, column=1, pady=(10,40))
 
-        self.fpLogoAttr = tk.PhotoImage(file="/home/pi/SPC/lake metroparks logo.png")
+        self.fpLogoAttr = loadImage("/home/pi/SPC/lake metroparks logo.png")
         fpLogoLbl = ttk.Label(self, image=self.fpLogoAttr, style="My1.TLabel")
         fpLogoLbl.grid(row=3, column=1, padx=40, pady=20)
 
-        self.rwLogoAttr = tk.PhotoImage(file="/home/pi/SPC/Rockwell_Automation_logo.png")
+        self.rwLogoAttr = loadImage("/home/pi/SPC/Rockwell_Automation_logo.png")
         rwLogoLbl = ttk.Label(self, image=self.rwLogoAttr, style="My1.TLabel")
         rwLogoLbl.grid(row=5, column=2, sticky="E", padx=(80, 10), pady=(10, 10))
 
-        self.cwruLogoAttr = tk.PhotoImage(file="/home/pi/SPC/cwru-formal-logo.png")
+        self.cwruLogoAttr = loadImage("/home/pi/SPC/cwru-formal-logo.png")
         cwruLogoLbl = ttk.Label(self, image=self.cwruLogoAttr, style="My1.TLabel")
         cwruLogoLbl.grid(row=5, column=0, sticky="W", padx=10, pady=(10, 10))
 
@@ -176,97 +2299,370 @@ class AutoPage(ttk.Frame):
         fpLogoLbl.bind("<Button-1>", lambda x: controller.show_frame(LandingPage))
         rwLogoLbl.bind("<Button-1>", lambda x: controller.show_frame(LandingPage))
 
-        timerT = TimerThread(controller)
-        timerT.daemon = True
-        timerT.start()
+'''
+    Weather Provider Class
+        Describes where a weather service lives and how to read its reply,
+        subclasses are swapped in to change services
+'''
+class WeatherProvider:
+    # text shown under the weather, and/or an attribution image
+    attribution = ""
+    attrImage = None
+
+    def url(self):
+        raise NotImplementedError
+
+    # returns (temperature in °F, condition text) from the decoded JSON reply
+    def parse(self, data):
+        raise NotImplementedError
+
+'''
+    Yahoo! Weather Provider
+        YQL query for the Kirtland, OH forecast
+        The YQL endpoint has been retired, kept for reference
+            Inputs:
+                woeid - Yahoo! location id
+'''
+class YahooWeatherProvider(WeatherProvider):
+    attrImage = "/home/pi/SPC/yahooAttr.png"
+
+    def __init__(self, woeid):
+        self.woeid = woeid
+
+    def url(self):
+        baseurl = "https://query.yahooapis.com/v1/public/yql?"
+        yql_query = "select item.condition from weather.forecast where woeid=" + str(self.woeid)
+        return baseurl + urllib.parse.urlencode({'q':yql_query}) + "&format=json"
+
+    def parse(self, data):
+        conditions = data['query']['results']['channel']['item']['condition']
+        return conditions['temp'], conditions['text']
+
+'''
+    Open-Meteo Provider
+        Current conditions from open-meteo.com, no API key needed
+            Inputs:
+                latitude - location latitude
+                longitude - location longitude
+'''
+class OpenMeteoProvider(WeatherProvider):
+    attribution = "Weather data by Open-Meteo.com"
+
+    # WMO weather interpretation codes
+    CONDITIONS = { 0:"Clear", 1:"Mostly Clear", 2:"Partly Cloudy", 3:"Cloudy",
+45:"Fog", 48:"Freezing Fog", 51:"Light Drizzle", 53:"Drizzle", 55:"Heavy Drizzle",
+56:"Freezing Drizzle", 57:"Freezing Drizzle", 61:"Light Rain", 63:"Rain",
+65:"Heavy Rain", 66:"Freezing Rain", 67:"Freezing Rain", 71:"Light Snow",
+73:"Snow", 75:"Heavy Snow", 77:"Snow Grains", 80:"Rain Showers",
+81:"Rain Showers", 82:"Heavy Rain Showers", 85:"Snow Showers",
+86:"Heavy Snow Showers", 95:"Thunderstorms", 96:"Thunderstorms and Hail",
+99:"Thunderstorms and Hail" }
+
+    def __init__(self, latitude, longitude):
+        self.latitude = latitude
+        self.longitude = longitude
+
+    def url(self):
+        return "https://api.open-meteo.com/v1/forecast?" + urllib.parse.urlencode({
+            'latitude':self.latitude, 'longitude':self.longitude,
+            'current_weather':'true', 'temperature_unit':'fahrenheit'})
+
+    def parse(self, data):
+        current = data['current_weather']
+        return round(current['temperature']), self.CONDITIONS.get(current['weathercode'], "")
+
+'''
+    Weather Fetcher Class
+        asyncio weather client with a request timeout, exponential backoff
+        on failures and a conditional request once the cached reading is
+        older than the TTL
+        The last good reading is kept on disk so it can be shown at boot
+            Inputs:
+                provider - WeatherProvider to fetch from
+                cachePath - JSON file holding the last known good reading
+                ttl - seconds a reading is used before it is refreshed
+                timeout - seconds before a request is abandoned
+                maxBackoff - longest wait between failed requests
+'''
+class WeatherFetcher:
+    def __init__(self, provider, cachePath, ttl, timeout, maxBackoff):
+        self.provider = provider
+        self.cachePath = cachePath
+        self.ttl = ttl
+        self.timeout = timeout
+        self.maxBackoff = maxBackoff
+        self.cache = None
+        # set to cut a sleep short, made on the fetcher's loop
+        self.wake = None
+
+    def loadCache(self):
+        try:
+            with open(self.cachePath) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # a reading for a different service or location is useless
+        if cache.get('url') != self.provider.url():
+            return None
+        return cache
+
+    def saveCache(self):
+        # write then rename so a power cut never leaves half a file
+        tmpPath = self.cachePath + ".tmp"
+        with open(tmpPath, "w") as f:
+            json.dump(self.cache, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, self.cachePath)
+
+    # plain HTTP/1.0 GET, returns (status, headers, body)
+    async def get(self, url, headers):
+        parts = urllib.parse.urlsplit(url)
+        secure = parts.scheme == "https"
+        port = parts.port or (443 if secure else 80)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        reader, writer = await asyncio.open_connection(parts.hostname, port,
+            ssl=ssl.create_default_context() if secure else None)
+        try:
+            request = ["GET " + path + " HTTP/1.0", "Host: " + parts.hostname,
+                       "Accept: application/json"]
+            for name, value in headers.items():
+                request.append(name + ": " + value)
+            writer.write(("\r\n".join(request) + "\r\n\r\n").encode("latin-1"))
+            await writer.drain()
+            # HTTP/1.0 servers close the connection after the body
+            response = await reader.read()
+        finally:
+            writer.close()
+
+        head, _, body = response.partition(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        # an empty, cut off or non-HTTP reply is a failed request, not a crash
+        statusLine = lines[0].split()
+        if len(statusLine) < 2 or not statusLine[0].startswith("HTTP/") or not statusLine[1].isdigit():
+            raise ValueError("malformed HTTP response " + repr(lines[0][:40]))
+        status = int(statusLine[1])
+        respHeaders = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            respHeaders[name.strip().lower()] = value.strip()
+        return status, respHeaders, body
+
+    # fetches a fresh reading into the cache
+    async def refresh(self):
+        url = self.provider.url()
+        headers = {}
+        if self.cache is not None:
+            # only download the body if it changed
+            if self.cache.get('etag'):
+                headers['If-None-Match'] = self.cache['etag']
+            if self.cache.get('lastModified'):
+                headers['If-Modified-Since'] = self.cache['lastModified']
+
+        status, respHeaders, body = await asyncio.wait_for(self.get(url, headers), self.timeout)
+
+        if status == 304 and self.cache is not None:
+            self.cache['fetched'] = time.time()
+        elif status == 200:
+            temp, text = self.provider.parse(json.loads(body.decode("utf-8")))
+            self.cache = { 'url':url, 'temp':temp, 'text':text, 'fetched':time.time(),
+                           'etag':respHeaders.get('etag'),
+                           'lastModified':respHeaders.get('last-modified') }
+        else:
+            raise ValueError("weather request returned HTTP " + str(status))
+        # the fsync can stall on the SD card, so it waits on the executor
+        # instead of holding up the loop
+        await asyncio.get_event_loop().run_in_executor(None, self.saveCache)
+
+    # sleeps for seconds, or until wake is set
+    async def sleep(self, seconds):
+        try:
+            await asyncio.wait_for(self.wake.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        self.wake.clear()
+
+    # publish(temp, text) is called with every reading, starting with the cached one
+    async def run(self, publish):
+        self.wake = asyncio.Event()
+        self.cache = self.loadCache()
+        if self.cache is not None:
+            publish(self.cache['temp'], self.cache['text'])
+
+        backoff = 5
+        while True:
+            if self.cache is not None:
+                age = time.time() - self.cache['fetched']
+                if 0 <= age < self.ttl:
+                    await self.sleep(self.ttl - age)
+                    # woken early, check the age against the new ttl
+                    continue
+
+            started = time.monotonic()
+            try:
+                await self.refresh()
+            except (OSError, ValueError, KeyError, IndexError, TypeError, asyncio.TimeoutError) as e:
+                weatherFetchSeconds.observe(time.monotonic() - started)
+                weatherFetchFailures.inc()
+                log.warning("Weather fetch failed: %r", e)
+                # exponential backoff with jitter so retries don't line up
+                await asyncio.sleep(backoff * random.uniform(0.5, 1.0))
+                backoff = min(backoff * 2, self.maxBackoff)
+                continue
+
+            weatherFetchSeconds.observe(time.monotonic() - started)
+            backoff = 5
+            publish(self.cache['temp'], self.cache['text'])
 
 '''
     Weather Label Update Class
-        Contains Yahoo! Weather code and updates weather every minute
+        Runs the weather fetcher on its own asyncio event loop
+        Posts to the "weather.cond" and "weather.temp" keys of the UI bus
             Inputs:
-                weatherLbl - weather label to be updated
+                provider - WeatherProvider to fetch from
+                cachePath - JSON file holding the last good reading
 '''
 class WeatherUpdateLabel(threading.Thread):
-    def __init__(self, condLbl, tempLbl):
+    def __init__(self, provider, cachePath):
         threading.Thread.__init__(self)
-        self.condLbl = condLbl
-        self.tempLbl = tempLbl
+        self.fetcher = WeatherFetcher(provider, cachePath, WEATHER_IDLE_TTL,
+                                      WEATHER_TIMEOUT, WEATHER_MAX_BACKOFF)
+        self.loop = None
 
-    def run(self):
+    # refreshes every WEATHER_TTL while the weather is showing,
+    # every WEATHER_IDLE_TTL otherwise
+    def setActive(self, active):
+        self.fetcher.ttl = WEATHER_TTL if active else WEATHER_IDLE_TTL
+        if self.loop is not None and self.fetcher.wake is not None:
+            self.loop.call_soon_threadsafe(self.fetcher.wake.set)
 
-        # Initialize Yahoo! Weather
-        baseurl = "https://query.yahooapis.com/v1/public/yql?"
-        yql_query = "select item.condition from weather.forecast where woeid=2433149"
-        yql_url = baseurl + urllib.parse.urlencode({'q':yql_query}) + "&format=json"
+    def publish(self, temp, text):
+        uiBus.post("weather.temp", str(temp) + "°F")
+        uiBus.post("weather.cond", str(text))
 
-        wait(10)
+    async def runAsync(self, runtime):
+        self.loop = asyncio.get_event_loop()
+        await self.fetcher.run(self.publish)
 
-        while True:
-            # Open URL and grab data
-            result = urllib.request.urlopen(yql_url).read()
-            data = json.loads(result.decode("utf-8"))
-            conditions = data['query']['results']['channel']['item']['condition']
-            self.tempLbl.config(text=str(conditions['temp']) + "°F")
-            self.condLbl.config(text=str(conditions['text']))
-            time.sleep(60)
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self.runAsync(None))
 
 '''
     Panel Label Update Class
         Updates the labels displaying live panel information
+        Posts to the "panel.voltage" and "panel.current" keys of the UI bus
             Inputs:
-                volLbl - voltage label to be updated
-                curLbl - current label to be updated
                 interval - interval of time between updates
 '''
 class PanelUpdateLabel(threading.Thread):
-    def __init__(self, volLbl, curLbl, interval):
+    def __init__(self, interval):
         threading.Thread.__init__(self)
-        self.volLbl = volLbl
-        self.curLbl = curLbl
         self.interval = interval
+        self.active = Wakeup()
 
-    def run(self):
-        while True:
-            volIn = adc.read_adc(VOLTAGE, gain=GAIN)
-            curIn = adc.read_adc(CURRENT, gain=GAIN)
+    # only updates while the labels are showing
+    def setActive(self, active):
+        if active:
+            self.active.set()
+        else:
+            self.active.clear()
 
-            print("Voltage Raw: " + str(volIn) + " | Current Raw: " + str(curIn))
+    def update(self):
+        sample = labelStream.latest
+        if sample is None:
+            return
+        volIn = sample.voltage
+        curIn = sample.current
 
-            # maps [0 - 26500] to [0 - 10V] to [0 - 240V]
-            volVal = ((volIn / 26500) * 10) * 24
-            # maps [0 - 26500] to [4 - 20 mA] to [0 - 7A] 
-            curVal = ((curIn / 26500) * 16) * .4375 
+        log.debug("Voltage Raw: %s | Current Raw: %s", volIn, curIn)
 
-            self.volLbl.config(text=str(round(volVal, 4)) + " Volts")
-            self.curLbl.config(text=str(round(curVal, 4)) + " Amps")
+        volVal = float(calibration.convert(VOLTAGE, volIn))
+        curVal = float(calibration.convert(CURRENT, curIn))
+
+        uiBus.post("panel.voltage", str(round(volVal, 4)) + " Volts")
+        uiBus.post("panel.current", str(round(curVal, 4)) + " Amps")
+
+    def run(self):
+        while True:
+            self.active.wait()
+            self.update()
             time.sleep(self.interval)
 
+    async def runAsync(self, runtime):
+        while True:
+            await self.active.waitAsync()
+            self.update()
+            await asyncio.sleep(self.interval)
+
 ''''
-    Timer Thread
+    Inactivity Scheduler
         Handles the timer between auto and user mode
+        The mode and deadline live in the KioskState, a touch only moves the
+        deadline so bursts of touches don't wake the thread, it sleeps out
+        the deadline it saw and checks again
+            Inputs:
+                controller - DisplayApp to switch back to AutoPage
+                state - KioskState holding the mode and deadline
+                timeout - seconds without a touch before auto mode
 '''
-class TimerThread(threading.Thread):
-    def __init__(self, controller):
+class InactivityScheduler(threading.Thread):
+    def __init__(self, controller, state, timeout):
         threading.Thread.__init__(self)
         self.controller = controller
+        self.state = state
+        self.timeout = timeout
+
+    # enters user mode and pushes the deadline back, safe to call from any thread
+    def reset(self):
+        self.state.update(mode = "user", deadline = time.monotonic() + self.timeout)
+
+    def disarm(self):
+        self.state.update(mode = "auto", deadline = None)
+
+    # back to auto mode unless a touch moved the deadline since it was checked
+    def expire(self, snapshot):
+        if snapshot.deadline is None or snapshot.deadline > time.monotonic():
+            return {}
+        return { 'mode':"auto", 'deadline':None }
 
     def run(self):
-        # Establish global timer variable
-        global timer
+        while True:
+            snapshot = self.state.snapshot
+            if snapshot.deadline is None:
+                # asleep until a touch arms a deadline
+                self.state.waitFor(snapshot.version)
+                continue
+
+            remaining = snapshot.deadline - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+                continue
 
+            self.check()
+
+    async def runAsync(self, runtime):
         while True:
-            c.acquire()
-            if timer == 0:
-                timer = TIMEOUT
-                # set mode to auto mode
-                print("Switching to auto mode")
-                GPIO.output(MODE_PIN, GPIO.LOW)
-                self.controller.show_frame(AutoPage)
-            else:
-                timer -= 1
-                print("timer: " + str(timer))
-            c.release()
-            wait(1)
+            snapshot = self.state.snapshot
+            if snapshot.deadline is None:
+                await self.state.waitForAsync(snapshot.version)
+                continue
+
+            remaining = snapshot.deadline - time.monotonic()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+                continue
+
+            self.check()
+
+    def check(self):
+        if self.state.apply(self.expire) is not None:
+            log.info("Switching to auto mode")
+            uiBus.call(self.controller.show_frame, AutoPage)
 
 
 ''''
@@ -274,6 +2670,7 @@ class TimerThread(threading.Thread):
         Home page once the display enters user mode
 '''
 class LandingPage(ttk.Frame):
+    feeds = ("sampler", "panel", "weather")
 
     def __init__(self, parent, controller):
         # background color
@@ -297,24 +2694,26 @@ class LandingPage(ttk.Frame):
         tempLbl = ttk.Label(self, text="°F", font=LARGE_FONT, style="My.TLabel")
         tempLbl.grid(row=3, column=1, sticky="N", pady=10)
 
-        self.yahooAttr = tk.PhotoImage(file="/home/pi/SPC/yahooAttr.png")
-        attrLbl = ttk.Label(self, image=self.yahooAttr, style="My.TLabel")
+        if weatherProvider.attrImage is not None:
+            self.weatherAttr = loadImage(weatherProvider.attrImage)
+            attrLbl = ttk.Label(self, image=self.weatherAttr, style="My.TLabel")
+        else:
+            attrLbl = ttk.Label(self, text=weatherProvider.attribution, font=SM_FONT, style="My.TLabel")
         attrLbl.grid(row=4, column=1, sticky="N", pady=5)
 
         # update weather values
-        weatherT = WeatherUpdateLabel(condLbl, tempLbl)
-        weatherT.daemon = True
-        weatherT.start()
+        uiBus.bind("weather.cond", condLbl)
+        uiBus.bind("weather.temp", tempLbl)
 
         # next page labels/buttons
         audioLbl = ttk.Label(self, text="Audio Experiments", font=MED_FONT, style="My.TLabel")
-        self.audioIcon = tk.PhotoImage(file="/home/pi/SPC/headphones.png")
+        self.audioIcon = loadImage("/home/pi/SPC/headphones.png")
         audioBtn = ttk.Button(self, image=self.audioIcon, style="My.TButton", command = lambda: controller.show_frame(AudioPage))
         audioLbl.grid(row=5, column=0, sticky="W", padx=(110, 0), pady=(10, 0))
         audioBtn.grid(row=6, column=0, sticky="W", padx=(80, 0), pady=(10, 40))
 
         batteryLbl = ttk.Label(self, text="Battery Diagnostics", font=MED_FONT, style="My.TLabel")
-        self.batteryIcon = tk.PhotoImage(file="/home/pi/SPC/battery.png")
+        self.batteryIcon = loadImage("/home/pi/SPC/battery.png")
         batteryBtn = ttk.Button(self, image=self.batteryIcon, style="My.TButton", command = lambda: controller.show_frame(BatteryPage))
         batteryLbl.grid(row=5, column=2, sticky="E", padx=(0, 105), pady=(10, 0))
         batteryBtn.grid(row=6, column=2, sticky="E", padx=(0, 80), pady=(10, 40))
@@ -333,30 +2732,24 @@ class LandingPage(ttk.Frame):
         volLbl.grid(row=1, column=1, pady=(40, 0))
         curLbl.grid(row=1, column=3, pady=(40, 0))
 
+        historyBtn = ttk.Button(panelFrame, text="Energy History", style="My.TButton", command = lambda: controller.show_frame(HistoryPage))
+        historyBtn.grid(row=2, column=2, pady=(30, 0))
+
         # panel grid weights for centering
         panelFrame.grid_columnconfigure(0, weight=1)
         panelFrame.grid_columnconfigure(2, weight=1)
         panelFrame.grid_columnconfigure(4, weight=1)
 
         # update panel values
-        panelT = PanelUpdateLabel(volLbl, curLbl, 2)
-        panelT.daemon = True
-        panelT.start()
+        uiBus.bind("panel.voltage", volLbl)
+        uiBus.bind("panel.current", curLbl)
 
         # grid weights for centering
         self.grid_columnconfigure(1, weight=1)
         self.grid_rowconfigure(4, weight=1)
 
         # bind click to timer reset
-        self.bind("<Button-1>", lambda x: self.resetTimer())
-
-    def resetTimer(self):
-        # establish global timer variable
-        global timer
-
-        c1.acquire()
-        timer = TIMEOUT
-        c1.release()
+        self.bind("<Button-1>", lambda x: controller.resetTimer())
 
 
 '''
@@ -364,6 +2757,7 @@ class LandingPage(ttk.Frame):
         Page for the audio experiments
 '''
 class AudioPage(ttk.Frame):
+    feeds = ("pitch",)
 
     def __init__(self, parent, controller):
         # background color
@@ -374,6 +2768,7 @@ class AudioPage(ttk.Frame):
 
         # frame
         ttk.Frame.__init__(self, parent, style="My3.TFrame")
+        self.controller = controller
 
         # title
         audioTitle = ttk.Label(self, text = "Audio Experiments", font = TITLE_FONT, style="My3.TLabel")
@@ -381,26 +2776,26 @@ class AudioPage(ttk.Frame):
 
         # play/stop labels and buttons
         playLbl = ttk.Label(self, text="Play Audio", font=MED_FONT, style="My3.TLabel")
-        self.playIcon = tk.PhotoImage(file="/home/pi/SPC/headphones.png")
+        self.playIcon = loadImage("/home/pi/SPC/headphones.png")
         playBtn = ttk.Button(self, image=self.playIcon, style="My3.TButton", command = self.play)
         playLbl.grid(row=1, column=0, pady=(10, 0))
         playBtn.grid(row=2, column=0, pady=(10, 10))
 
         stopLbl = ttk.Label(self, text="Stop Audio", font=MED_FONT, style="My3.TLabel")
-        self.stopIcon = tk.PhotoImage(file="/home/pi/SPC/headphones.png")
+        self.stopIcon = loadImage("/home/pi/SPC/headphones.png")
         stopBtn = ttk.Button(self, image=self.stopIcon, style="My3.TButton", command = self.stop)
         stopLbl.grid(row=1, column=2, pady=(10, 0))
         stopBtn.grid(row=2, column=2, pady=(10, 10))
 
         # next page labels/buttons
         homeLbl = ttk.Label(self, text="Back", font=MED_FONT, style="My3.TLabel")
-        self.homeIcon = tk.PhotoImage(file="/home/pi/SPC/home.png")
+        self.homeIcon = loadImage("/home/pi/SPC/home.png")
         homeBtn = ttk.Button(self, image=self.homeIcon, style="My3.TButton", command = lambda: controller.show_frame(LandingPage))
         homeLbl.grid(row=4, column=0, sticky="W", padx=(160, 20), pady=(10, 0))
         homeBtn.grid(row=5, column=0, sticky="W", padx=(80, 20), pady=(10, 40))
 
         batteryLbl = ttk.Label(self, text="Battery Diagnostics", font=MED_FONT, style="My3.TLabel")
-        self.batteryIcon = tk.PhotoImage(file="/home/pi/SPC/battery.png")
+        self.batteryIcon = loadImage("/home/pi/SPC/battery.png")
         batteryBtn = ttk.Button(self, image=self.batteryIcon, style="My3.TButton", command = lambda: controller.show_frame(BatteryPage))
         batteryLbl.grid(row=4, column=2, sticky="E", padx=(20, 105), pady=(10, 0))
         batteryBtn.grid(row=5, column=2, sticky="E", padx=(20, 80), pady=(10, 40))
@@ -416,7 +2811,7 @@ class AudioPage(ttk.Frame):
         self.pitchDescLbl = ttk.Label(pitchFrame, text="Change Pitch Set", font=MED_FONT, style="My3.TLabel")
         self.pitchBtnL = ttk.Button(pitchFrame, text="<--", style="My3.TButton", command = lambda: self.changePitches(0))
         self.pitchBtnR = ttk.Button(pitchFrame, text="-->", style="My3.TButton", command = lambda: self.changePitches(1))
-        self.pitchLbl = ttk.Label(pitchFrame, text="Blues", font=MED_FONT, style="My3.TLabel")
+        self.pitchLbl = ttk.Label(pitchFrame, text=pitchSets.selection.scale.name, font=MED_FONT, style="My3.TLabel")
         self.pitchDescLbl.grid(row=0, column=2, pady=(0, 5))
         self.pitchBtnL.grid(row=1, column=1)
         self.pitchLbl.grid(row=1, column=2, padx=15)
@@ -426,118 +2821,135 @@ class AudioPage(ttk.Frame):
         pitchFrame.grid_columnconfigure(0, weight=1)
         pitchFrame.grid_columnconfigure(4, weight=1)
 
-        # create audio thread
-        self.playThread = AudioPlayThread()
-        self.playThread.daemon = True
-        self.playThread.stop()
-        self.playThread.start()
-
-        # create pitch label thread
-        self.pitchLblThread = PitchLabelUpdate(self.pitchLbl)
-        self.pitchLblThread.daemon = True
-        self.pitchLblThread.start()
+        # update pitch label
+        uiBus.bind("pitch", self.pitchLbl)
 
         # bind click to timer reset
-        self.bind("<Button-1>", lambda x: self.resetTimer())
+        self.bind("<Button-1>", lambda x: controller.resetTimer())
 
-    def resetTimer(self):
-        # establish global timer variable
-        global timer
-
-        c1.acquire()
-        timer = TIMEOUT
-        c1.release()
-
-    # changes the pitch set
+    # changes the pitch set, lr 0 = previous, 1 = next
     def changePitches(self, lr):
-        self.resetTimer()
-
-        # Establish global pitch set variable
-        global ps
-
-        c.acquire()
+        self.controller.resetTimer()
         if lr == 0:
-            if ps > 0:
-                ps -= 1
-            else:
-                ps = 2
-        if lr == 1:
-            if ps < 2:
-                ps += 1
-            else:
-                ps = 0
-        c.release()
+            pitchSets.step(-1)
+        elif lr == 1:
+            pitchSets.step(1)
 
 
     # plays audio composition
     def play(self):
-        self.resetTimer()
+        self.controller.resetTimer()
 
         # disable change pitches
         self.pitchBtnL.state(["disabled"])
         self.pitchBtnR.state(["disabled"])
         # start audio
-        self.playThread._stop.clear()
+        self.controller.services["audio"].play()
+        self.controller.updateFeeds()
 
     # stops audio composition
     def stop(self):
-        self.resetTimer()
+        self.controller.resetTimer()
 
         # enable change pitches
         self.pitchBtnL.state(["!disabled"])
         self.pitchBtnR.state(["!disabled"])
         # stop audio
-        self.playThread.stop()
+        self.controller.services["audio"].stop()
+        self.controller.updateFeeds()
 
 '''
     Pitch Label Update Class
         Allows for pitch label to be updated
+        Waits on the KioskState for each new version and posts the pitch
+        set's name to the "pitch" key of the UI bus when it changed
             Inputs:
-                pitchLbl - label to be updated
+                state - KioskState holding the pitch selection
 '''
 
 class PitchLabelUpdate(threading.Thread):
-    def __init__(self, pitchLbl):
+    def __init__(self, state):
         threading.Thread.__init__(self)
-        self.pitchLbl = pitchLbl
+        self.state = state
+        self.active = False
+
+    # only updates while the label is showing
+    def setActive(self, active):
+        self.active = active
+        if active:
+            uiBus.post("pitch", self.state.snapshot.pitch.scale.name)
+
+    def changed(self, snapshot, previous):
+        if self.active and snapshot.pitch != previous.pitch:
+            uiBus.post("pitch", snapshot.pitch.scale.name)
 
     def run(self):
-        # Establish global pitch set variable
-        global ps
+        snapshot = self.state.snapshot
+        while True:
+            previous = snapshot
+            snapshot = self.state.waitFor(snapshot.version)
+            self.changed(snapshot, previous)
 
+    async def runAsync(self, runtime):
+        snapshot = self.state.snapshot
         while True:
-            c.acquire()
-            if ps == 0:
-                self.pitchLbl.config(text="Blues")
-            elif ps == 1:
-                self.pitchLbl.config(text="Pentatonic")
-            elif ps == 2:
-                self.pitchLbl.config(text="Wholetone")
-            else:
-                self.pitchLbl.config(text="ERROR")
-            c.release()
-            wait(0.11)
+            previous = snapshot
+            snapshot = await self.state.waitForAsync(snapshot.version)
+            self.changed(snapshot, previous)
 
 '''
-    Audio Play Thread
+    Scale Class
+        A pitch set compiled once into sorted frequency arrays
+        Lookup tables built when the scale is made map every 16-bit ADC
+        value straight to its main note index and its (main, secondary,
+        tertiary) frequencies, so a reading costs one array index
+        Never changed once built, so any thread can use it without a lock
+            Inputs:
+                name - name of the pitch set
+                freqs - increasing frequencies of the notes
 '''
-class AudioPlayThread(threading.Thread):
-    def __init__(self):
-        threading.Thread.__init__(self)
-        self._stop = threading.Event()
-
-    def stop(self):
-        self._stop.set()
-
-    def stopped(self):
-        return self._stop.isSet()
-
-    def run(self):
-        # setup global pitch set variable
-        global ps
-
-        # pitch-to-freq dictionary
-        self.p2f = { 'C2':65.41, 'Cs2/Db2':69.30, 'D2':73.42, 'Ds2/Eb2':77.78, 'E2':82.41,
+class Scale:
+    def __init__(self, name, freqs):
+        self.name = name
+        self.freqs = np.array(freqs, dtype=np.float64)
+        if len(self.freqs) == 0 or not np.all(np.diff(self.freqs) > 0) or self.freqs[0] <= 0:
+            raise ValueError("pitch set " + repr(name) + " needs increasing positive frequencies")
+        self.freqs.flags.writeable = False
+        # plain floats for per-note indexing, and what the scale is made of
+        # for caches that should outlive one reload of the pitch set file
+        self.freqList = tuple(self.freqs.tolist())
+        self.key = (name, self.freqList)
+        # a frequency belongs to the first note whose upper midpoint is above it
+        bounds = (self.freqs[:-1] + self.freqs[1:]) / 2
+
+        # neighbours of each note, mirrored inwards at the ends of the scale
+        last = len(self.freqs) - 1
+        index = np.arange(len(self.freqs))
+        self.secIndex = np.where(index == 0, 1, index - 1).clip(0, last)
+        self.terIndex = np.where(index == 0, 2, np.where(index == last, last - 2, index + 1)).clip(0, last)
+
+        # every raw reading [-32768 - 32767] mapped across the scale's range
+        raw = np.arange(-32768, 32768)
+        freq = self.freqs[0] + (self.freqs[-1] - self.freqs[0]) * (raw / AUDIO_FULL_SCALE)
+        main = np.searchsorted(bounds, freq)
+        self.indexLut = main.astype(np.int16)
+        self.indexLut.flags.writeable = False
+        self.lut = np.stack((self.freqs[main],
+                             self.freqs[self.secIndex[main]],
+                             self.freqs[self.terIndex[main]]), axis=1)
+        self.lut.flags.writeable = False
+
+    # (main, secondary, tertiary) frequencies for a raw reading
+    def lookup(self, val):
+        index = min(65535, max(0, int(val) + 32768))
+        return self.lut[index]
+
+    # index of the main note for a raw reading
+    def lookupIndex(self, val):
+        return int(self.indexLut[min(65535, max(0, int(val) + 32768))])
+
+# pitch-to-freq dictionary
+P2F = { 'C2':65.41, 'Cs2/Db2':69.30, 'D2':73.42, 'Ds2/Eb2':77.78, 'E2':82.41,
 'F2':87.31, 'Fs2/Gb2':92.50, 'G2':98.00, 'Gs2/Ab2':103.83, 'A2':110.00,
 'As2/Bb2':116.54, 'B2':123.47, 'C3':130.81, 'Cs3/Db3':138.59, 'D3':146.83,
 'Ds3/Eb3':155.56, 'E3':164.81, 'F3':174.61, 'Fs3/Gb3':185.00, 'G3':196.00,
@@ -548,120 +2960,446 @@ class AudioPlayThread(threading.Thread):
 'E5':659.25, 'F5':698.46, 'Fs5/Gb5':739.99, 'G5':783.99, 'Gs5/Ab5':830.61,
 'A5':880.00, 'As5/Bb5':932.33, 'B5':987.77, 'C6':1046.50 }
 
-        blues = ['C2', 'Ds2/Eb2', 'F2', 'Fs2/Gb2', 'G2', 'As2/Bb2', 'C3', 'Ds3/Eb3', 'F3', 'Fs3/Gb3', 'G3', 'As3/Bb3', 'C4', 'Ds4/Eb4', 'F4', 'Fs4/Gb4', 'G4', 'As4/Bb4', 'C5']
-        pentatonic = ['C2', 'D2', 'E2', 'G2', 'A2', 'C3', 'D3', 'E3', 'G3', 'A3', 'C4', 'D4', 'E4', 'G4', 'A4', 'C5']
-        wholetone = ['C2', 'D2', 'E2', 'Fs2/Gb2', 'Gs2/Ab2', 'As2/Bb2', 'C3', 'D3', 'E3', 'Fs3/Gb3', 'Gs3/Ab3', 'As3/Bb3', 'C4', 'D4', 'E4', 'Fs4/Gb4', 'Gs4/Ab4', 'As4/Bb4', 'C5']
-
-        # default
-        self.pClass = blues
-
-        # create dictionary of pitch frequencies
-        self.myPitches = self.p2f.fromkeys(self.pClass)
-        for key in self.myPitches:
-            self.myPitches[key] = self.p2f[key]
-        # create lists for order
-        self.pitchList = list(self.myPitches.keys())
-        self.freqList = list(self.myPitches.values())
-
-        # establish and connect instruments
-        s = StruckBar()
-        s.connect()
-        s.setVolume(1.0)         # 0.0 <= volume <= 1.0
-        s.setStickHardness(0.1)  # 0.0 <= hardness <= 1.0
-        s.setStrikePosition(0.1) # 0.0 <= position <= 1.0
-        s.preset(1)              # vibraphone
+# used when the pitch set file can't be loaded
+DEFAULT_SCALES = (
+    Scale("Blues", [P2F[p] for p in ['C2', 'Ds2/Eb2', 'F2', 'Fs2/Gb2', 'G2', 'As2/Bb2', 'C3', 'Ds3/Eb3', 'F3', 'Fs3/Gb3', 'G3', 'As3/Bb3', 'C4', 'Ds4/Eb4', 'F4', 'Fs4/Gb4', 'G4', 'As4/Bb4', 'C5']]),
+    Scale("Pentatonic", [P2F[p] for p in ['C2', 'D2', 'E2', 'G2', 'A2', 'C3', 'D3', 'E3', 'G3', 'A3', 'C4', 'D4', 'E4', 'G4', 'A4', 'C5']]),
+    Scale("Wholetone", [P2F[p] for p in ['C2', 'D2', 'E2', 'Fs2/Gb2', 'Gs2/Ab2', 'As2/Bb2', 'C3', 'D3', 'E3', 'Fs3/Gb3', 'Gs3/Ab3', 'As3/Bb3', 'C4', 'D4', 'E4', 'Fs4/Gb4', 'Gs4/Ab4', 'As4/Bb4', 'C5']]),
+)
+
+# builds a Scale from one entry of the pitch set file, entries give
+#  - "pitches": pitch names from P2F, or
+#  - "freqs": frequencies in Hz, or
+#  - "root": a pitch name or Hz, with one octave of "ratios" (numbers or
+#    "a/b") or "cents" above it, repeated for "octaves" octaves and
+#    closed on the root
+def compileScale(entry):
+    name = str(entry['name'])
+    if 'pitches' in entry:
+        freqs = [P2F[p] for p in entry['pitches']]
+    elif 'freqs' in entry:
+        freqs = [float(f) for f in entry['freqs']]
+    else:
+        root = entry['root']
+        root = P2F[root] if isinstance(root, str) else float(root)
+        if 'ratios' in entry:
+            ratios = [float(fractions.Fraction(str(r))) for r in entry['ratios']]
+        else:
+            ratios = [2 ** (float(cents) / 1200) for cents in entry['cents']]
+        octaves = int(entry.get('octaves', 1))
+        freqs = [root * 2 ** octave * ratio for octave in range(octaves) for ratio in ratios]
+        freqs.append(root * 2 ** octaves)
+    return Scale(name, freqs)
+
+'''
+    Pitch Selection
+        The loaded pitch sets and which one is playing, kept in the
+        KioskState
+            Fields:
+                sets - tuple of Scales
+                index - index of the selected Scale
+'''
+class PitchSelection(collections.namedtuple("PitchSelection", ["sets", "index"])):
+    __slots__ = ()
+
+    @property
+    def scale(self):
+        return self.sets[self.index]
+
+'''
+    Pitch Set Registry Class
+        The pitch sets of the config file, each compiled once into a Scale
+        The selection is the pitch field of a KioskState, so reading it
+        never locks and every change reaches the state's waiters
+            Inputs:
+                path - JSON pitch set file, see compileScale
+                initial - name of the pitch set to start on, the first if None
+                state - KioskState to keep the selection in, a private one if None
+'''
+class PitchSetRegistry:
+    def __init__(self, path, initial = None, state = None):
+        self.path = path
+        self.mtime = None
+        self.state = state if state is not None else KioskState(PitchSelection(DEFAULT_SCALES, 0))
+        self.reload()
+        if initial is not None:
+            self.select(initial)
+
+    @property
+    def selection(self):
+        return self.state.snapshot.pitch
+
+    def names(self):
+        return [scale.name for scale in self.selection.sets]
+
+    def load(self):
+        with open(self.path) as f:
+            config = json.load(f)
+        sets = tuple(compileScale(entry) for entry in config['pitchSets'])
+        if not sets:
+            raise ValueError("no pitch sets in " + self.path)
+        return sets
+
+    # True if the file changed since it was last read
+    def changed(self):
+        try:
+            return os.stat(self.path).st_mtime != self.mtime
+        except OSError:
+            return False
+
+    # keeps the sets it has if the file can't be used
+    def reload(self):
+        try:
+            # a broken file is only retried once it changes again
+            self.mtime = os.stat(self.path).st_mtime
+            sets = self.load()
+        except (OSError, ValueError, KeyError, TypeError, ZeroDivisionError) as e:
+            log.warning("Loading pitch sets from %s failed: %r", self.path, e)
+            return False
+        # stay on the same pitch set if it is still there
+        names = [scale.name for scale in sets]
+        def swap(snapshot):
+            name = snapshot.pitch.scale.name
+            index = names.index(name) if name in names else min(snapshot.pitch.index, len(sets) - 1)
+            return { 'pitch':PitchSelection(sets, index) }
+        self.state.apply(swap)
+        return True
+
+    # moves delta pitch sets along, wrapping around
+    def step(self, delta):
+        def move(snapshot):
+            sets, index = snapshot.pitch
+            return { 'pitch':PitchSelection(sets, (index + delta) % len(sets)) }
+        self.state.apply(move)
+
+    def select(self, name):
+        def choose(snapshot):
+            sets = snapshot.pitch.sets
+            names = [scale.name for scale in sets]
+            if name not in names:
+                raise ValueError("no pitch set named " + repr(name))
+            return { 'pitch':PitchSelection(sets, names.index(name)) }
+        self.state.apply(choose)
+
+'''
+    Pitch Set Watcher Class
+        Hot-reloads the pitch set file whenever it changes on disk
+            Inputs:
+                registry - PitchSetRegistry to reload
+                interval - seconds between checks of the file
+'''
+class PitchSetWatcher(threading.Thread):
+    def __init__(self, registry, interval):
+        threading.Thread.__init__(self)
+        self.registry = registry
+        self.interval = interval
+
+    def check(self):
+        if self.registry.changed() and self.registry.reload():
+            log.info("Reloaded %d pitch sets from %s", len(self.registry.selection.sets), self.registry.path)
 
+    def run(self):
         while True:
-            c.acquire()
-            if ps == 0:
-                self.pClass = blues
-            elif ps == 1:
-                self.pClass = pentatonic
-            elif ps == 2:
-                self.pClass = wholetone
-            else:
-                self.pClass = ['C4']
-            c.release()
-            wait(0.1)
-
-            # recreate dictionary of pitch frequencies
-            self.myPitches = self.p2f.fromkeys(self.pClass)
-            for key in self.myPitches:
-                self.myPitches[key] = self.p2f[key]
-            # create lists for order
-            self.pitchList = list(self.myPitches.keys())
-            self.freqList = list(self.myPitches.values())
-
-            # what will actually be playing
-            while not self.stopped():
-                # read current level
-                curVal = adc.read_adc(CURRENT, gain=GAIN)
-                
-                # set tempo
-                self.beat = self.calcTempo(curVal)
-
-                self.BeatsPerMeasure = 4
-
-                # read voltage level
-                volVal = adc.read_adc(VOLTAGE, gain=GAIN)
-                
-                # calculate subdivisions
-                self.calcSubdivisions(volVal, curVal)
-
-                # use subdivisions to determine length of "measure" iteration
-                self.measureCtr = ((self.BeatsPerMeasure/4) * self.numSubs)
-
-                while self.measureCtr > 0:
-                    # determine notes
-                    mainPitch = self.calcPitch(volVal)
-                    secPitch = None
-                    terPitch = None
-                    mainIndex = self.pitchList.index(mainPitch)
-                    if mainIndex > 0 and mainIndex < (len(self.pitchList) - 1):
-                        secPitch = self.pitchList[mainIndex - 1]
-                        terPitch = self.pitchList[mainIndex + 1]
-                    elif mainIndex == 0:
-                        secPitch = self.pitchList[mainIndex + 1]
-                        terPitch = self.pitchList[mainIndex + 2]
-                    elif mainIndex == (len(self.pitchList) - 1):
-                        secPitch = self.pitchList[mainIndex - 1]
-                        terPitch = self.pitchList[mainIndex - 2]
-
-                    # choose note
-                    rand = random.random()
-                    if rand > 0.0 and rand < 0.15:
-                        s.setFrequency(self.myPitches[secPitch])
-                        print("played sec")
-                    elif rand >= 0.15 and rand <= 0.85:
-                        s.setFrequency(self.myPitches[mainPitch])
-                        print("played main")
-                    else:
-                        s.setFrequency(self.myPitches[terPitch])
-                        print("played ter")
+            time.sleep(self.interval)
+            self.check()
+
+    async def runAsync(self, runtime):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.check()
+
+'''
+    Note Event
+        One scheduled strike
+            Fields:
+                t - clock.monotonic() time the note sounds, see NoteScheduler
+                freq - frequency of the note
+                velocity - strike velocity
+                voice - index of the instrument in VOICES, 0 by default
+'''
+NoteEvent = collections.namedtuple("NoteEvent", ["t", "freq", "velocity", "voice"], defaults=(0,))
+
+# seconds between the NTP epoch (1900) and the Unix epoch (1970)
+NTP_DELTA = 2208988800
+
+'''
+    OSC Encoding
+        Just enough of OSC 1.0 for ChucK: int, float and string arguments,
+        messages and (nested) bundles
+'''
+def oscString(text):
+    data = text.encode("utf-8") + b"\0"
+    return data + b"\0" * (-len(data) % 4)
+
+def oscMessage(address, args):
+    tags = ","
+    payload = b""
+    for arg in args:
+        if isinstance(arg, int):
+            tags += "i"
+            payload += struct.pack(">i", arg)
+        elif isinstance(arg, float):
+            tags += "f"
+            payload += struct.pack(">f", arg)
+        else:
+            tags += "s"
+            payload += oscString(str(arg))
+    return oscString(address) + oscString(tags) + payload
+
+# t is a time.time() time, None means immediately
+def oscTimetag(t):
+    if t is None:
+        return struct.pack(">Q", 1)
+    seconds = int(t) + NTP_DELTA
+    fraction = int((t % 1) * (1 << 32))
+    return struct.pack(">II", seconds, fraction)
+
+# elements are encoded messages or bundles
+def oscBundle(elements, t = None):
+    data = b"#bundle\0" + oscTimetag(t)
+    for element in elements:
+        data += struct.pack(">i", len(element)) + element
+    return data
+
+'''
+    OSC Transport Class
+        One connected UDP socket reused for every packet to the receiver
+            Inputs:
+                host - receiver host
+                port - receiver port
+'''
+class OSCTransport:
+    def __init__(self, host, port):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # connecting once skips the address lookup on every send
+        self.sock.connect((host, port))
+
+    def send(self, packet):
+        self.sock.send(packet)
+
+    def close(self):
+        self.sock.close()
+
+'''
+    Chuck Note Output
+        Plays notes through the chuck module's StruckBar, one call each
+            Inputs:
+                instruments - StruckBar of each voice
+'''
+class ChuckNoteOutput:
+    # notes are handed over when they are due
+    sendAhead = 0
+
+    def __init__(self, instruments):
+        self.instruments = instruments
+
+    def play(self, events):
+        for event in events:
+            instrument = self.instruments[event.voice]
+            instrument.setFrequency(event.freq)
+            instrument.strike(event.velocity)
+
+'''
+    OSC Note Output
+        Sends each note's frequency and strike together in one bundle
+        With timetags every note due within sendAhead goes out in a single
+        packet, each note in its own bundle stamped with its play time
+        Note times are on clock, the timetags are the real wall clock
+        times they come due, so a sped up SimClock sends them sped up too
+            Inputs:
+                transport - OSCTransport to send on
+                timetags - True if the receiver schedules by bundle timetag
+                clock - SystemClock or SimClock the note times are on
+'''
+class OSCNoteOutput:
+    def __init__(self, transport, timetags, clock):
+        self.transport = transport
+        self.timetags = timetags
+        self.clock = clock
+        self.sendAhead = AUDIO_LOOKAHEAD if timetags else 0
+
+    # voice 0 uses the plain addresses, voice n has /n appended
+    def suffix(self, voice):
+        return "/" + str(voice) if voice else ""
+
+    # sends each voice's (preset, volume, hardness, position) settings in
+    # one bundle, before any note is played
+    def setup(self, voices):
+        self.transport.send(oscBundle([oscMessage(OSC_SETUP_ADDRESS + self.suffix(voice),
+                                                  [int(preset), float(volume), float(hardness), float(position)])
+                                       for voice, (preset, volume, hardness, position) in enumerate(voices)]))
+
+    def noteBundle(self, event, t = None):
+        suffix = self.suffix(event.voice)
+        return oscBundle([oscMessage(OSC_FREQ_ADDRESS + suffix, [float(event.freq)]),
+                          oscMessage(OSC_STRIKE_ADDRESS + suffix, [float(event.velocity)])], t)
+
+    def play(self, events):
+        if not self.timetags:
+            for event in events:
+                self.transport.send(self.noteBundle(event))
+            return
+        # clock times to wall clock for the timetags, a stepped clock only
+        # plays notes once it reaches them, so they are due now
+        now = self.clock.monotonic()
+        sent = time.time()
+        speed = self.clock.speed
+        self.transport.send(oscBundle([self.noteBundle(event, sent + (event.t - now) / speed if speed else None)
+                                       for event in events]))
+
+'''
+    Note Scheduler Class
+        Plays queued notes at their absolute times
+        Notes are computed ahead of time by the audio thread, this thread
+        only sleeps until each timestamp and hands the notes to the output,
+        so the time spent choosing notes never delays the beat or lets the
+        tempo drift
+        Note times are on clock, so a SimClock plays them at simulated
+        speed, and a stepped one is played by hand with pump()
+            Inputs:
+                output - ChuckNoteOutput or OSCNoteOutput to play on
+                clock - SystemClock or SimClock the note times are on
+'''
+class NoteScheduler(threading.Thread):
+    def __init__(self, output, clock):
+        threading.Thread.__init__(self)
+        self.output = output
+        self.clock = clock
+        self.cond = threading.Condition()
+        self.events = collections.deque()
+        # time the note after the last queued one should sound, None when idle
+        self.horizon = None
+
+    # queues events in time order, end is when the next note after them is due
+    def schedule(self, events, end):
+        with self.cond:
+            self.events.extend(events)
+            self.horizon = end
+            self.cond.notify()
+
+    # drops every queued note
+    def clear(self):
+        with self.cond:
+            self.events.clear()
+            self.horizon = None
+            self.cond.notify()
+
+    # outputs that schedule themselves get notes sendAhead early
+    def due(self):
+        return self.clock.monotonic() + self.output.sendAhead
+
+    # takes the notes due by due, call holding cond
+    def take(self, due):
+        batch = []
+        while self.events and self.events[0].t <= due:
+            batch.append(self.events.popleft())
+        return batch
+
+    def play(self, batch):
+        self.output.play(batch)
+        now = self.due()
+        for event in batch:
+            noteLateness.observe(max(0, now - event.t))
+        notesPlayed.inc(len(batch))
+
+    # plays every note due by now, for clocks stepped by hand
+    def pump(self):
+        with self.cond:
+            batch = self.take(self.due())
+        if batch:
+            self.play(batch)
+
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.events:
+                    self.cond.wait()
+                    continue
+                due = self.due()
+                delay = self.events[0].t - due
+                if delay > 0:
+                    # woken early if the queue is cleared, a stepped clock
+                    # never gets here
+                    self.cond.wait(delay / self.clock.speed)
+                    continue
+                batch = self.take(due)
+
+            self.play(batch)
+
+# instrument setup of each voice, (preset, volume, stick hardness, strike position)
+VOICES = (
+    (1, 1.0, 0.1, 0.1), # vibraphone, the melody
+    (0, 0.6, 0.5, 0.3), # marimba, the bass
+)
+
+# seconds per beat for a current reading, shared by the composers
+def calcTempo(val):
+    # map incoming current values [0 - AUDIO_FULL_SCALE]
+    # to [1 - 0.3][sec]
+    # or [60 - 200] [BPM]
+    return 1 - ((val/AUDIO_FULL_SCALE) * 0.7)
+
+'''
+    Neighbour Composer
+        The original composition, every note of a measure is the main
+        pitch 70% of the time and one of its neighbours otherwise, with the
+        subdivision picked by power
+        Plays one voice
+'''
+class NeighbourComposer:
+    voices = 1
+
+    # returns (events, time the next measure starts) for the measure at start
+    def compose(self, scale, volVal, curVal, start):
+        self.scale = scale
+
+        # set tempo
+        self.beat = self.calcTempo(curVal)
 
-                    s.strike(0.5)
-                    wait(self.wait)
-                    self.measureCtr -= 1
+        self.BeatsPerMeasure = 4
 
-        # disconnect instruments
-        s.disconnect()
+        # calculate subdivisions
+        self.calcSubdivisions(volVal, curVal)
+
+        # use subdivisions to determine length of "measure" iteration
+        self.measureCtr = ((self.BeatsPerMeasure/4) * self.numSubs)
+
+        # determine notes, the voltage is fixed for the whole measure
+        mainFreq, secFreq, terFreq = self.calcPitch(volVal)
+
+        noteTime = start
+        events = []
+        while self.measureCtr > 0:
+            # choose note
+            freq, played = self.chooseNeighbour(mainFreq, secFreq, terFreq)
+            log.debug("played %s", played)
+
+            events.append(NoteEvent(noteTime, freq, 0.5))
+            noteTime += self.wait
+            self.measureCtr -= 1
+        return events, noteTime
 
     def calcTempo(self, val):
-        # map incoming current values [0 - 27000]
-        # to [1 - 0.3][sec]
-        # or [60 - 200] [BPM]
-        return 1 - ((val/27000) * 0.7)
+        return calcTempo(val)
 
     def calcPitch(self, val):
-        # map incoming voltage values [0 - 27000]
-        # to freq [variable based on myPitches range of freq]
-        self.freq = self.myPitches[self.pClass[0]] + ((self.myPitches[self.pClass[len(self.myPitches) - 1]] - self.myPitches[self.pClass[0]]) * (val/27000))
-        # return pitch in myPitches closest to freq
-        pitch = min(self.myPitches, key=lambda y:abs(float(self.myPitches[y]) - self.freq))
-        return pitch
+        # map incoming voltage values [0 - AUDIO_FULL_SCALE]
+        # to (main, secondary, tertiary) freqs of the closest pitch in the scale
+        return self.scale.lookup(val)
+
+    # main pitch 70% of the time, a neighbour otherwise
+    # returns (freq, "main", "sec" or "ter")
+    def chooseNeighbour(self, mainFreq, secFreq, terFreq):
+        rand = random.random()
+        if rand > 0.0 and rand < 0.15:
+            return secFreq, "sec"
+        elif rand >= 0.15 and rand <= 0.85:
+            return mainFreq, "main"
+        else:
+            return terFreq, "ter"
 
     def calcSubdivisions(self, volVal, curVal):
-        MAX_PWR = 27000 * 27000
+        MAX_PWR = AUDIO_FULL_SCALE * AUDIO_FULL_SCALE
         PWR_DIV = MAX_PWR / 5
         pwrVal = (volVal + 1) * (curVal + 1)
         # map "power" (i.e. the product of voltage and current values) [0 - 25000 * 25000]
@@ -679,11 +3417,255 @@ class AudioPlayThread(threading.Thread):
             self.wait = self.beat
 
         self.numSubs = 4 / (self.wait/self.beat)
+
+'''
+    Phrase Table Class
+        Precomputed phrases of one pitch set in one power band and the
+        Markov chain between them
+        Phrases are scale degree offsets from the measure's main pitch,
+        built by a random walk whose steps widen with power and that
+        drifts back to the main pitch, then each phrase most likely
+        follows one that ended near where it starts
+            Inputs:
+                rng - numpy RandomState to build with
+                notes - notes per measure
+                perOctave - scale degrees per octave
+                spread - typical step, in octaves
+                count - number of phrases
+'''
+class PhraseTable:
+    def __init__(self, rng, notes, perOctave, spread, count):
+        # step sizes up to an octave, weighted towards small ones
+        steps = np.arange(-perOctave, perOctave + 1)
+        weights = np.exp(-np.abs(steps) / max(spread * perOctave, 0.5))
+        stepCdf = np.cumsum(weights) / weights.sum()
+
+        walk = steps[np.searchsorted(stepCdf, rng.random_sample((count, notes)))]
+        walk[:, 0] = steps[np.searchsorted(stepCdf, rng.random_sample(count))] // 2
+        offsets = np.cumsum(walk, axis=1)
+        # pull back halfway to the main pitch from the middle of the measure
+        offsets[:, notes // 2:] //= 2
+        self.phrases = offsets.clip(-perOctave, perOctave)
+
+        # downbeats accented, the rest a little uneven
+        accent = np.where(np.arange(notes) % max(1, notes // 4) == 0, 0.7, 0.45)
+        self.velocities = (accent + rng.uniform(-0.05, 0.05, (count, notes))).clip(0.05, 1.0)
+
+        # phrase i to phrase j by the jump from i's last note to j's first
+        jump = np.abs(self.phrases[:, -1][:, None] - self.phrases[:, 0][None, :])
+        transitions = np.exp(-jump / 2.0)
+        self.cdf = np.cumsum(transitions, axis=1) / transitions.sum(axis=1, keepdims=True)
+
+        # the same as plain lists, so composing a measure is only indexing
+        self.fractions = [i / notes for i in range(notes)]
+        self.phraseLists = self.phrases.tolist()
+        self.velocityLists = self.velocities.tolist()
+        self.cdfLists = self.cdf.tolist()
+
+    # next phrase after phrase, given a uniform random number
+    def next(self, phrase, rand):
+        return min(bisect.bisect_left(self.cdfLists[phrase], rand), len(self.cdfLists) - 1)
+
+'''
+    Markov Composer
+        Composes whole measures from PhraseTables, one per pitch set and
+        power band, built the first time each pitch set plays
+        Each measure is one random draw and some list indexing, its
+        melody follows the panel voltage and its density the panel power
+        A marimba bass doubles the main pitch an octave down
+            Inputs:
+                seed - random seed, None for a different piece every run
+'''
+class MarkovComposer:
+    voices = 2
+    PHRASES = 32
+    # band edges on (voltage + 1) * (current + 1), as in calcSubdivisions
+    BAND_EDGES = tuple(edge * (AUDIO_FULL_SCALE * AUDIO_FULL_SCALE / 5) for edge in range(1, 5))
+    # notes per measure, step spread in octaves and bass beats per band
+    NOTES = (1, 2, 4, 8, 16)
+    SPREAD = (0.05, 0.1, 0.15, 0.2, 0.3)
+    BASS = ((0,), (0,), (0, 2), (0, 2), (0, 1, 2, 3))
+
+    def __init__(self, seed = None):
+        # tables are built with rng, measures drawn with random
+        self.rng = np.random.RandomState(seed)
+        self.random = random.Random(seed).random
+        # Scale.key -> PhraseTable per band, so reloading the pitch set
+        # file reuses the tables of the sets it didn't change
+        self.tables = {}
+        self.phrase = 0
+
+    # returns (scale degrees per octave, PhraseTable per band)
+    def tablesFor(self, scale):
+        tables = self.tables.get(scale.key)
+        if tables is None:
+            # degrees from the first note up to its octave
+            perOctave = max(1, int(np.searchsorted(scale.freqs, scale.freqs[0] * 2 * 0.99)))
+            tables = (perOctave, [PhraseTable(self.rng, notes, perOctave, spread, self.PHRASES)
+                                  for notes, spread in zip(self.NOTES, self.SPREAD)])
+            self.tables[scale.key] = tables
+        return tables
+
+    # returns (events, time the next measure starts) for the measure at start
+    def compose(self, scale, volVal, curVal, start):
+        perOctave, tables = self.tablesFor(scale)
+        band = bisect.bisect_left(self.BAND_EDGES, (volVal + 1) * (curVal + 1))
+        table = tables[band]
+        beat = calcTempo(curVal)
+        freqs = scale.freqList
+        last = len(freqs) - 1
+        main = scale.lookupIndex(volVal)
+
+        self.phrase = table.next(self.phrase, self.random())
+        measure = 4 * beat
+        events = [NoteEvent(start + fraction * measure, freqs[min(max(main + offset, 0), last)], velocity, 0)
+                  for fraction, offset, velocity in
+                  zip(table.fractions, table.phraseLists[self.phrase], table.velocityLists[self.phrase])]
+
+        bassFreq = freqs[max(0, main - perOctave)]
+        events.extend(NoteEvent(start + b * beat, bassFreq, 0.6 if b == 0 else 0.4, 1)
+                      for b in self.BASS[band])
+        events.sort()
+        return events, start + 4 * beat
+
+# composers by name, see COMPOSER
+COMPOSERS = { "neighbour":NeighbourComposer, "markov":MarkovComposer }
+
+'''
+    Audio Play Thread
+        Composes a measure at a time and hands the notes to a NoteScheduler
+        with absolute timestamps, keeping AUDIO_LOOKAHEAD seconds queued
+        The NoteScheduler keeps its own thread under either runtime, so
+        nothing else on the event loop, like a Tk redraw, delays a strike
+        The timeline is on clock, simulateDays drives a stepped one by hand
+            Inputs:
+                composer - NeighbourComposer or MarkovComposer
+                clock - SystemClock or SimClock the notes are timed on
+'''
+class AudioPlayThread(threading.Thread):
+    def __init__(self, composer, clock):
+        threading.Thread.__init__(self)
+        self.composer = composer
+        self.clock = clock
+        self._stop = Wakeup()
+        self._play = Wakeup()
+        self.scheduler = None
+
+    def play(self):
+        self._stop.clear()
+        self._play.set()
+        uiBus.post("audio", "Playing")
+
+    def stop(self):
+        self._stop.set()
+        self._play.clear()
+        uiBus.post("audio", "Stopped")
+        # silence the notes already queued
+        if self.scheduler is not None:
+            self.scheduler.clear()
+
+    def stopped(self):
+        return self._stop.is_set()
+
+    # sets up each voice and the note scheduler, returns the instruments
+    # connected, none when the notes go out over OSC
+    def connect(self):
+        voices = VOICES[:self.composer.voices]
+        instruments = []
+        if NOTE_OUTPUT == "osc":
+            # the receiver owns the instruments, it only needs their settings
+            output = OSCNoteOutput(OSCTransport(OSC_HOST, OSC_PORT), OSC_TIMETAGS, self.clock)
+            output.setup(voices)
+        else:
+            for preset, volume, hardness, position in voices:
+                s = hardware.newInstrument()
+                s.connect()
+                s.setVolume(volume)           # 0.0 <= volume <= 1.0
+                s.setStickHardness(hardness)  # 0.0 <= hardness <= 1.0
+                s.setStrikePosition(position) # 0.0 <= position <= 1.0
+                s.preset(preset)              # 0 = marimba, 1 = vibraphone
+                instruments.append(s)
+            output = ChuckNoteOutput(instruments)
+
+        # plays the composed notes on time
+        self.scheduler = NoteScheduler(output, self.clock)
+        metrics.gauge("spc_note_queue_depth", "Notes queued ahead of the audio output",
+                      lambda: len(self.scheduler.events))
+        return instruments
+
+    def disconnect(self, instruments):
+        self.scheduler.clear()
+        for s in instruments:
+            s.disconnect()
+
+    # queues the next measure, returns clock seconds until the one after
+    # it is due to be composed, None before the first reading
+    def measure(self):
+        # grab the latest filtered reading of the panel
+        sample = audioStream.latest
+        if sample is None:
+            return None
+
+        # the measure starts where the queued notes end
+        now = self.clock.monotonic()
+        noteTime = self.scheduler.horizon
+        if noteTime is None or noteTime < now:
+            noteTime = now + 0.05
+
+        # the pitch set and readings are fixed for the whole measure
+        self.scale = pitchSets.selection.scale
+        events, noteTime = self.composer.compose(self.scale, sample.voltage, sample.current, noteTime)
+
+        self.scheduler.schedule(events, noteTime)
+        # stop() may have cleared the queue while this measure was composed
+        if self.stopped():
+            self.scheduler.clear()
+
+        # compose the next measure once the queue runs low
+        return max(0, noteTime - self.clock.monotonic() - AUDIO_LOOKAHEAD)
+
+    def run(self):
+        instruments = self.connect()
+        self.scheduler.daemon = True
+        self.scheduler.start()
+        try:
+            while True:
+                # sleep until play is pressed
+                self._play.wait()
+
+                # what will actually be playing
+                while not self.stopped():
+                    delay = self.measure()
+                    if delay is None:
+                        time.sleep(0.1)
+                        continue
+                    # or stop
+                    self._stop.wait(delay / self.clock.speed)
+        finally:
+            self.disconnect(instruments)
+
+    async def runAsync(self, runtime):
+        instruments = self.connect()
+        self.scheduler.daemon = True
+        self.scheduler.start()
+        try:
+            while True:
+                await self._play.waitAsync()
+                while not self.stopped():
+                    delay = self.measure()
+                    if delay is None:
+                        await asyncio.sleep(0.1)
+                        continue
+                    await self._stop.waitAsync(delay / self.clock.speed)
+        finally:
+            self.disconnect(instruments)
+
 '''
     Battery Page
         Page for the battery diagnostics
 '''
 class BatteryPage(ttk.Frame):
+    feeds = ("sampler", "battery")
 
     def __init__(self, parent, controller):
         # background color
@@ -699,13 +3681,13 @@ class BatteryPage(ttk.Frame):
 
         # next page labels/buttons
         homeLbl = ttk.Label(self, text="Back", font=MED_FONT, style="My2.TLabel")
-        self.homeIcon = tk.PhotoImage(file="/home/pi/SPC/home.png")
+        self.homeIcon = loadImage("/home/pi/SPC/home.png")
         homeBtn = ttk.Button(self, image=self.homeIcon, style="My2.TButton", command = lambda: controller.show_frame(LandingPage))
         homeLbl.grid(row=7, column=0, sticky="W", padx=(160, 20), pady=(10, 0))
         homeBtn.grid(row=8, column=0, sticky="W", padx=(80, 20), pady=(10, 40))
 
         audioLbl = ttk.Label(self, text="Audio Experiments", font=MED_FONT, style="My2.TLabel")
-        self.audioIcon = tk.PhotoImage(file="/home/pi/SPC/headphones.png")
+        self.audioIcon = loadImage("/home/pi/SPC/headphones.png")
         audioBtn = ttk.Button(self, image=self.audioIcon, style="My2.TButton", command = lambda: controller.show_frame(AudioPage))
         audioLbl.grid(row=7, column=2, sticky="E", padx=(20, 105), pady=(10, 0))
         audioBtn.grid(row=8, column=2, sticky="E", padx=(20, 80), pady=(10, 40))
@@ -726,67 +3708,1040 @@ class BatteryPage(ttk.Frame):
         self.grid_rowconfigure(6, weight=1)
 
         # update battery values
-        batteryT = BatteryUpdateLabel(chargingLbl, powerLbl, timeLbl)
-        batteryT.daemon = True
-        batteryT.start()
+        uiBus.bind("battery.charging", chargingLbl)
+        uiBus.bind("battery.power", powerLbl)
+        uiBus.bind("battery.time", timeLbl)
 
         # bind click to timer reset
-        self.bind("<Button-1>", lambda x: self.resetTimer())
-
-    def resetTimer(self):
-        # establish global timer variable
-        global timer
-
-        c1.acquire()
-        timer = TIMEOUT
-        c1.release()
+        self.bind("<Button-1>", lambda x: controller.resetTimer())
 
 '''
     Battery Label Update Class
-        Updates the label displaying power draw from the batter
+        Updates the label displaying charge put into the battery
+        Posts to the "battery.charging", "battery.power" and "battery.time"
+        keys of the UI bus
             Inputs:
-                chargingLbl - charging/not charging label to be updated
-                powerLbl - power label to be updated
-                timeLbl - charging time label to be updated
+                counter - CoulombCounter doing the integration
 '''
 class BatteryUpdateLabel(threading.Thread):
-    def __init__(self, chargingLbl, powerLbl, timeLbl):
+    def __init__(self, counter):
         threading.Thread.__init__(self)
-        self.chargingLbl = chargingLbl
-        self.powerLbl = powerLbl
-        self.timeLbl = timeLbl
+        self.counter = counter
+        self.active = Wakeup()
+
+    # only updates while the labels are showing, counting goes on regardless
+    def setActive(self, active):
+        if active:
+            self.active.set()
+        else:
+            self.active.clear()
+
+    def update(self):
+        charging, sessionmAh, sessionSeconds, totalmAh = self.counter.snapshot
+
+        if charging:
+            uiBus.post("battery.charging", "Charging")
+            uiBus.post("battery.power", str(round(sessionmAh, 4))  + " mAh")
+            uiBus.post("battery.time", "Over " + str(int(sessionSeconds))  + " seconds")
+        else:
+            uiBus.post("battery.charging", "Not Charging")
+            uiBus.post("battery.power", "0 mAh")
+            uiBus.post("battery.time", "")
 
     def run(self):
-        secondsCharging = 0
+        while True:
+            self.active.wait()
+            self.update()
+            time.sleep(1)
 
+    async def runAsync(self, runtime):
         while True:
-            # read proportional current
-            powerVal = adc.read_adc(BATTERY, gain=GAIN)
-
-            print("Power Raw: " + str(powerVal))
-            
-            # cutoff value for battery not being drawn from
-            CUTOFF = 1000
-
-            if powerVal > CUTOFF:
-                secondsCharging += 1
-                # map input value to mA
-                # TODO
-                mAVal = powerVal
-                mAhVal = mAVal * (secondsCharging / 3600)
-
-                self.chargingLbl.config(text="Charging")
-                self.powerLbl.config(text=str(round(mAhVal, 4))  + " mAh")
-                self.timeLbl.config(text="Over " + str(secondsCharging)  + " seconds")
+            await self.active.waitAsync()
+            self.update()
+            await asyncio.sleep(1)
+
+'''
+    History Page
+        Charts of panel power and battery charge over the last hour, day or week
+        Reads the precomputed rollups and only moves the existing canvas
+        items, redrawing once per bucket while the page is showing
+'''
+class HistoryPage(ttk.Frame):
+    feeds = ()
+    WIDTH = 900
+    CHART_HEIGHT = 170
+    MARGIN = 60
+    # (button text, seconds shown)
+    SPANS = (("Hour", 3600), ("Day", 86400), ("Week", 604800))
+
+    def __init__(self, parent, controller):
+        # background color
+        gui_style = ttk.Style()
+        gui_style.configure('My4.TFrame', background='#e8e8ff')
+        gui_style.configure('My4.TLabel', background='#e8e8ff')
+        gui_style.configure('My4.TButton', background='#c6d2ff')
+
+        # frame and title
+        ttk.Frame.__init__(self, parent, style="My4.TFrame")
+        self.controller = controller
+        title = ttk.Label(self, text="Energy History", font=TITLE_FONT, style="My4.TLabel")
+        title.grid(row=0, column=1, sticky="N", pady=(40, 10))
+
+        # span buttons
+        spanFrame = ttk.Frame(self, style="My4.TFrame")
+        spanFrame.grid(row=1, column=1)
+        for i, (text, span) in enumerate(self.SPANS):
+            spanBtn = ttk.Button(spanFrame, text=text, style="My4.TButton", command = lambda span=span: self.setSpan(span))
+            spanBtn.grid(row=0, column=i, padx=10)
+
+        # charts
+        self.canvas = tk.Canvas(self, width=self.WIDTH, height=2 * self.CHART_HEIGHT + 3 * 30,
+                                background="white", highlightthickness=0)
+        self.canvas.grid(row=2, column=0, columnspan=3, pady=10)
+        self.charts = []
+        for i, (name, color) in enumerate((("Panel Power (Watts)", "#e0a000"), ("Battery Charge (mAh)", "#20a040"))):
+            top = 30 + i * (self.CHART_HEIGHT + 30)
+            bottom = top + self.CHART_HEIGHT
+            self.canvas.create_text(self.MARGIN, top - 15, text=name, anchor="w", font=SM_FONT)
+            self.canvas.create_line(self.MARGIN, bottom, self.WIDTH - 10, bottom, fill="#888888")
+            # items are created once and only have their coords moved
+            chart = {
+                'top':top, 'bottom':bottom, 'scale':None,
+                'band':self.canvas.create_polygon(0, 0, 0, 0, 0, 0, fill=color, stipple="gray50", outline=""),
+                'line':self.canvas.create_line(0, 0, 0, 0, fill=color, width=2),
+                'maxLbl':self.canvas.create_text(self.MARGIN - 5, top, text="", anchor="e", font=SM_FONT),
+                'minLbl':self.canvas.create_text(self.MARGIN - 5, bottom, text="0", anchor="e", font=SM_FONT),
+            }
+            self.charts.append(chart)
+        # shown until the stored history is in, see RollupStore.seed
+        self.loadingLbl = self.canvas.create_text(self.WIDTH / 2, self.CHART_HEIGHT + 45,
+                                                  text="Loading history...", font=MED_FONT)
+
+        # next page labels/buttons
+        homeLbl = ttk.Label(self, text="Back", font=MED_FONT, style="My4.TLabel")
+        self.homeIcon = loadImage("/home/pi/SPC/home.png")
+        homeBtn = ttk.Button(self, image=self.homeIcon, style="My4.TButton", command = lambda: controller.show_frame(LandingPage))
+        homeLbl.grid(row=3, column=0, sticky="W", padx=(160, 20), pady=(10, 0))
+        homeBtn.grid(row=4, column=0, sticky="W", padx=(80, 20), pady=(10, 40))
+
+        # grid weights for centering
+        self.grid_columnconfigure(1, weight=1)
+        self.grid_rowconfigure(5, weight=1)
+
+        # bind click to timer reset
+        self.bind("<Button-1>", lambda x: controller.resetTimer())
+        self.canvas.bind("<Button-1>", lambda x: controller.resetTimer())
+
+        self.span = self.SPANS[0][1]
+        self.drawnBucket = None
+        self.after(1000, self.refresh)
+
+    def setSpan(self, span):
+        self.controller.resetTimer()
+        self.span = span
+        self.drawnBucket = None
+        self.refresh(False)
+
+    def refresh(self, reschedule = True):
+        if reschedule:
+            self.after(1000, self.refresh)
+        if self.controller.currentFrame is not self or not rollups.seeded:
+            return
+        if self.loadingLbl is not None:
+            self.canvas.delete(self.loadingLbl)
+            self.loadingLbl = None
+
+        level, end, starts, mins, maxs, means = rollups.chart(self.span)
+        # nothing new since the last bucket was drawn
+        bucket = int(rollups.latest // level.width)
+        if bucket == self.drawnBucket:
+            return
+        self.drawnBucket = bucket
+
+        x = self.MARGIN + (starts - (end - self.span)) / self.span * (self.WIDTH - 10 - self.MARGIN)
+        for i, chart in enumerate(self.charts):
+            self.drawChart(chart, x, mins[:, i], maxs[:, i], means[:, i])
+
+    def drawChart(self, chart, x, mins, maxs, means):
+        if len(x) < 2:
+            self.canvas.coords(chart['line'], 0, 0, 0, 0)
+            self.canvas.coords(chart['band'], 0, 0, 0, 0, 0, 0)
+            return
+
+        # round the scale up so the axis label rarely changes
+        peak = max(float(maxs.max()), 1e-9)
+        scale = 10 ** math.floor(math.log10(peak))
+        scale = math.ceil(peak / scale) * scale
+        if scale != chart['scale']:
+            chart['scale'] = scale
+            self.canvas.itemconfig(chart['maxLbl'], text=str(round(scale, 2)))
+
+        height = chart['bottom'] - chart['top']
+        def y(values):
+            return chart['bottom'] - np.clip(values / scale, 0, 1) * height
+
+        line = np.column_stack((x, y(means))).ravel().tolist()
+        band = np.concatenate((np.column_stack((x, y(maxs))).ravel(),
+                               np.column_stack((x[::-1], y(mins[::-1]))).ravel())).tolist()
+        self.canvas.coords(chart['line'], *line)
+        self.canvas.coords(chart['band'], *band)
+
+'''
+    Fleet Frame
+        One kiosk's telemetry as sent to a FleetCollector
+            Fields:
+                node - name of the kiosk, at most 16 bytes of UTF-8
+                seq - frame number, counts up from 0 at every start
+                t - time.time() of the reading
+                voltage - panel volts
+                current - panel amps
+                battery - battery mA
+                userMode - True while the mode pin is HIGH
+                playing - True while the audio is playing
+'''
+FleetFrame = collections.namedtuple("FleetFrame", ["node", "seq", "t", "voltage", "current",
+                                                   "battery", "userMode", "playing"])
+
+# magic, version, flags, seq, t, voltage, current, battery, node, 46 bytes
+FLEET_FRAME = struct.Struct("<4sBBIdfff16s")
+FLEET_MAGIC = b"SPCF"
+FLEET_VERSION = 1
+FLEET_USER_MODE = 0x01
+FLEET_PLAYING = 0x02
+
+def encodeFrame(frame):
+    flags = (FLEET_USER_MODE if frame.userMode else 0) | (FLEET_PLAYING if frame.playing else 0)
+    return FLEET_FRAME.pack(FLEET_MAGIC, FLEET_VERSION, flags, frame.seq & 0xffffffff, frame.t,
+                            frame.voltage, frame.current, frame.battery,
+                            frame.node.encode("utf-8")[:16])
+
+def decodeFrame(data):
+    if len(data) != FLEET_FRAME.size:
+        raise ValueError("fleet frame is " + str(len(data)) + " bytes")
+    magic, version, flags, seq, t, voltage, current, battery, node = FLEET_FRAME.unpack(data)
+    if magic != FLEET_MAGIC or version != FLEET_VERSION:
+        raise ValueError("not a version " + str(FLEET_VERSION) + " fleet frame")
+    return FleetFrame(node.rstrip(b"\0").decode("utf-8", "replace"), seq, t, voltage, current,
+                      battery, bool(flags & FLEET_USER_MODE), bool(flags & FLEET_PLAYING))
+
+def isMulticast(host):
+    try:
+        return ipaddress.ip_address(host).is_multicast
+    except ValueError:
+        return False
+
+# "host:port" to (host, port)
+def parseAddress(text):
+    host, _, port = text.rpartition(":")
+    return host, int(port)
+
+'''
+    Telemetry Publisher Class
+        Sends this kiosk's readings to a FleetCollector as FleetFrames over
+        UDP, unicast or multicast, at a fixed rate
+            Inputs:
+                stream - FilteredStream to report
+                audio - AudioPlayThread whose state is reported
+                state - KioskState whose mode is reported
+                clock - clock the samples are stamped with
+                node - name of this kiosk
+                host - collector address or multicast group
+                port - collector UDP port
+                rate - frames per second
+'''
+class TelemetryPublisher(threading.Thread):
+    def __init__(self, stream, audio, state, clock, node, host, port, rate):
+        threading.Thread.__init__(self)
+        self.stream = stream
+        self.audio = audio
+        self.state = state
+        self.clock = clock
+        self.node = node
+        self.address = (host, port)
+        self.interval = 1.0 / rate
+        self.seq = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if isMulticast(host):
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, FLEET_TTL)
+
+    def frame(self, sample):
+        return FleetFrame(self.node, self.seq, sample.t + (self.clock.time() - self.clock.monotonic()),
+                          float(calibration.convert(VOLTAGE, sample.voltage)),
+                          float(calibration.convert(CURRENT, sample.current)),
+                          float(calibration.convert(BATTERY, sample.battery)),
+                          self.state.snapshot.mode == "user", not self.audio.stopped())
+
+    def send(self):
+        sample = self.stream.latest
+        if sample is not None:
+            try:
+                self.sock.sendto(encodeFrame(self.frame(sample)), self.address)
+            except OSError as e:
+                log.debug("Sending telemetry failed: %r", e)
+            self.seq += 1
+
+    def run(self):
+        nextSend = time.monotonic()
+        while True:
+            self.send()
+            nextSend += self.interval
+            delay = nextSend - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
             else:
-                self.chargingLbl.config(text="Not Charging")
-                self.powerLbl.config(text="0 mAh")
-                self.timeLbl.config(text="")
-                secondsCharging = 0
+                nextSend = time.monotonic()
+
+    # a datagram send never blocks, so it is made on the loop
+    async def runAsync(self, runtime):
+        nextSend = time.monotonic()
+        try:
+            while True:
+                self.send()
+                nextSend += self.interval
+                delay = nextSend - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    nextSend = time.monotonic()
+        finally:
+            self.sock.close()
 
-            time.sleep(1)
+'''
+    Fleet Node Class
+        The collector's ring of the newest frames from one kiosk
+        Gaps in seq count as lost, a frame arriving after a newer one is
+        late and no longer lost, and a lower seq with a newer reading is
+        the kiosk restarting
+            Inputs:
+                name - node name from its frames
+                size - number of frames kept
+'''
+class FleetNode:
+    DTYPE = np.dtype([('t', '<f8'), ('voltage', '<f4'), ('current', '<f4'),
+                      ('battery', '<f4'), ('userMode', '?'), ('playing', '?')])
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.ring = np.zeros(size, dtype=self.DTYPE)
+        self.count = 0
+        self.lastSeq = None
+        self.lastT = None
+        # frames that never arrived, from gaps in seq
+        self.lost = 0
+        # frames that arrived after a newer one
+        self.late = 0
+        self.address = None
+        self.lastSeen = None
+
+    def add(self, frame, address, now):
+        self.address = address
+        self.lastSeen = now
+        if self.lastSeq is not None and frame.seq <= self.lastSeq and frame.t <= self.lastT:
+            # late or duplicated, kept out of the ring so it stays in order
+            if frame.seq < self.lastSeq:
+                self.late += 1
+                # counted lost when the frames after it came in
+                self.lost = max(0, self.lost - 1)
+            return
+        if self.lastSeq is not None and frame.seq > self.lastSeq + 1:
+            self.lost += frame.seq - self.lastSeq - 1
+        # a lower seq with a newer reading is a restart, count on from it
+        self.lastSeq = frame.seq
+        self.lastT = frame.t
+        self.ring[self.count % self.size] = (frame.t, frame.voltage, frame.current,
+                                             frame.battery, frame.userMode, frame.playing)
+        self.count += 1
+
+    # up to the n newest frames, oldest first
+    def history(self, n = None):
+        if n is None or n > self.size:
+            n = self.size
+        n = min(n, self.count)
+        return self.ring[np.arange(self.count - n, self.count) % self.size]
+
+    def summary(self, now):
+        latest = self.history(1)
+        summary = { 'name':self.name, 'address':self.address[0], 'frames':self.count, 'lost':self.lost,
+                    'late':self.late, 'secondsSinceSeen':round(now - self.lastSeen, 3) }
+        for field in self.DTYPE.names:
+            summary[field] = latest[field][0].item()
+        return summary
 
-# run the app
-app = DisplayApp()
-app.geometry("1024x768")
-app.mainloop()
+'''
+    Fleet Collector Class
+        Gathers the FleetFrames of every kiosk into per-node rings
+        A single datagram endpoint receives for all of them, so dozens of
+        nodes cost no more threads than one, and it serves the fleet as
+        JSON at /fleet and /fleet/<node>@<address>?n=<frames> over HTTP
+        Nodes are told apart by name and address, stock Pis are all
+        named raspberrypi
+            Inputs:
+                size - frames kept per node
+'''
+class FleetCollector(asyncio.DatagramProtocol):
+    def __init__(self, size):
+        self.size = size
+        self.nodes = {}
+        # datagrams that weren't fleet frames
+        self.rejected = 0
+
+    def datagram_received(self, data, address):
+        try:
+            frame = decodeFrame(data)
+        except ValueError:
+            self.rejected += 1
+            return
+        key = frame.node + "@" + address[0]
+        node = self.nodes.get(key)
+        if node is None:
+            if any(other.name == frame.node for other in self.nodes.values()):
+                log.warning("Fleet node name %s is used from more than one address, "
+                            "give each kiosk its own --node", frame.node)
+            node = FleetNode(frame.node, self.size)
+            self.nodes[key] = node
+            log.info("Fleet node %s joined from %s", frame.node, address[0])
+        node.add(frame, address, time.monotonic())
+
+    def summary(self):
+        now = time.monotonic()
+        return { 'rejected':self.rejected,
+                 'nodes':{ key:node.summary(now) for key, node in self.nodes.items() } }
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, query = await readRequest(reader)
+            if method == "GET" and path == "/fleet":
+                body = json.dumps(self.summary())
+            elif method == "GET" and path.startswith("/fleet/") and path[7:] in self.nodes:
+                rows = self.nodes[path[7:]].history(int(query.get('n', ['60'])[0]))
+                body = json.dumps({ field:rows[field].tolist() for field in FleetNode.DTYPE.names })
+            else:
+                await writeResponse(writer, "404 Not Found", "text/plain", b"not found\n")
+                return
+            await writeResponse(writer, "200 OK", "application/json", body.encode("utf-8"))
+        except (OSError, ValueError, IndexError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+'''
+    Struck Bar Synth Class
+        NumPy stand-in for ChucK's StruckBar for offline rendering
+        Every note is a few exponentially decaying sine modes, all the
+        sounding modes are computed together one block of samples at a time
+        The vibraphone preset gets its motor tremolo
+            Inputs:
+                rate - samples per second
+                voices - instrument setup per voice, as VOICES
+'''
+class StruckBarSynth:
+    # (mode frequency ratios, mode decay seconds, tremolo depth) per preset
+    PRESETS = {
+        0: ((1.0, 3.9, 9.2), (0.6, 0.15, 0.05), 0.0), # marimba
+        1: ((1.0, 4.0, 10.0), (3.0, 0.8, 0.25), 0.3), # vibraphone
+    }
+    TREMOLO_HZ = 5.5
+    # a mode is dropped once it has decayed this many time constants (-80 dB)
+    CUTOFF = 9.2
+
+    def __init__(self, rate, voices = VOICES):
+        self.rate = rate
+        # per voice, mode rows of (ratio, decay, amplitude) and the tremolo depth
+        self.voices = []
+        for preset, volume, hardness, position in voices:
+            ratios, decays, tremolo = self.PRESETS[preset]
+            # harder sticks bring out the upper modes
+            amps = volume * (0.25 + 0.75 * hardness) ** np.arange(len(ratios))
+            self.voices.append((np.array(ratios), np.array(decays), amps, tremolo))
+        # sounding modes, one row each
+        self.start = np.zeros(0)
+        self.freq = np.zeros(0)
+        self.decay = np.zeros(0)
+        self.amp = np.zeros(0)
+        self.tremolo = np.zeros(0)
+
+    def add(self, events):
+        if not events:
+            return
+        start, freq, velocity, voice = (np.array(column) for column in zip(*events))
+        rows = [self.start], [self.freq], [self.decay], [self.amp], [self.tremolo]
+        for v, (ratios, decays, amps, tremolo) in enumerate(self.voices):
+            mine = voice == v
+            n = int(mine.sum())
+            if n == 0:
+                continue
+            rows[0].append(np.repeat(start[mine], len(ratios)))
+            rows[1].append(np.outer(freq[mine], ratios).ravel())
+            rows[2].append(np.tile(decays, n))
+            rows[3].append(np.outer(velocity[mine], amps).ravel())
+            rows[4].append(np.full(n * len(ratios), tremolo))
+        self.start, self.freq, self.decay, self.amp, self.tremolo = (np.concatenate(r) for r in rows)
+
+    # n samples from sample first, as float64 in about [-1, 1]
+    def render(self, first, n):
+        t = (first + np.arange(n)) / self.rate
+        t0 = first / self.rate
+        # drop the modes that have died away, and hold back the ones not started
+        alive = (t0 - self.start) < self.decay * self.CUTOFF
+        self.start, self.freq, self.decay, self.amp, self.tremolo = (
+            a[alive] for a in (self.start, self.freq, self.decay, self.amp, self.tremolo))
+        started = self.start < t[-1]
+
+        age = t[None, :] - self.start[started, None]
+        modes = np.where(age >= 0,
+                         self.amp[started, None] * np.exp(-np.maximum(age, 0) / self.decay[started, None])
+                         * np.sin(2 * math.pi * self.freq[started, None] * age), 0.0)
+        # motor tremolo, a gain dipping by each row's depth
+        dip = 0.5 + 0.5 * np.sin(2 * math.pi * self.TREMOLO_HZ * t)
+        gain = 1 - self.tremolo[started, None] * dip[None, :]
+        return (gain * modes).sum(axis=0)
+
+'''
+    Render WAV
+        Runs a composer over a solar profile and writes what it would have
+        played to a mono 16-bit WAV file, one block at a time
+        Each second of audio covers speed seconds of the profile
+        Returns a summary of the render
+            Inputs:
+                path - WAV file to write
+                profile - SolarProfile to compose from
+                composer - NeighbourComposer or MarkovComposer
+                scale - Scale to play in
+                seconds - seconds of audio
+                speed - profile seconds per audio second
+'''
+def renderWav(path, profile, composer, scale, seconds, speed):
+    synth = StruckBarSynth(RENDER_RATE)
+    total = int(seconds * RENDER_RATE)
+    noteTime = 0.0
+    notes = 0
+    started = time.monotonic()
+    with wave.open(path, "wb") as out:
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(RENDER_RATE)
+        for first in range(0, total, RENDER_BLOCK):
+            n = min(RENDER_BLOCK, total - first)
+            # compose until the measures reach past this block
+            while noteTime * RENDER_RATE < first + n:
+                t = profile.start + noteTime * speed
+                events, noteTime = composer.compose(scale, profile.value(VOLTAGE, t),
+                                                    profile.value(CURRENT, t), noteTime)
+                synth.add(events)
+                notes += len(events)
+            block = np.tanh(synth.render(first, n) * RENDER_GAIN)
+            out.writeframes((block * 32767).astype('<i2').tobytes())
+    elapsed = time.monotonic() - started
+    return {
+        'path':path,
+        'audioSeconds':round(total / RENDER_RATE, 3),
+        'profileSeconds':round(total / RENDER_RATE * speed, 1),
+        'notes':notes,
+        'seconds':round(elapsed, 3),
+        'realtimeFactor':round(total / RENDER_RATE / elapsed, 1),
+    }
+
+'''
+    Setup Services
+        Builds the sampler, streams and stores on the given hardware as the
+        module globals the threads and pages read
+            Inputs:
+                hw - PiHardware or SimulatedHardware
+                directory - directory for the telemetry, charge and weather files
+                interval - seconds between ADC scans
+                fleet - (node name, host, port) to publish telemetry to, or None
+                composer - name of the composer in COMPOSERS
+                pitchFile - pitch set file
+                pitchSet - name of the pitch set to start on, the first if None
+'''
+def setupServices(hw, directory, interval = SAMPLE_INTERVAL, fleet = None, composer = COMPOSER,
+                  pitchFile = PITCHSET_FILE, pitchSet = None):
+    global hardware, dataDir, fleetTarget, composerName, kiosk, pitchSets, sampler, audioStream, labelStream, telemetryStream
+    global coulombs, rollups, telemetryStore, recorder, uiBus, weatherProvider
+    hardware = hw
+    dataDir = directory
+    fleetTarget = fleet
+    composerName = composer
+    hardware.start()
+
+    # the state the threads share, MODE_PIN follows its mode
+    kiosk = KioskState(PitchSelection(DEFAULT_SCALES, 0))
+    kiosk.subscribe(followMode(hardware.gpio))
+    pitchSets = PitchSetRegistry(pitchFile, pitchSet, kiosk)
+
+    # start sampling the ADC before anything reads from it
+    # a stepped clock is scanned by hand, see simulateDays
+    if ADC_MODE == "continuous" and hardware.clock.speed:
+        sampler = ContinuousADCSampler(hardware.adc, hardware.alertGPIO, ALERT_PIN, DATA_RATE, hardware.clock)
+    else:
+        sampler = ADCSampler(hardware.adc, interval, hardware.clock)
+
+    # filtered streams, audio follows changes quickly, labels are smoothed
+    audioStream = FilteredStream(sampler, AUDIO_RATE, FILTERS[AUDIO_FILTER](5))
+    labelStream = FilteredStream(sampler, LABEL_RATE, FILTERS[LABEL_FILTER](max(1, int(1 / (LABEL_RATE * sampler.interval)))))
+    telemetryStream = FilteredStream(sampler, TELEMETRY_RATE, FILTERS[TELEMETRY_FILTER](max(1, int(1 / (TELEMETRY_RATE * sampler.interval)))))
+
+    # record the readings to the SD card
+    telemetryStore = TelemetryStore(os.path.join(dataDir, TELEMETRY_DIR), TELEMETRY_RATE,
+                                    TELEMETRY_SEGMENT, TELEMETRY_RETENTION)
+    recorder = TelemetryRecorder(telemetryStream, telemetryStore, hardware.clock)
+
+    # battery charge integration, saved by the recorder
+    coulombs = CoulombCounter(sampler, os.path.join(dataDir, CHARGE_STATE), recorder.defer)
+
+    # history chart rollups
+    rollups = RollupStore(telemetryStream, coulombs, ROLLUP_LEVELS, hardware.clock)
+    # seeded from what was stored before this boot, read by the recorder
+    # once it starts so the first paint doesn't wait on the card
+    bootTime = hardware.clock.time()
+    bootmAh = coulombs.snapshot[3]
+    recorder.defer(lambda: rollups.seed(telemetryStore.query(bootTime - ROLLUP_SEED, bootTime), bootmAh))
+
+    # label updates from the worker threads
+    uiBus = UIUpdateBus()
+
+    metrics.gauge("spc_telemetry_queue_depth", "Readings waiting to be written to the telemetry store",
+                  recorder.queue.qsize)
+    metrics.gauge("spc_ui_queue_depth", "Label updates waiting for the Tk thread",
+                  lambda: uiBus.queue.qsize() + uiBus.calls.qsize())
+
+    # weather for Kirtland, OH (the Yahoo! YQL service is retired)
+    weatherProvider = OpenMeteoProvider(41.63, -81.36)
+
+'''
+    Simulated Load Test
+        Steps a SimulatedHardware clock through whole days of scans as fast
+        as the pipeline keeps up, with the audio composing throughout
+        Returns a summary of the run
+            Inputs:
+                days - simulated days to run
+                interval - simulated seconds between scans
+'''
+def simulateDays(days, interval):
+    recorder.daemon = True
+    recorder.start()
+    # composed and played in simulated time, notes are struck at the
+    # first scan at or after their time
+    audio = AudioPlayThread(COMPOSERS[composerName](), hardware.clock)
+    instruments = audio.connect()
+    audio.play()
+    nextMeasure = 0.0
+
+    start = hardware.clock.time()
+    scans = int(days * 86400 / interval)
+    realStart = time.monotonic()
+    for _ in range(scans):
+        hardware.clock.advance(interval)
+        sampler.publish(sampler.scan())
+
+        # keep AUDIO_LOOKAHEAD queued, as the audio thread would
+        now = hardware.clock.monotonic()
+        while now >= nextMeasure:
+            delay = audio.measure()
+            if delay is None:
+                break
+            nextMeasure = now + delay
+        audio.scheduler.pump()
+    audio.stop()
+    audio.disconnect(instruments)
+    recorder.queue.join()
+    telemetryStore.flush()
+    elapsed = time.monotonic() - realStart
+
+    charging, sessionmAh, sessionSeconds, totalmAh = coulombs.snapshot
+    return {
+        'days':days,
+        'scans':scans,
+        'seconds':round(elapsed, 3),
+        'scansPerSecond':round(scans / elapsed, 1),
+        'telemetryRecords':len(telemetryStore.query(start, hardware.clock.time() + 1)),
+        'totalmAh':round(totalmAh, 3),
+        'gpioTransitions':hardware.gpio.transitions,
+        'notes':len(hardware.notes()),
+    }
+
+# (count, mean, p50, p90, p99, max) of durations in seconds, reported in ms
+def latencyStats(seconds):
+    ms = np.asarray(seconds, dtype=np.float64) * 1000
+    if len(ms) == 0:
+        return { 'count':0 }
+    p50, p90, p99 = np.percentile(ms, (50, 90, 99)).tolist()
+    return { 'count':len(ms), 'meanMs':round(float(ms.mean()), 4), 'p50Ms':round(p50, 4),
+             'p90Ms':round(p90, 4), 'p99Ms':round(p99, 4), 'maxMs':round(float(ms.max()), 4) }
+
+'''
+    Beat Probe
+        Note output for the benchmarks, records how late each note was
+        handed over against the time it was scheduled for
+'''
+class BeatProbe:
+    sendAhead = 0
+
+    def __init__(self):
+        self.lateness = []
+
+    def play(self, events):
+        now = time.monotonic()
+        for event in events:
+            self.lateness.append(now - event.t)
+
+# runs the steps of NeighbourComposer.compose on random readings,
+# timing each step of the note selection
+def benchNoteSelection(measures):
+    audio = NeighbourComposer()
+    audio.scale = DEFAULT_SCALES[0]
+    audio.BeatsPerMeasure = 4
+    readings = np.random.RandomState(0).uniform(0, AUDIO_FULL_SCALE, (measures, 2)).tolist()
+    steps = { 'calcTempo':0.0, 'calcSubdivisions':0.0, 'calcPitch':0.0, 'chooseNeighbour':0.0 }
+    latencies = []
+    notes = 0
+
+    clock = time.perf_counter
+    start = clock()
+    for volVal, curVal in readings:
+        t0 = clock()
+        audio.beat = audio.calcTempo(curVal)
+        t1 = clock()
+        audio.calcSubdivisions(volVal, curVal)
+        t2 = clock()
+        mainFreq, secFreq, terFreq = audio.calcPitch(volVal)
+        t3 = clock()
+        count = int((audio.BeatsPerMeasure / 4) * audio.numSubs)
+        for _ in range(count):
+            audio.chooseNeighbour(mainFreq, secFreq, terFreq)
+        t4 = clock()
+        steps['calcTempo'] += t1 - t0
+        steps['calcSubdivisions'] += t2 - t1
+        steps['calcPitch'] += t3 - t2
+        steps['chooseNeighbour'] += t4 - t3
+        latencies.append(t4 - t0)
+        notes += count
+    elapsed = clock() - start
+
+    return {
+        'measures':measures,
+        'notes':notes,
+        'measuresPerSecond':round(measures / elapsed, 1),
+        'notesPerSecond':round(notes / elapsed, 1),
+        'measureLatency':latencyStats(latencies),
+        # mean time per call, chooseNeighbour per note
+        'stepMeanUs':{ name:round(total * 1e6 / (notes if name == 'chooseNeighbour' else measures), 3)
+                       for name, total in steps.items() },
+    }
+
+# times whole compose() calls of every composer on random readings
+def benchComposers(measures):
+    readings = np.random.RandomState(0).uniform(0, AUDIO_FULL_SCALE, (measures, 2)).tolist()
+    results = {}
+    for name, composerClass in sorted(COMPOSERS.items()):
+        built = time.perf_counter()
+        composer = composerClass()
+        built = time.perf_counter() - built
+        latencies = []
+        notes = 0
+        start = time.perf_counter()
+        for volVal, curVal in readings:
+            t0 = time.perf_counter()
+            events, end = composer.compose(DEFAULT_SCALES[0], volVal, curVal, 0.0)
+            latencies.append(time.perf_counter() - t0)
+            notes += len(events)
+        elapsed = time.perf_counter() - start
+        results[name] = {
+            'setupMs':round(built * 1000, 3),
+            'notes':notes,
+            'measuresPerSecond':round(measures / elapsed, 1),
+            'notesPerSecond':round(notes / elapsed, 1),
+            'measureLatency':latencyStats(latencies),
+        }
+    return results
+
+# plays a steady beat through a NoteScheduler a measure at a time,
+# keeping AUDIO_LOOKAHEAD queued like AudioPlayThread
+def benchBeatJitter(seconds, beat = 0.125):
+    probe = BeatProbe()
+    scheduler = NoteScheduler(probe, SystemClock())
+    scheduler.daemon = True
+    scheduler.start()
+
+    end = time.monotonic() + seconds
+    noteTime = time.monotonic() + 0.05
+    while noteTime < end:
+        events = [NoteEvent(noteTime + i * beat, 440.0, 0.5) for i in range(4)]
+        noteTime += 4 * beat
+        scheduler.schedule(events, noteTime)
+        time.sleep(max(0, noteTime - time.monotonic() - AUDIO_LOOKAHEAD))
+    time.sleep(max(0, noteTime - time.monotonic()) + 0.1)
+    scheduler.clear()
+
+    lateness = np.array(probe.lateness)
+    return {
+        'beatSeconds':beat,
+        'notes':len(lateness),
+        'lateness':latencyStats(lateness),
+        'earlyNotes':int((lateness < 0).sum()),
+    }
+
+# runs the sampler at full rate on the simulated ADC
+def benchADC(seconds):
+    sampler.setActive(True)
+    adc = hardware.adc
+    reads = dict(adc.reads)
+    scans = adcScans.value
+    start = time.monotonic()
+    time.sleep(seconds)
+    elapsed = time.monotonic() - start
+    scans = adcScans.value - scans
+
+    channels = { 'voltage':VOLTAGE, 'current':CURRENT, 'battery':BATTERY }
+    return {
+        'mode':ADC_MODE,
+        'targetScansPerSecond':round(1.0 / sampler.interval, 1),
+        'scansPerSecond':round(scans / elapsed, 2),
+        'readsPerSecond':{ name:round((adc.reads[channel] - reads.get(channel, 0)) / elapsed, 2)
+                           for name, channel in channels.items() },
+    }
+
+# time from a sample being published to its label text being drawn,
+# through the UI bus like the panel labels
+def benchLabelLatency(seconds):
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        return { 'error':"no display: " + str(e) }
+    uiBus.start(root)
+    label = ttk.Label(root, text="")
+    label.pack()
+    uiBus.bind("bench.sample", label)
+
+    def post(sample):
+        uiBus.post("bench.sample", repr(sample.t))
+    sampler.subscribe(post)
+
+    latencies = []
+    shown = [""]
+    # polls for the label changing, then waits for it to be drawn
+    def check():
+        text = label.cget("text")
+        if text and text != shown[0]:
+            shown[0] = text
+            root.update_idletasks()
+            latencies.append(hardware.clock.monotonic() - float(text))
+        root.after(1, check)
+
+    root.after(1, check)
+    root.after(int(seconds * 1000), root.quit)
+    root.mainloop()
+    sampler.unsubscribe(post)
+    root.destroy()
+
+    return {
+        'interval':uiBus.interval,
+        'latency':latencyStats(latencies),
+    }
+
+'''
+    Benchmarks
+        Times the audio and sensor paths on SimulatedHardware running in
+        real time, returns the results for JSON output
+            Inputs:
+                seconds - length of each timed run
+'''
+def runBenchmarks(seconds):
+    sampler.daemon = True
+    sampler.start()
+    return {
+        'time':time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        'python':sys.version.split()[0],
+        'numpy':np.__version__,
+        'noteSelection':benchNoteSelection(20000),
+        'composers':benchComposers(20000),
+        'beatJitter':benchBeatJitter(seconds),
+        'adc':benchADC(seconds),
+        'labelLatency':benchLabelLatency(seconds),
+    }
+
+# receives fleet frames on host:port, joining host if it is a multicast
+# group, and serves the fleet over HTTP on webPort, all on one event loop
+def runCollector(host, port, webPort):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    collector = FleetCollector(FLEET_HISTORY)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if isMulticast(host):
+        sock.bind(("", port))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                        socket.inet_aton(host) + socket.inet_aton("0.0.0.0"))
+    else:
+        sock.bind((host, port))
+    loop.run_until_complete(loop.create_datagram_endpoint(lambda: collector, sock=sock))
+    if webPort:
+        loop.run_until_complete(asyncio.start_server(collector.handle, WEB_HOST, webPort))
+    log.info("Collecting fleet telemetry on %s:%d", host, port)
+    loop.run_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Solar powered chime kiosk")
+    parser.add_argument("--sim", action="store_true",
+                        help="run on simulated GPIO, ADC and ChucK instead of the Pi's")
+    parser.add_argument("--profile",
+                        help="CSV file or telemetry directory for --sim to replay, a synthetic day by default")
+    parser.add_argument("--speed", type=float,
+                        help="simulated seconds per real second for --sim (1), "
+                             "profile seconds per audio second for --render (RENDER_SPEED)")
+    parser.add_argument("--days", type=float,
+                        help="run this many simulated days headless with --sim and print a summary")
+    parser.add_argument("--step", type=float, default=1.0,
+                        help="simulated seconds between scans for --days")
+    parser.add_argument("--bench", nargs="?", const="-", metavar="FILE",
+                        help="run the benchmarks with --sim and write JSON to FILE, stdout by default")
+    parser.add_argument("--bench-seconds", type=float, default=10,
+                        help="length of each timed benchmark")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="port of the local /metrics endpoint, 0 to turn it off")
+    parser.add_argument("--log-level", default="INFO",
+                        help="DEBUG also logs every sample and note")
+    parser.add_argument("--headless", action="store_true",
+                        help="run without the Tk window, serving the dashboard over HTTP")
+    parser.add_argument("--web-port", type=int,
+                        help="port of the web dashboard, WEB_PORT when headless and off otherwise, "
+                             "0 turns it off and so can't be used with --headless")
+    parser.add_argument("--fleet", metavar="HOST:PORT",
+                        help="publish telemetry frames to a collector or multicast group")
+    parser.add_argument("--node", default=socket.gethostname(),
+                        help="name this kiosk reports to the fleet, set it when several share a hostname")
+    parser.add_argument("--collect", metavar="HOST:PORT",
+                        help="run a fleet collector on this address or multicast group instead of a kiosk")
+    parser.add_argument("--render", metavar="WAV",
+                        help="compose from --profile, a synthetic day by default, into a WAV file and exit")
+    parser.add_argument("--render-seconds", type=float,
+                        help="length of the --render audio, the whole profile by default")
+    parser.add_argument("--pitch-sets", default=PITCHSET_FILE, metavar="JSON",
+                        help="pitch set file, reloaded whenever it changes")
+    parser.add_argument("--pitch-set", metavar="NAME",
+                        help="pitch set to start on")
+    parser.add_argument("--runtime", choices=("threads", "asyncio"), default=RUNTIME,
+                        help="run the kiosk's services as threads or as tasks on one event loop")
+    parser.add_argument("--composer", choices=sorted(COMPOSERS), default=COMPOSER,
+                        help="how the music is composed")
+    parser.add_argument("--data",
+                        help="directory for the telemetry, charge and weather files, "
+                             "DATA_DIR on the Pi and a scratch directory for --sim")
+    args = parser.parse_args()
+    if (args.days or args.bench) and not args.sim:
+        parser.error("--days and --bench need --sim")
+    # the dashboard is the only thing left draining the UI bus
+    if args.headless and args.web_port == 0:
+        parser.error("--headless needs the web dashboard, --web-port can't be 0")
+
+    logging.basicConfig(level=args.log_level.upper(),
+                        format="%(asctime)s %(levelname)s %(threadName)s: %(message)s")
+    if args.pitch_set is not None:
+        names = PitchSetRegistry(args.pitch_sets).names()
+        if args.pitch_set not in names:
+            parser.error("no pitch set named " + repr(args.pitch_set) + " in " + args.pitch_sets +
+                         ", choose from " + ", ".join(names))
+    # only the kiosk itself has services to put on the event loop
+    global runtime
+    if args.runtime == "asyncio" and not (args.render or args.collect or args.days or args.bench):
+        runtime = AsyncRuntime()
+    if args.metrics_port:
+        startService(MetricsServer(metrics, METRICS_HOST, args.metrics_port))
+
+    if args.render:
+        profile = SolarProfile.load(args.profile) if args.profile else SolarProfile.synthetic()
+        speed = args.speed or RENDER_SPEED
+        seconds = args.render_seconds or profile.period / speed
+        scale = PitchSetRegistry(args.pitch_sets, args.pitch_set).selection.scale
+        summary = renderWav(args.render, profile, COMPOSERS[args.composer](), scale, seconds, speed)
+        print(json.dumps(summary, indent=2))
+        return
+
+    if args.collect:
+        host, port = parseAddress(args.collect)
+        webPort = args.web_port if args.web_port is not None else WEB_PORT
+        runCollector(host, port, webPort)
+        return
+    fleet = None
+    if args.fleet:
+        host, port = parseAddress(args.fleet)
+        fleet = (args.node, host, port)
+
+    if args.sim:
+        profile = SolarProfile.load(args.profile) if args.profile else None
+        # load tests step the clock by hand
+        hw = SimulatedHardware(profile, 0 if args.days else (args.speed or 1.0))
+        directory = args.data or tempfile.mkdtemp(prefix="spc-sim-")
+    else:
+        hw = PiHardware()
+        directory = args.data or DATA_DIR
+
+    if args.days:
+        setupServices(hw, directory, args.step, fleet, args.composer, args.pitch_sets, args.pitch_set)
+        print(json.dumps(simulateDays(args.days, args.step), indent=2))
+        return
+
+    if args.bench:
+        setupServices(hw, directory, composer = args.composer,
+                      pitchFile = args.pitch_sets, pitchSet = args.pitch_set)
+        results = json.dumps(runBenchmarks(args.bench_seconds), indent=2)
+        if args.bench == "-":
+            print(results)
+        else:
+            with open(args.bench, "w") as f:
+                f.write(results + "\n")
+        return
+
+    setupServices(hw, directory, fleet = fleet, composer = args.composer,
+                  pitchFile = args.pitch_sets, pitchSet = args.pitch_set)
+
+    global dashboard
+    webPort = args.web_port if args.web_port is not None else (WEB_PORT if args.headless else 0)
+    if webPort:
+        dashboard = DashboardServer(WEB_HOST, webPort, runtime.loop if runtime is not None else None)
+        uiBus.watch(dashboard.watch)
+
+    if args.headless:
+        services = makeServices()
+        for service in services.values():
+            startService(service)
+        setFeeds(services, ())
+        if dashboard is not None:
+            # the dashboard's event loop drains the UI bus instead of Tk
+            dashboard.onClients = lambda clients: setFeeds(services, DashboardServer.feeds if clients else ())
+            uiBus.start(dashboard)
+            startService(dashboard)
+        if runtime is not None:
+            runtime.run()
+            coulombs.save()
+        else:
+            # nothing left to do here, the threads keep recording until
+            # SIGTERM or Ctrl-C, then the totals are saved
+            stopped = threading.Event()
+            signal.signal(signal.SIGTERM, lambda sig, frame: stopped.set())
+            try:
+                stopped.wait()
+            finally:
+                coulombs.save()
+        return
+
+    # run the app
+    app = DisplayApp()
+    uiBus.start(app)
+    if dashboard is not None:
+        dashboard.onClients = lambda clients: uiBus.call(app.updateFeeds)
+        startService(dashboard)
+    app.geometry("1024x768")
+    if runtime is not None:
+        runtime.run(app)
+        coulombs.save()
+    else:
+        try:
+            app.mainloop()
+        finally:
+            coulombs.save()
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,4 @@
 #!/bin/bash
-xterm -hold -e "sudo chuck --verbose /usr/local/lib/python3.4/dist-packages/chuck/osc/oscrecv.ck"
\ No newline at end of file
+# oscrecv.ck ships inside the chuck package of whichever python3 runs main.py
+OSCRECV=$(python3 -c 'import importlib.util, os; print(os.path.join(os.path.dirname(importlib.util.find_spec("chuck").origin), "osc", "oscrecv.ck"))')
+xterm -hold -e "sudo chuck --verbose $OSCRECV"
@@ -0,0 +1,56 @@
+// StruckBar OSC receiver
+//   plays the notes main.py sends with NOTE_OUTPUT = "osc", one StruckBar
+//   per voice, voice 0 on the plain addresses and voice n on addresses
+//   ending in /n
+//     /struckbar/setup     i f f f - preset, volume, stick hardness, strike position
+//     /struckbar/frequency f       - frequency of the voice's next strike
+//     /struckbar/strike    f       - strikes the voice at a velocity
+//   notes are struck as they arrive, bundle timetags are ignored, so leave
+//   OSC_TIMETAGS off in main.py
+//   usage: chuck struckbar.ck[:port], OSC_PORT (6449) by default
+
+6449 => int port;
+if (me.args() > 0) Std.atoi(me.arg(0)) => port;
+
+// as many as VOICES in main.py
+2 => int VOICES;
+StruckBar bars[VOICES];
+for (0 => int v; v < VOICES; v++) bars[v] => dac;
+
+OscIn oin;
+port => oin.port;
+OscMsg msg;
+
+for (0 => int v; v < VOICES; v++) {
+    "" => string suffix;
+    if (v > 0) "/" + v => suffix;
+    oin.addAddress("/struckbar/setup" + suffix + ", i f f f");
+    oin.addAddress("/struckbar/frequency" + suffix + ", f");
+    oin.addAddress("/struckbar/strike" + suffix + ", f");
+}
+
+// voice of an address starting with base, 0 without a /n suffix
+fun int voiceOf(string address, string base) {
+    if (address.length() == base.length()) return 0;
+    return Std.atoi(address.substring(base.length() + 1));
+}
+
+<<< "struckbar.ck listening on port", port >>>;
+
+while (true) {
+    oin => now;
+    while (oin.recv(msg)) {
+        msg.address => string address;
+        if (address.find("/struckbar/setup") == 0) {
+            voiceOf(address, "/struckbar/setup") => int v;
+            msg.getInt(0) => bars[v].preset;
+            msg.getFloat(1) => bars[v].gain;
+            msg.getFloat(2) => bars[v].stickHardness;
+            msg.getFloat(3) => bars[v].strikePosition;
+        } else if (address.find("/struckbar/frequency") == 0) {
+            msg.getFloat(0) => bars[voiceOf(address, "/struckbar/frequency")].freq;
+        } else if (address.find("/struckbar/strike") == 0) {
+            msg.getFloat(0) => bars[voiceOf(address, "/struckbar/strike")].strike;
+        }
+    }
+}
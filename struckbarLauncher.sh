@@ -0,0 +1,2 @@
+#!/bin/bash
+xterm -hold -e "chuck --verbose /home/pi/SPC/struckbar.ck"
@@ -0,0 +1,119 @@
+'''
+    Coulomb Counter Tests
+        Feeds raw battery readings to a CoulombCounter and checks the
+        charge it integrates and the totals it keeps across restarts
+'''
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+'''
+    Stub Stream
+        Stands in for a FilteredStream, push() hands a battery reading to
+        every subscriber
+'''
+class StubStream:
+    def __init__(self):
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def push(self, t, battery):
+        for callback in self.subscribers:
+            callback(main.Sample(t, 0, 0, battery))
+
+def mA(raw):
+    return float(main.calibration.convert(main.BATTERY, raw))
+
+class CoulombCounterTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.statePath = os.path.join(directory.name, main.CHARGE_STATE)
+        self.stream = StubStream()
+        self.counter = main.CoulombCounter(self.stream, self.statePath)
+
+    def test_trapezoid_integration(self):
+        self.stream.push(0, 1200)
+        self.stream.push(10, 1400)
+        self.stream.push(40, 1400)
+        charging, sessionmAh, sessionSeconds, totalmAh = self.counter.snapshot
+        expected = (mA(1200) + mA(1400)) / 2 * 10 / 3600 + mA(1400) * 30 / 3600
+        self.assertTrue(charging)
+        self.assertAlmostEqual(sessionmAh, expected)
+        self.assertAlmostEqual(totalmAh, expected)
+        self.assertEqual(sessionSeconds, 40)
+
+    def test_idle_readings_are_not_counted(self):
+        self.stream.push(0, 800)
+        self.stream.push(10, 1000)
+        self.assertEqual(self.counter.snapshot, (False, 0.0, 0.0, 0.0))
+
+    def test_hysteresis(self):
+        self.stream.push(0, main.CHARGE_ON + 100)
+        # between the thresholds it keeps charging
+        self.stream.push(10, (main.CHARGE_ON + main.CHARGE_OFF) // 2)
+        self.stream.push(20, main.CHARGE_OFF + 10)
+        self.assertTrue(self.counter.charging)
+        self.assertEqual(self.counter.sessionSeconds, 20)
+        self.stream.push(30, main.CHARGE_OFF - 10)
+        self.assertFalse(self.counter.charging)
+        # the interval that ends a charge is still counted
+        self.assertEqual(self.counter.sessionSeconds, 30)
+        total = self.counter.totalmAh
+
+        # and it only starts again above CHARGE_ON
+        self.stream.push(40, main.CHARGE_ON - 10)
+        self.assertFalse(self.counter.charging)
+        self.assertEqual(self.counter.totalmAh, total)
+        self.stream.push(50, main.CHARGE_ON + 10)
+        charging, sessionmAh, sessionSeconds, totalmAh = self.counter.snapshot
+        self.assertEqual((charging, sessionmAh, sessionSeconds, totalmAh), (True, 0.0, 0.0, total))
+
+    def test_gaps_are_skipped(self):
+        self.stream.push(0, 1200)
+        self.stream.push(main.CHARGE_MAX_GAP + 1, 1200)
+        # a clock stepping back isn't counted either
+        self.stream.push(main.CHARGE_MAX_GAP - 5, 1200)
+        self.assertEqual(self.counter.snapshot, (True, 0.0, 0.0, 0.0))
+        self.stream.push(main.CHARGE_MAX_GAP, 1200)
+        self.assertAlmostEqual(self.counter.sessionmAh, mA(1200) * 5 / 3600)
+
+    def test_totals_survive_a_restart(self):
+        self.stream.push(0, 1200)
+        self.stream.push(30, 1200)
+        self.counter.save()
+        restarted = main.CoulombCounter(StubStream(), self.statePath)
+        self.assertEqual(restarted.snapshot, self.counter.snapshot)
+
+    def test_bad_state_file_starts_from_zero(self):
+        with open(self.statePath, "w") as f:
+            f.write("{ not json")
+        self.assertEqual(main.CoulombCounter(StubStream(), self.statePath).snapshot, (False, 0.0, 0.0, 0.0))
+
+    def test_saves_are_deferred_with_the_state_of_their_sample(self):
+        deferred = []
+        stream = StubStream()
+        counter = main.CoulombCounter(stream, self.statePath, deferred.append)
+        stream.push(0, 1200)
+        stream.push(10, 1200)
+        stream.push(20, 800)
+        # one save for each change of charging
+        self.assertEqual(len(deferred), 2)
+        self.assertFalse(os.path.exists(self.statePath))
+        deferred[0]()
+        with open(self.statePath) as f:
+            self.assertEqual(json.load(f), { 'charging':True, 'sessionmAh':0.0,
+                                             'sessionSeconds':0.0, 'totalmAh':0.0 })
+        deferred[1]()
+        with open(self.statePath) as f:
+            self.assertEqual(json.load(f), counter.state())
+
+if __name__ == "__main__":
+    unittest.main()
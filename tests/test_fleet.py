@@ -0,0 +1,140 @@
+'''
+    Fleet Telemetry Tests
+        Sends frames from simulated kiosks on localhost to a FleetCollector
+        and checks how it keys and counts them
+'''
+import asyncio
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+'''
+    Stub Stream
+        Stands in for a FilteredStream, the publisher only reads latest
+'''
+class StubStream:
+    def __init__(self):
+        self.latest = None
+
+'''
+    Stub Audio
+        Stands in for an AudioPlayThread that is always playing
+'''
+class StubAudio:
+    def stopped(self):
+        return False
+
+class FrameTest(unittest.TestCase):
+    def test_round_trip(self):
+        frame = main.FleetFrame("kiosk-a", 7, 1500000000.25, 12.5, 0.75, 1800.0, True, False)
+        data = main.encodeFrame(frame)
+        self.assertEqual(len(data), main.FLEET_FRAME.size)
+        decoded = main.decodeFrame(data)
+        self.assertEqual(decoded[:3], frame[:3])
+        # readings go out as 32 bit floats
+        for got, sent in zip(decoded[3:6], frame[3:6]):
+            self.assertAlmostEqual(got, sent, places=5)
+        self.assertEqual(decoded[6:], frame[6:])
+
+    def test_long_names_are_cut(self):
+        frame = main.FleetFrame("k" * 20, 0, 0.0, 0.0, 0.0, 0.0, False, True)
+        self.assertEqual(main.decodeFrame(main.encodeFrame(frame)).node, "k" * 16)
+
+    def test_rejects_other_datagrams(self):
+        data = main.encodeFrame(main.FleetFrame("kiosk-a", 0, 0.0, 0.0, 0.0, 0.0, False, False))
+        for bad in (data[:-1], b"XXXX" + data[4:], data[:4] + bytes([main.FLEET_VERSION + 1]) + data[5:]):
+            with self.assertRaises(ValueError):
+                main.decodeFrame(bad)
+
+class FleetCollectorTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.collector = main.FleetCollector(16)
+        transport, _ = self.loop.run_until_complete(self.loop.create_datagram_endpoint(
+            lambda: self.collector, local_addr=("127.0.0.1", 0)))
+        self.addCleanup(transport.close)
+        self.port = transport.get_extra_info("sockname")[1]
+
+    # a simulated kiosk whose frames are stamped from a stopped clock
+    def publisher(self, node):
+        stream = StubStream()
+        publisher = main.TelemetryPublisher(stream, StubAudio(), main.KioskState(0), main.SimClock(0, 0),
+                                            node, "127.0.0.1", self.port, 1)
+        self.addCleanup(publisher.sock.close)
+        return publisher
+
+    # sends one frame with the given seq and reading time
+    def send(self, publisher, seq, t):
+        publisher.stream.latest = main.Sample(t, 0, 0, 0)
+        publisher.seq = seq
+        publisher.send()
+
+    # runs the loop until the collector has taken n more datagrams
+    def receive(self, n):
+        done = lambda: sum(node.count + node.late for node in self.collector.nodes.values())
+        target = done() + n
+        deadline = time.monotonic() + 1
+        while done() < target and time.monotonic() < deadline:
+            self.loop.run_until_complete(asyncio.sleep(0.005))
+        self.assertEqual(done(), target)
+
+    def test_kiosks_are_kept_apart(self):
+        a, b = self.publisher("kiosk-a"), self.publisher("kiosk-b")
+        for seq in range(3):
+            self.send(a, seq, seq)
+            self.send(b, seq, seq)
+        self.receive(6)
+        self.assertEqual(sorted(self.collector.nodes), ["kiosk-a@127.0.0.1", "kiosk-b@127.0.0.1"])
+        for node in self.collector.nodes.values():
+            self.assertEqual(node.count, 3)
+            self.assertEqual(node.lost, 0)
+            self.assertEqual(list(node.history()['t']), [0, 1, 2])
+        summary = self.collector.summary()['nodes']["kiosk-a@127.0.0.1"]
+        self.assertEqual((summary['name'], summary['frames'], summary['playing']), ("kiosk-a", 3, True))
+
+    def test_same_name_from_two_addresses(self):
+        data = main.encodeFrame(main.FleetFrame("raspberrypi", 0, 0.0, 0.0, 0.0, 0.0, False, False))
+        self.collector.datagram_received(data, ("10.0.0.1", 9000))
+        self.collector.datagram_received(data, ("10.0.0.2", 9000))
+        self.assertEqual(sorted(self.collector.nodes), ["raspberrypi@10.0.0.1", "raspberrypi@10.0.0.2"])
+
+    def test_rejected_datagrams_are_counted(self):
+        self.collector.datagram_received(b"not a frame", ("10.0.0.1", 9000))
+        self.assertEqual(self.collector.rejected, 1)
+        self.assertEqual(self.collector.nodes, {})
+
+    def test_gaps_count_as_lost(self):
+        a = self.publisher("kiosk-a")
+        for seq in (0, 1, 5, 6):
+            self.send(a, seq, seq)
+        self.receive(4)
+        node = self.collector.nodes["kiosk-a@127.0.0.1"]
+        self.assertEqual((node.count, node.lost, node.late), (4, 3, 0))
+
+    def test_late_frames_are_not_lost(self):
+        a = self.publisher("kiosk-a")
+        for seq in (0, 1, 3, 2, 4):
+            self.send(a, seq, seq)
+            # one at a time so they arrive in this order
+            self.receive(1)
+        node = self.collector.nodes["kiosk-a@127.0.0.1"]
+        self.assertEqual((node.count, node.lost, node.late), (4, 0, 1))
+        # the late frame is kept out of the ring
+        self.assertEqual(list(node.history()['t']), [0, 1, 3, 4])
+
+    def test_restart_counts_on(self):
+        a = self.publisher("kiosk-a")
+        for seq, t in ((0, 0), (1, 1), (2, 2), (0, 10), (1, 11)):
+            self.send(a, seq, t)
+            self.receive(1)
+        node = self.collector.nodes["kiosk-a@127.0.0.1"]
+        self.assertEqual((node.count, node.lost, node.late), (5, 0, 0))
+        self.assertEqual(node.lastSeq, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,169 @@
+'''
+    OSC Note Output Tests
+        Sends notes through OSCNoteOutput to a loopback stand-in for the
+        ChucK receiver and checks what arrives
+'''
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+# returns a list of (timetag time or None, address, args)
+def oscDecode(data, t = None):
+    if data.startswith(b"#bundle\0"):
+        seconds, fraction = struct.unpack(">II", data[8:16])
+        if (seconds, fraction) != (0, 1):
+            t = seconds - main.NTP_DELTA + fraction / (1 << 32)
+        messages = []
+        pos = 16
+        while pos < len(data):
+            size = struct.unpack(">i", data[pos:pos + 4])[0]
+            messages += oscDecode(data[pos + 4:pos + 4 + size], t)
+            pos += 4 + size
+        return messages
+
+    def readString(pos):
+        end = data.index(b"\0", pos)
+        return data[pos:end].decode("utf-8"), end + 4 - (end % 4)
+
+    address, pos = readString(0)
+    tags, pos = readString(pos)
+    args = []
+    for tag in tags[1:]:
+        if tag == "i":
+            args.append(struct.unpack(">i", data[pos:pos + 4])[0])
+            pos += 4
+        elif tag == "f":
+            args.append(struct.unpack(">f", data[pos:pos + 4])[0])
+            pos += 4
+        elif tag == "s":
+            arg, pos = readString(pos)
+            args.append(arg)
+    return [(t, address, args)]
+
+'''
+    Loopback OSC Receiver
+        Stand-in for the ChucK receiver, listens on localhost and records
+        every message it gets
+'''
+class LoopbackOSCReceiver(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        # (timetag time, address, args)
+        self.messages = []
+        self.packets = 0
+
+    def run(self):
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                break
+            self.packets += 1
+            self.messages.extend(oscDecode(data))
+
+    # waits up to a second for n messages
+    def wait(self, n):
+        deadline = time.monotonic() + 1
+        while len(self.messages) < n and time.monotonic() < deadline:
+            time.sleep(0.005)
+        return self.messages
+
+    def close(self):
+        self.sock.close()
+
+class OSCNoteOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.receiver = LoopbackOSCReceiver()
+        self.receiver.start()
+        self.addCleanup(self.receiver.close)
+        self.transport = main.OSCTransport("127.0.0.1", self.receiver.port)
+        self.addCleanup(self.transport.close)
+
+    def assertArgs(self, args, expected):
+        self.assertEqual(len(args), len(expected))
+        for arg, value in zip(args, expected):
+            # floats go out as 32 bits
+            self.assertAlmostEqual(arg, value, places=5)
+
+    def test_setup_sends_every_voice(self):
+        output = main.OSCNoteOutput(self.transport, False, main.SystemClock())
+        output.setup(main.VOICES)
+        messages = self.receiver.wait(2)
+        self.assertEqual([address for t, address, args in messages],
+                         [main.OSC_SETUP_ADDRESS, main.OSC_SETUP_ADDRESS + "/1"])
+        for (t, address, args), voice in zip(messages, main.VOICES):
+            self.assertIsNone(t)
+            self.assertIsInstance(args[0], int)
+            self.assertArgs(args, voice)
+        self.assertEqual(self.receiver.packets, 1)
+
+    def test_play_without_timetags(self):
+        clock = main.SystemClock()
+        output = main.OSCNoteOutput(self.transport, False, clock)
+        self.assertEqual(output.sendAhead, 0)
+        now = clock.monotonic()
+        output.play([main.NoteEvent(now, 440.0, 0.5), main.NoteEvent(now, 110.0, 0.6, 1)])
+        messages = self.receiver.wait(4)
+        self.assertEqual([(t, address) for t, address, args in messages],
+                         [(None, main.OSC_FREQ_ADDRESS), (None, main.OSC_STRIKE_ADDRESS),
+                          (None, main.OSC_FREQ_ADDRESS + "/1"), (None, main.OSC_STRIKE_ADDRESS + "/1")])
+        self.assertArgs([args[0] for t, address, args in messages], [440.0, 0.5, 110.0, 0.6])
+        # one bundle per note
+        self.assertEqual(self.receiver.packets, 2)
+
+    def test_play_with_timetags(self):
+        clock = main.SystemClock()
+        output = main.OSCNoteOutput(self.transport, True, clock)
+        self.assertEqual(output.sendAhead, main.AUDIO_LOOKAHEAD)
+        now = clock.monotonic()
+        sent = time.time()
+        output.play([main.NoteEvent(now + 0.1, 440.0, 0.5), main.NoteEvent(now + 0.3, 220.0, 0.5)])
+        messages = self.receiver.wait(4)
+        self.assertEqual([address for t, address, args in messages],
+                         [main.OSC_FREQ_ADDRESS, main.OSC_STRIKE_ADDRESS] * 2)
+        # each note's bundle is stamped with the wall clock time it sounds
+        for (t, address, args), due in zip(messages, (0.1, 0.1, 0.3, 0.3)):
+            self.assertAlmostEqual(t - sent, due, delta=0.02)
+        # every note in one packet
+        self.assertEqual(self.receiver.packets, 1)
+
+    def test_timetags_follow_a_sped_up_clock(self):
+        clock = main.SimClock(time.time(), 60)
+        output = main.OSCNoteOutput(self.transport, True, clock)
+        sent = time.time()
+        output.play([main.NoteEvent(clock.monotonic() + 6, 440.0, 0.5)])
+        t, address, args = self.receiver.wait(2)[0]
+        # six simulated seconds are a tenth of a real one
+        self.assertAlmostEqual(t - sent, 0.1, delta=0.02)
+
+    def test_stepped_clock_sends_notes_due_now(self):
+        clock = main.SimClock(time.time(), 0)
+        output = main.OSCNoteOutput(self.transport, True, clock)
+        output.play([main.NoteEvent(clock.monotonic(), 440.0, 0.5)])
+        self.assertEqual([t for t, address, args in self.receiver.wait(2)], [None, None])
+
+    def test_audio_connect_builds_no_instruments(self):
+        hardware = main.SimulatedHardware(speed = 0)
+        for name, value in (("NOTE_OUTPUT", "osc"), ("OSC_PORT", self.receiver.port), ("hardware", hardware)):
+            self.addCleanup(setattr, main, name, getattr(main, name, None))
+            setattr(main, name, value)
+        audio = main.AudioPlayThread(main.MarkovComposer(0), hardware.clock)
+        self.assertEqual(audio.connect(), [])
+        self.addCleanup(audio.scheduler.output.transport.close)
+        self.assertEqual(hardware.instruments, [])
+        self.assertEqual([address for t, address, args in self.receiver.wait(2)],
+                         [main.OSC_SETUP_ADDRESS, main.OSC_SETUP_ADDRESS + "/1"])
+
+if __name__ == "__main__":
+    unittest.main()
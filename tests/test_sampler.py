@@ -0,0 +1,114 @@
+'''
+    Continuous ADC Sampler Tests
+        Drives ContinuousADCSampler with ready edges, by hand and from a
+        SimulatedADC converting in the background, and checks the scans it
+        publishes
+'''
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+# raw reading of each channel
+LEVELS = { main.VOLTAGE:100, main.CURRENT:200, main.BATTERY:300 }
+
+'''
+    Stepped ADC
+        Stands in for the ADS1115, converts only when told to so every
+        ready edge is made by the test
+'''
+class SteppedADC:
+    def __init__(self):
+        self.channel = None
+        # (channel, data rate) of every conversion started
+        self.started = []
+        self.stopped = False
+
+    def start_adc_comparator(self, channel, high_threshold, low_threshold, gain = 1,
+                             data_rate = None, active_low = True, traditional = True,
+                             latching = False, num_readings = 1):
+        self.channel = channel
+        self.started.append((channel, data_rate))
+
+    def get_last_result(self):
+        return LEVELS[self.channel]
+
+    def stop_adc(self):
+        self.stopped = True
+
+class ContinuousADCSamplerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = main.SimClock(0, 0)
+        self.gpio = main.SimulatedGPIO(self.clock)
+        self.adc = SteppedADC()
+        self.sampler = main.ContinuousADCSampler(self.adc, self.gpio, main.ALERT_PIN, main.DATA_RATE, self.clock)
+        self.samples = []
+        self.sampler.subscribe(self.samples.append)
+        self.sampler.begin()
+
+    def test_scans_round_robin(self):
+        self.assertEqual(self.gpio.input(main.ALERT_PIN), self.gpio.HIGH)
+        for step in range(6):
+            self.clock.advance(1)
+            self.gpio.edge(main.ALERT_PIN)
+        channels = [channel for channel, rate in self.adc.started]
+        self.assertEqual(channels, [main.VOLTAGE, main.CURRENT, main.BATTERY] * 2 + [main.VOLTAGE])
+        # a scan is published once its last channel is in
+        self.assertEqual(self.samples, [main.Sample(3, 100, 200, 300), main.Sample(6, 100, 200, 300)])
+        self.assertIs(self.sampler.latest, self.samples[-1])
+
+    def test_idle_rate_applies_from_the_next_conversion(self):
+        self.gpio.edge(main.ALERT_PIN)
+        self.sampler.setActive(False)
+        self.assertEqual(self.sampler.interval, 3.0 / main.IDLE_DATA_RATE)
+        self.gpio.edge(main.ALERT_PIN)
+        self.assertEqual([rate for channel, rate in self.adc.started],
+                         [main.DATA_RATE, main.DATA_RATE, main.IDLE_DATA_RATE])
+
+    def test_stalled_edges(self):
+        self.assertFalse(self.sampler.stalled())
+        self.sampler.lastReady -= 2
+        with self.assertLogs(main.log, "WARNING"):
+            self.assertTrue(self.sampler.stalled())
+        self.gpio.edge(main.ALERT_PIN)
+        self.assertFalse(self.sampler.stalled())
+
+    def test_stop(self):
+        self.sampler.stop()
+        self.assertTrue(self.adc.stopped)
+        self.gpio.edge(main.ALERT_PIN)
+        self.assertEqual(self.adc.started, [(main.VOLTAGE, main.DATA_RATE)])
+
+class SimulatedContinuousTest(unittest.TestCase):
+    def test_simulated_hardware(self):
+        start = time.time()
+        profile = main.SolarProfile([0, 86400], *[[LEVELS[channel]] * 2 for channel in
+                                                  (main.VOLTAGE, main.CURRENT, main.BATTERY)], start, 86400)
+        hardware = main.SimulatedHardware(profile, speed = 1.0)
+        sampler = main.ContinuousADCSampler(hardware.adc, hardware.alertGPIO, main.ALERT_PIN,
+                                            main.DATA_RATE, hardware.clock)
+        samples = []
+        scanned = threading.Event()
+        def collect(sample):
+            samples.append(sample)
+            if len(samples) >= 5:
+                scanned.set()
+        sampler.subscribe(collect)
+        sampler.begin()
+        self.addCleanup(sampler.stop)
+        # three conversions a scan at DATA_RATE, well under a second
+        self.assertTrue(scanned.wait(2))
+        sampler.stop()
+        for sample in samples:
+            self.assertEqual(sample[1:], (100, 200, 300))
+        times = [sample.t for sample in samples]
+        self.assertEqual(times, sorted(times))
+        self.assertGreater(times[-1], times[0])
+        self.assertGreaterEqual(hardware.adc.reads[main.BATTERY], 5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+'''
+    Telemetry Store Tests
+        Writes segment files to a temporary folder, damages them the way a
+        power cut or a stepped clock would, and checks what reads back
+'''
+import os
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+DAY = 86400
+# midnight UTC, so the segments start on whole days
+START = 1500076800.0
+
+class TelemetrySegmentTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "segment.tlm")
+
+    # a closed segment holding n records a second apart
+    def write(self, n):
+        segment = main.TelemetrySegment(self.path, START, DAY, 100)
+        for i in range(n):
+            segment.append(START + i, i, 2 * i, 3 * i)
+        offset = segment.dataOffset
+        segment.close()
+        return offset
+
+    def patch(self, offset, data):
+        with open(self.path, "r+b") as f:
+            f.seek(offset)
+            f.write(data)
+
+    def reopen(self):
+        segment = main.TelemetrySegment(self.path)
+        self.addCleanup(segment.close)
+        return segment
+
+    def test_reopen_keeps_every_record(self):
+        self.write(3)
+        segment = self.reopen()
+        self.assertEqual(segment.count, 3)
+        self.assertEqual(list(segment.query(START, START + DAY)['voltage']), [0, 1, 2])
+
+    def test_torn_record_is_dropped(self):
+        offset = self.write(3)
+        size = main.TelemetrySegment.RECORD.size
+        # only the time of the last record reached the card
+        self.patch(offset + 2 * size + 8, bytes(size - 8))
+        segment = self.reopen()
+        self.assertEqual(segment.count, 2)
+        # and the next reading takes its place
+        segment.append(START + 5, 5, 10, 15)
+        self.assertEqual(list(segment.query(START, START + DAY)['t'] - START), [0, 1, 5])
+
+    def test_header_lagging_the_records(self):
+        self.write(3)
+        # the power went before the count was written
+        self.patch(16, struct.pack("<Q", 1))
+        self.assertEqual(self.reopen().count, 3)
+
+    def test_crc_mismatch_ends_the_records(self):
+        offset = self.write(3)
+        size = main.TelemetrySegment.RECORD.size
+        self.patch(16, struct.pack("<Q", 1))
+        # a flipped bit in the voltage of the second record
+        self.patch(offset + size + 8, b"\xff")
+        segment = self.reopen()
+        self.assertEqual(segment.count, 1)
+        self.assertEqual(list(segment.query(START, START + DAY)['voltage']), [0])
+
+class TelemetryStoreTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def store(self, rate = 1, period = DAY, retention = 30):
+        store = main.TelemetryStore(self.directory, rate, period, retention)
+        self.addCleanup(lambda: store.segment is not None and store.segment.close())
+        return store
+
+    def files(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_rolls_over_each_day(self):
+        store = self.store()
+        for t in (START + 10, START + DAY + 10, START + 2 * DAY + 10):
+            store.append(t, 0, 0, 0)
+        self.assertEqual(len(self.files()), 3)
+        self.assertEqual(list(store.query(START, START + 3 * DAY)['t'] - START),
+                         [10, DAY + 10, 2 * DAY + 10])
+        self.assertEqual(list(store.query(START + DAY, START + 2 * DAY)['t'] - START), [DAY + 10])
+
+    def test_clock_stepping_back_starts_a_new_part(self):
+        store = self.store()
+        times = [100, 101, 102, 50, 51, 103]
+        for t in times:
+            store.append(START + t, t, 0, 0)
+        self.assertEqual(len(self.files()), 2)
+        self.assertEqual(list(store.query(START, START + DAY)['t'] - START), sorted(times))
+        # every part is still in order after a restart
+        store.segment.close()
+        store.segment = None
+        self.assertEqual(list(self.store().query(START, START + DAY)['t'] - START), sorted(times))
+
+    def test_clock_stepping_back_a_day(self):
+        store = self.store()
+        for t in (100, DAY + 100, 50):
+            store.append(START + t, 0, 0, 0)
+        self.assertEqual(len(self.files()), 3)
+        self.assertEqual(list(store.query(START, START + 2 * DAY)['t'] - START), [50, 100, DAY + 100])
+
+    def test_restart_appends_to_the_same_part(self):
+        store = self.store()
+        store.append(START + 10, 0, 0, 0)
+        store.segment.close()
+        store.segment = None
+        store = self.store()
+        store.append(START + 20, 0, 0, 0)
+        self.assertEqual(len(self.files()), 1)
+        self.assertEqual(list(store.query(START, START + DAY)['t'] - START), [10, 20])
+
+    def test_full_segment_goes_on_in_a_new_part(self):
+        # a minute at one reading every 20 seconds holds 6
+        store = self.store(rate = 0.05, period = 60)
+        for t in range(8):
+            store.append(START + t, 0, 0, 0)
+        self.assertEqual(len(self.files()), 2)
+        self.assertEqual(len(store.query(START, START + 60)), 8)
+
+    def test_expire_removes_every_part(self):
+        store = self.store(retention = 1)
+        for t in (100, 50, 3 * DAY):
+            store.append(START + t, 0, 0, 0)
+        self.assertEqual(len(self.files()), 1)
+        self.assertEqual(list(store.query(0, float("inf"))['t'] - START), [3 * DAY])
+
+if __name__ == "__main__":
+    unittest.main()
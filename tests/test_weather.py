@@ -0,0 +1,165 @@
+'''
+    Weather Fetcher Tests
+        Runs the WeatherFetcher against a stub HTTP server on localhost
+'''
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+'''
+    Stub Provider
+        Asks the stub server for {"temp": ..., "text": ...}
+'''
+class StubProvider(main.WeatherProvider):
+    def __init__(self, port):
+        self.port = port
+
+    def url(self):
+        return "http://127.0.0.1:" + str(self.port) + "/weather"
+
+    def parse(self, data):
+        return data['temp'], data['text']
+
+'''
+    Stub Server
+        Answers every request with reply(headers), the raw bytes to send,
+        or None to never answer
+'''
+class StubServer:
+    def __init__(self, reply):
+        self.reply = reply
+        self.requests = []
+        self.handlers = set()
+        self.server = None
+        self.port = None
+
+    async def handle(self, reader, writer):
+        self.handlers.add(asyncio.current_task())
+        head = await reader.readuntil(b"\r\n\r\n")
+        headers = {}
+        for line in head.decode("latin-1").split("\r\n")[1:]:
+            name, _, value = line.partition(":")
+            if name:
+                headers[name.strip().lower()] = value.strip()
+        self.requests.append(headers)
+        response = self.reply(headers)
+        if response is None:
+            await asyncio.sleep(3600)
+        writer.write(response)
+        await writer.drain()
+        writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    # also drops the requests left unanswered
+    def close(self, loop):
+        self.server.close()
+        for handler in self.handlers:
+            handler.cancel()
+        loop.run_until_complete(asyncio.gather(*self.handlers, return_exceptions=True))
+
+def ok(temp, text, etag):
+    body = json.dumps({ 'temp':temp, 'text':text }).encode("utf-8")
+    return (b"HTTP/1.0 200 OK\r\nContent-Type: application/json\r\nETag: " + etag.encode("latin-1") +
+            b"\r\n\r\n" + body)
+
+class WeatherFetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        # cleanups run last first, so the servers close before the loop
+        self.addCleanup(self.loop.close)
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.cachePath = os.path.join(self.dir.name, "weather.json")
+
+    def fetcher(self, reply, timeout = 5):
+        server = StubServer(reply)
+        self.loop.run_until_complete(server.start())
+        self.addCleanup(server.close, self.loop)
+        fetcher = main.WeatherFetcher(StubProvider(server.port), self.cachePath, 600, timeout, 60)
+        return server, fetcher
+
+    def test_200_fills_and_saves_cache(self):
+        server, fetcher = self.fetcher(lambda headers: ok(71, "Clear", '"v1"'))
+        self.loop.run_until_complete(fetcher.refresh())
+        self.assertEqual((fetcher.cache['temp'], fetcher.cache['text']), (71, "Clear"))
+        self.assertEqual(fetcher.cache['etag'], '"v1"')
+        with open(self.cachePath) as f:
+            self.assertEqual(json.load(f)['text'], "Clear")
+
+    def test_cache_is_saved_off_the_loop(self):
+        server, fetcher = self.fetcher(lambda headers: ok(71, "Clear", '"v1"'))
+        threads = []
+        save = fetcher.saveCache
+        def recordThread():
+            threads.append(threading.current_thread())
+            save()
+        fetcher.saveCache = recordThread
+        self.loop.run_until_complete(fetcher.refresh())
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+        self.assertTrue(os.path.exists(self.cachePath))
+
+    def test_304_keeps_cache(self):
+        def reply(headers):
+            if headers.get('if-none-match') == '"v1"':
+                return b"HTTP/1.0 304 Not Modified\r\n\r\n"
+            return ok(71, "Clear", '"v1"')
+        server, fetcher = self.fetcher(reply)
+        self.loop.run_until_complete(fetcher.refresh())
+        fetched = fetcher.cache['fetched']
+        time.sleep(0.01)
+        self.loop.run_until_complete(fetcher.refresh())
+        self.assertEqual(server.requests[1].get('if-none-match'), '"v1"')
+        self.assertEqual((fetcher.cache['temp'], fetcher.cache['text']), (71, "Clear"))
+        self.assertGreater(fetcher.cache['fetched'], fetched)
+
+    def test_timeout(self):
+        server, fetcher = self.fetcher(lambda headers: None, timeout = 0.2)
+        with self.assertRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(fetcher.refresh())
+        self.assertIsNone(fetcher.cache)
+
+    def test_malformed_reply(self):
+        for response in (b"", b"garbage", b"HTTP/1.0\r\n\r\n"):
+            server, fetcher = self.fetcher(lambda headers: response)
+            with self.assertRaises(ValueError):
+                self.loop.run_until_complete(fetcher.refresh())
+
+    def test_malformed_reply_does_not_stop_run(self):
+        server, fetcher = self.fetcher(lambda headers: b"garbage")
+        failures = main.weatherFetchFailures.value
+        task = self.loop.create_task(fetcher.run(lambda temp, text: None))
+        self.loop.run_until_complete(asyncio.sleep(0.3))
+        self.assertFalse(task.done())
+        self.assertEqual(main.weatherFetchFailures.value, failures + 1)
+        task.cancel()
+        self.loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+
+    def test_boot_publishes_last_known_good(self):
+        server, fetcher = self.fetcher(lambda headers: None)
+        with open(self.cachePath, "w") as f:
+            json.dump({ 'url':fetcher.provider.url(), 'temp':55, 'text':"Rain",
+                        'fetched':time.time(), 'etag':None, 'lastModified':None }, f)
+        published = []
+        task = self.loop.create_task(fetcher.run(lambda temp, text: published.append((temp, text))))
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual(published, [(55, "Rain")])
+        # still fresh, so the network isn't touched
+        self.assertEqual(server.requests, [])
+        task.cancel()
+        self.loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+
+if __name__ == "__main__":
+    unittest.main()